@@ -7,6 +7,8 @@ import "os"
 import "log"
 import "math"
 import "sync"
+import "runtime"
+import "unsafe"
 import "C"
 
 
@@ -143,6 +145,120 @@ func createAnimation(temp_file string){
 
 }
 
+func psf_kernel(center float64, sigma float64, half_width int, size int, pixel_length_in_um float64, kernel []float64) int{
+    // Same window as add_molecule_at_position_to_frame, returns the first pixel of the kernel
+    nearest_pixel := int(math.Round(center/pixel_length_in_um))
+    min_pixel := nearest_pixel - half_width
+    for k := range kernel{
+        kernel[k] = 0
+        pixel := min_pixel + k
+        if pixel >= 0 && pixel < size{
+            x := float64(pixel) * pixel_length_in_um
+            kernel[k] = math.Exp(- math.Pow((x-center),2)/(2*math.Pow(sigma,2)))
+        }
+    }
+    return min_pixel
+}
+
+// Frames are rendered in float64 and added to the output at the end
+func render_frame_to_buffer(frame_index int, positions []float64, offsets []int64, start_frames []int64, intensities []float64,
+                            number_of_subframes_per_frame int, pixel_length_in_um float64, sigma_x float64, sigma_y float64,
+                            screen_size_x int, screen_size_y int, frame []float64){
+    half_width_x := int(5 * (math.Round(sigma_x/pixel_length_in_um)+1))
+    half_width_y := int(5 * (math.Round(sigma_y/pixel_length_in_um)+1))
+    kernel_x := make([]float64, 2*half_width_x)
+    kernel_y := make([]float64, 2*half_width_y)
+
+    first_subframe := int64(frame_index*number_of_subframes_per_frame)
+    last_subframe := first_subframe + int64(number_of_subframes_per_frame)
+    for molecule := range start_frames{
+        // Rows of the molecule that are alive in the subframes of the frame
+        first_row := offsets[molecule] + first_subframe - start_frames[molecule]
+        last_row := offsets[molecule] + last_subframe - start_frames[molecule]
+        if first_row < offsets[molecule]{
+            first_row = offsets[molecule]
+        }
+        if last_row > offsets[molecule + 1]{
+            last_row = offsets[molecule + 1]
+        }
+        intensity := 1.0
+        if intensities != nil{
+            intensity = intensities[molecule]
+        }
+        for row := first_row; row < last_row; row++{
+            min_x_pixel := psf_kernel(positions[3*row], sigma_x, half_width_x, screen_size_x, pixel_length_in_um, kernel_x)
+            min_y_pixel := psf_kernel(positions[3*row + 1], sigma_y, half_width_y, screen_size_y, pixel_length_in_um, kernel_y)
+            for i, value_x := range kernel_x{
+                if value_x == 0{
+                    continue
+                }
+                value_x *= intensity
+                line := frame[(min_x_pixel + i)*screen_size_y:]
+                for j, value_y := range kernel_y{
+                    if value_y != 0{
+                        line[min_y_pixel + j] += value_x * value_y
+                    }
+                }
+            }
+        }
+    }
+}
+
+//export renderFrames
+func renderFrames(positions *C.double, offsets *C.longlong, start_frames *C.longlong, intensities *C.double,
+                  number_of_molecules C.longlong,
+                  first_frame C.longlong, number_of_frames C.longlong, number_of_subframes_per_frame C.longlong,
+                  pixel_length_in_um C.double, sigma_x C.double, sigma_y C.double,
+                  screen_size_x C.longlong, screen_size_y C.longlong,
+                  output *C.float){
+    // Binary interface : renders frames [first_frame, first_frame + number_of_frames) of the journeys
+    //     positions    - (offsets[number_of_molecules], 3) doubles, the journeys back to back
+    //     offsets      - number_of_molecules + 1 int64, molecule i owns rows offsets[i]..offsets[i+1]
+    //     start_frames - the subframe of the first position of every molecule
+    //     intensities  - per molecule, or NULL for 1
+    //     output       - (number_of_frames, screen_size_x, screen_size_y) float32, owned by the caller.
+    //                    Frames are added to it, so several calls can render into the same stack
+    // Nothing is copied or parsed, the frames are written straight into the caller's memory
+    n := int(number_of_molecules)
+    offsets_slice := unsafe.Slice((*int64)(unsafe.Pointer(offsets)), n + 1)
+    start_frames_slice := unsafe.Slice((*int64)(unsafe.Pointer(start_frames)), n)
+    positions_slice := unsafe.Slice((*float64)(unsafe.Pointer(positions)), 3*offsets_slice[n])
+    var intensities_slice []float64
+    if intensities != nil{
+        intensities_slice = unsafe.Slice((*float64)(unsafe.Pointer(intensities)), n)
+    }
+    frame_size := int(screen_size_x) * int(screen_size_y)
+    output_slice := unsafe.Slice((*float32)(unsafe.Pointer(output)), int(number_of_frames)*frame_size)
+
+    frame_indices := make(chan int)
+    var wg sync.WaitGroup
+    number_of_workers := runtime.GOMAXPROCS(0)
+    wg.Add(number_of_workers)
+    for w := 0; w < number_of_workers; w++{
+        go func(){
+            defer wg.Done()
+            frame := make([]float64, frame_size)
+            for idx := range frame_indices{
+                for k := range frame{
+                    frame[k] = 0
+                }
+                render_frame_to_buffer(int(first_frame) + idx, positions_slice, offsets_slice, start_frames_slice, intensities_slice,
+                                       int(number_of_subframes_per_frame), float64(pixel_length_in_um), float64(sigma_x), float64(sigma_y),
+                                       int(screen_size_x), int(screen_size_y), frame)
+                out := output_slice[idx*frame_size:(idx + 1)*frame_size]
+                for k, value := range frame{
+                    out[k] += float32(value)
+                }
+            }
+        }()
+    }
+    for idx := 0; idx < int(number_of_frames); idx++{
+        frame_indices <- idx
+    }
+    close(frame_indices)
+    wg.Wait()
+}
+
 func main(){
     fmt.Println("You should compile not RUN!")
 }
\ No newline at end of file
@@ -0,0 +1,239 @@
+import ast
+import hashlib
+import importlib.util
+import json
+import os
+import numpy as np
+
+CACHE_DIRECTORY_ENVIRONMENT_VARIABLE = 'DIFFUSION_SIMULATION_CACHE'
+DEFAULT_MAXIMUM_BYTES = 20 * 2**30
+
+# The cached results are only valid for the code that produced them : these modules,
+# every module of the repository they import, and the Go source of the renderer library
+_CODE_MODULES = ['simulation', 'fused_simulation', 'go_renderer']
+_CODE_FILES = [os.path.join('Animation', 'animation.go')]
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+ARRAYS_EXTENSION = '.npz'
+FRAMES_EXTENSION = '.npy'
+TEMPORARY_EXTENSION = '.tmp'
+
+
+def _module_file(name):
+    """
+        Source file of module name as it would be imported (gui/simulation.py in the gui),
+        None if it is not a module of the repository. The modules of the repository are all
+        top level ones, and looking up a submodule would import its package.
+    """
+    if '.' in name:
+        return None
+    try:
+        spec = importlib.util.find_spec(name)
+    except (ImportError, ValueError):
+        return None
+    if spec is None or spec.origin is None or not spec.origin.endswith('.py'):
+        return None
+    origin = os.path.abspath(spec.origin)
+    if os.path.commonpath([origin, REPOSITORY_DIRECTORY]) != REPOSITORY_DIRECTORY:
+        return None
+    return origin
+
+
+def _imported_names(filename):
+    with open(filename, 'rb') as f:
+        tree = ast.parse(f.read(), filename)
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                yield alias.name
+        elif isinstance(node, ast.ImportFrom) and node.module is not None and not node.level:
+            yield node.module
+
+
+def code_files(modules = _CODE_MODULES):
+    """
+        Sorted source files of modules and of every repository module they import, recursively
+    """
+    files = set()
+    pending = [_module_file(name) for name in modules]
+    while pending:
+        filename = pending.pop()
+        if filename is None or filename in files:
+            continue
+        files.add(filename)
+        pending.extend(_module_file(name) for name in _imported_names(filename))
+    return sorted(files)
+
+
+def _code_version():
+    digest = hashlib.sha256()
+    files = code_files() + [os.path.join(REPOSITORY_DIRECTORY, filename) for filename in _CODE_FILES]
+    for filename in files:
+        if os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+CODE_VERSION = _code_version()
+
+
+def _canonical(value):
+    """
+        JSON-able version of value, with numpy types turned into plain python ones
+    """
+    if isinstance(value, dict):
+        return {str(k) : _canonical(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    if isinstance(value, np.ndarray) or isinstance(value, np.generic):
+        return _canonical(value.tolist())
+    if isinstance(value, (type, np.dtype)):
+        return np.dtype(value).str
+    return value
+
+
+class SimulationCache:
+    """
+        Content addressed cache of trajectories and rendered frame stacks.
+        Keys are hashes of a canonical JSON of what produced the data (parameters, seed, ...)
+        and of the code version. Entries are plain files in directory, the least recently
+        used ones are deleted when the directory grows over maximum_bytes.
+    """
+    def __init__(self, directory, maximum_bytes = DEFAULT_MAXIMUM_BYTES):
+        self.directory = directory
+        self.maximum_bytes = maximum_bytes
+        os.makedirs(directory, exist_ok = True)
+
+    def key(self, *parts):
+        text = json.dumps([CODE_VERSION, _canonical(list(parts))], sort_keys = True)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def _path(self, key, extension):
+        return os.path.join(self.directory, key + extension)
+
+    def _hit(self, path):
+        if not os.path.exists(path):
+            return False
+        # Access time is not reliable on every file system, so the modification time is the LRU clock
+        os.utime(path, None)
+        return True
+
+    def _commit(self, temporary_path, path):
+        os.replace(temporary_path, path)
+        self.evict()
+
+    def load_arrays(self, key):
+        path = self._path(key, ARRAYS_EXTENSION)
+        if not self._hit(path):
+            return None
+        with np.load(path) as arrays:
+            return {name : arrays[name] for name in arrays.files}
+
+    def save_arrays(self, key, **arrays):
+        path = self._path(key, ARRAYS_EXTENSION)
+        temporary_path = path + TEMPORARY_EXTENSION
+        with open(temporary_path, 'wb') as f:
+            np.savez(f, **arrays)
+        self._commit(temporary_path, path)
+
+    def load_frames(self, key):
+        """
+            A read-only memory map of the cached frames, or None
+        """
+        path = self._path(key, FRAMES_EXTENSION)
+        if not self._hit(path):
+            return None
+        return np.load(path, mmap_mode = 'r')
+
+    def save_frames(self, key, frames):
+        path = self._path(key, FRAMES_EXTENSION)
+        temporary_path = path + TEMPORARY_EXTENSION
+        with open(temporary_path, 'wb') as f:
+            np.save(f, frames)
+        self._commit(temporary_path, path)
+
+    def cached_batches(self, key, renderer, batch_size):
+        """
+            Same as renderer.iter_batches(batch_size), but from the cache when the stack is there.
+            Otherwise the rendered batches are written to the cache while they pass, and the stack
+            is only added to the cache once all of them were consumed.
+        """
+        frames = self.load_frames(key)
+        if frames is not None:
+            for start in range(0, len(frames), batch_size):
+                yield list(range(start, min(start + batch_size, len(frames)))), frames[start:start + batch_size]
+            return
+
+        path = self._path(key, FRAMES_EXTENSION)
+        temporary_path = path + TEMPORARY_EXTENSION
+        output = np.lib.format.open_memmap(temporary_path, mode = 'w+', dtype = renderer.dtype,
+                                           shape = (renderer.number_of_frames,) + renderer.frame_shape)
+        try:
+            for frame_indices, frames in renderer.iter_batches(batch_size):
+                output[frame_indices[0]:frame_indices[-1] + 1] = frames
+                yield frame_indices, frames
+            output.flush()
+            del output
+            self._commit(temporary_path, path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+    def evict(self):
+        entries = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith((ARRAYS_EXTENSION, FRAMES_EXTENSION)):
+                continue
+            path = os.path.join(self.directory, filename)
+            entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.maximum_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+
+_default_cache = {}
+
+
+def set_default_cache(directory, maximum_bytes = DEFAULT_MAXIMUM_BYTES):
+    """
+        Turns on caching for all the simulations (directory = None turns it off)
+    """
+    _default_cache['cache'] = None if directory is None else SimulationCache(directory, maximum_bytes)
+
+
+def get_default_cache():
+    """
+        The cache set by set_default_cache, or by the DIFFUSION_SIMULATION_CACHE environment variable
+    """
+    if 'cache' not in _default_cache:
+        directory = os.environ.get(CACHE_DIRECTORY_ENVIRONMENT_VARIABLE)
+        set_default_cache(directory)
+    return _default_cache['cache']
+
+
+def cached_render(cache, key, renderer, progress = lambda x:x):
+    """
+        renderer.render(), through the cache when there is one (cache and key are not None).
+        Always a writable in-memory ndarray : a hit is copied out of the read-only memory map
+        (use SimulationCache.load_frames to keep the frames on disk).
+    """
+    if cache is None or key is None:
+        return renderer.render(progress = progress)
+    frames = cache.load_frames(key)
+    if frames is None:
+        frames = renderer.render(progress = progress)
+        cache.save_frames(key, frames)
+        return frames
+    return np.array(frames)
+
+
+def cached_batches(cache, key, renderer, batch_size):
+    """
+        renderer.iter_batches(batch_size), through the cache when there is one
+    """
+    if cache is None or key is None:
+        return renderer.iter_batches(batch_size)
+    return cache.cached_batches(key, renderer, batch_size)
@@ -0,0 +1,71 @@
+import numpy as np
+
+DEFAULT_BIT_DEPTH = 16
+DEFAULT_OFFSET = 100.
+
+
+class CameraModel:
+    """
+        Turns rendered frames (expected photons per pixel) into camera counts :
+            photo electrons  - Poisson(quantum_efficiency * frame + background)
+            em_gain          - EMCCD multiplication register, Gamma(electrons, em_gain)
+                               (None for an sCMOS / CCD)
+            read_noise       - gaussian, in electrons
+            gain, offset     - electrons to ADU, and the baseline in ADU
+        gain, offset and read_noise can also be (X, Y) maps, as for an sCMOS.
+        Counts are rounded and saturate at 0 and 2^bit_depth - 1 instead of wrapping around.
+        Frames are converted a block at a time into a uint16 buffer that is kept and reused,
+        and every frame draws from the noise stream of its own frame index, so the noise
+        does not depend on the blocks.
+    """
+    def __init__(self, quantum_efficiency = 1.,
+                 background = 0.,
+                 em_gain = None,
+                 gain = 1.,
+                 read_noise = 0.,
+                 offset = DEFAULT_OFFSET,
+                 bit_depth = DEFAULT_BIT_DEPTH):
+        if bit_depth > 16:
+            raise Exception("Frames are written as uint16, bit_depth has to be at most 16, got {}".format(bit_depth))
+        self.quantum_efficiency = quantum_efficiency
+        self.background = background
+        self.em_gain = em_gain
+        self.gain = np.asarray(gain, dtype = np.float32)
+        self.read_noise = np.asarray(read_noise, dtype = np.float32)
+        self.offset = np.asarray(offset, dtype = np.float32)
+        self.bit_depth = bit_depth
+        self.maximum_value = 2 ** bit_depth - 1
+        self._output = None
+        self._scratch = None
+
+    def _buffers(self, shape):
+        if self._output is None or self._output.shape[1:] != shape[1:] or len(self._output) < shape[0]:
+            self._output = np.empty(shape, dtype = np.uint16)
+            self._scratch = np.empty(shape, dtype = np.float32)
+        return self._output[:shape[0]], self._scratch[:shape[0]]
+
+    def apply(self, frames, frame_indices, random_streams):
+        """
+            Camera counts of a block of frames, as a (len(frames), X, Y) uint16 array.
+            The array is a reused buffer, it is only valid until the next call.
+        """
+        frames = np.asarray(frames)
+        output, scratch = self._buffers(frames.shape)
+        for slot, frame_index in enumerate(frame_indices):
+            generator = random_streams.noise(frame_index)
+            # Rendered frames may be a round-off below zero (e.g. the FFT render mode)
+            electrons = generator.poisson(np.maximum(self.quantum_efficiency * frames[slot] + self.background, 0))
+            if self.em_gain is not None:
+                # A sum of n exponential multiplications, zero electrons stay zero
+                electrons = generator.gamma(electrons, self.em_gain)
+            generator.standard_normal(dtype = np.float32, out = scratch[slot])
+            scratch[slot] *= self.read_noise
+            scratch[slot] += electrons
+
+        # In place on the whole block, no temporaries
+        scratch *= self.gain
+        scratch += self.offset
+        np.rint(scratch, out = scratch)
+        np.clip(scratch, 0, self.maximum_value, out = scratch)
+        np.copyto(output, scratch, casting = 'unsafe')
+        return output
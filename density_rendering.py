@@ -0,0 +1,110 @@
+import numpy as np
+from scipy.signal import fftconvolve
+from psf_kernels import psf_profile, GAUSSIAN_PSF
+
+WINDOW_RENDER_MODE = 'window'
+FFT_RENDER_MODE = 'fft'
+AUTOMATIC_RENDER_MODE = 'automatic'
+RENDER_MODES = [WINDOW_RENDER_MODE, FFT_RENDER_MODE, AUTOMATIC_RENDER_MODE]
+
+# Largest error the grid may add to a pixel, per emitter, relative to the peak of its PSF
+DEFAULT_TOLERANCE = 1e-2
+
+# Measured cost of one grid cell of the FFT mode (deposit, two 1-D FFT convolutions)
+# in units of one emitter pixel of the window mode
+FFT_COST_PER_CELL = 2.
+
+
+def oversampling_for_tolerance(sigma_x_in_um, sigma_y_in_um, pixel_length_in_um, tolerance):
+    """
+        Smallest number of grid cells per pixel for which error_bound is within tolerance
+    """
+    grid_spacing = min(sigma_x_in_um, sigma_y_in_um) * np.sqrt(4 * tolerance)
+    return max(1, int(np.ceil(pixel_length_in_um / grid_spacing)))
+
+
+class DensityGrid:
+    """
+        Renders all the emitters of a frame at once : they are deposited on a grid
+        oversampling times finer than the pixels (cloud in cell, bilinear weights),
+        the grid is convolved with the PSF by FFT, one axis at a time, and sampled
+        at the camera pixels. The cost depends on the number of pixels, not of emitters.
+        The grid extends half_width pixels around the screen, so emitters right outside
+        of it still light its border, and the PSF is cut at half_width pixels,
+        like the windows of FrameRenderer.
+        Bilinear deposit is linear interpolation of the PSF between grid nodes, so a pixel
+        is off by at most (h / sigma_x)^2 / 8 + (h / sigma_y)^2 / 8 per unit of intensity,
+        h being the grid spacing (error_bound).
+    """
+    def __init__(self, screen_size, pixel_length_in_um, sigma_x_in_um, sigma_y_in_um,
+                 half_width_x, half_width_y,
+                 psf = GAUSSIAN_PSF,
+                 tolerance = DEFAULT_TOLERANCE):
+        self.screen_size = [int(screen_size[0]), int(screen_size[1])]
+        self.pixel_length_in_um = pixel_length_in_um
+        self.sigma_x_in_um = sigma_x_in_um
+        self.sigma_y_in_um = sigma_y_in_um
+        self.oversampling = oversampling_for_tolerance(sigma_x_in_um, sigma_y_in_um,
+                                                       pixel_length_in_um, tolerance)
+        self.grid_spacing_in_um = pixel_length_in_um / self.oversampling
+        self.window_pixels = 4 * half_width_x * half_width_y
+
+        # Number of grid nodes before the node of pixel 0, and PSF samples on each side of a node
+        self.margins = [half_width_x * self.oversampling, half_width_y * self.oversampling]
+        self.grid_shape = tuple(margin * 2 + size * self.oversampling
+                                for margin, size in zip(self.margins, self.screen_size))
+        self.kernels = [psf_profile(np.arange(-margin, margin + 1) * self.grid_spacing_in_um,
+                                    sigma, pixel_length_in_um, psf)
+                        for margin, sigma in zip(self.margins, [sigma_x_in_um, sigma_y_in_um])]
+
+    def error_bound(self):
+        return ((self.grid_spacing_in_um / self.sigma_x_in_um) ** 2 +
+                (self.grid_spacing_in_um / self.sigma_y_in_um) ** 2) / 8
+
+    @property
+    def number_of_cells(self):
+        return self.grid_shape[0] * self.grid_shape[1]
+
+    def is_cheaper(self, number_of_emitters):
+        """
+            Whether the grid costs less than adding number_of_emitters PSF windows
+        """
+        return number_of_emitters * self.window_pixels > FFT_COST_PER_CELL * self.number_of_cells
+
+    def deposit(self, xs, ys, intensities):
+        grid_x = np.asarray(xs, dtype = np.float64) / self.grid_spacing_in_um + self.margins[0]
+        grid_y = np.asarray(ys, dtype = np.float64) / self.grid_spacing_in_um + self.margins[1]
+        first_x, first_y = np.floor(grid_x).astype(np.int64), np.floor(grid_y).astype(np.int64)
+        fraction_x, fraction_y = grid_x - first_x, grid_y - first_y
+        # Emitters further than half_width pixels from the screen do not reach it
+        inside = (first_x >= 0) & (first_x < self.grid_shape[0] - 1) & \
+                 (first_y >= 0) & (first_y < self.grid_shape[1] - 1)
+
+        grid = np.zeros(self.number_of_cells)
+        for dx, weight_x in [(0, 1 - fraction_x), (1, fraction_x)]:
+            for dy, weight_y in [(0, 1 - fraction_y), (1, fraction_y)]:
+                cells = (first_x + dx) * self.grid_shape[1] + first_y + dy
+                grid += np.bincount(cells[inside], weights = (intensities * weight_x * weight_y)[inside],
+                                    minlength = self.number_of_cells)
+        return grid.reshape(self.grid_shape)
+
+    def _convolve_and_sample(self, grid, axis):
+        """
+            Convolves along axis and keeps the nodes of the pixels of the screen
+        """
+        margin = self.margins[axis]
+        shape = [1, 1]
+        shape[axis] = -1
+        convolved = fftconvolve(grid, self.kernels[axis].reshape(shape), mode = 'full', axes = axis)
+        # Node n of the full convolution is node n - margin of the grid, pixel i is node margin + i * oversampling
+        nodes = slice(2 * margin, 2 * margin + self.screen_size[axis] * self.oversampling, self.oversampling)
+        return convolved[(nodes, slice(None)) if axis == 0 else (slice(None), nodes)]
+
+    def add_emitters_to_frame(self, frame, xs, ys, intensities):
+        if len(xs) == 0:
+            return frame
+        grid = self.deposit(xs, ys, intensities)
+        sampled = self._convolve_and_sample(self._convolve_and_sample(grid, 0), 1)
+        # The FFTs leave round-off around zero far from the emitters, the PSF is never negative
+        frame += np.maximum(sampled, 0)
+        return frame
@@ -0,0 +1,128 @@
+import json
+import os
+import numpy as np
+
+FRAME_STACK_DTYPE = np.float32
+METADATA_EXTENSION = '.json'
+# Frames are indexed [frame][x][y], see create_frame_stack
+AXES = 'TXY'
+# Metadata of the renderer kept next to the frames, for the analysis (localization needs the PSF)
+RENDERER_METADATA = ['number_of_frames', 'number_of_subframes_per_frame', 'pixel_length_in_um',
+                     'sigma_x_in_um', 'sigma_y_in_um', 'screen_size', 'blur_tolerance']
+
+
+def metadata_filename(filename):
+    return filename + METADATA_EXTENSION
+
+
+def create_frame_stack(filename, number_of_frames, frame_shape, metadata = None, dtype = FRAME_STACK_DTYPE):
+    """
+        A writable memory map of a (number_of_frames, X, Y) .npy stack, and its metadata
+        (a JSON dictionary) in filename + '.json'. Nothing is allocated in memory, pages are
+        written back to the file as they are filled.
+        The stack is [frame][x][y], not the (frames, Y, X) of image files : it is the layout
+        of every frame of the repository (FrameRenderer, the Go renderer, the cache and the
+        localizer), so the renderers write their slabs in place without a transposed copy.
+        stack.transpose(0, 2, 1) is a (frames, Y, X) view of it, nothing is copied.
+    """
+    if metadata is not None:
+        with open(metadata_filename(filename), 'w') as f:
+            # numpy scalars and arrays as plain numbers and lists
+            json.dump(metadata, f, indent = 4, default = lambda value : value.tolist())
+    elif os.path.exists(metadata_filename(filename)):
+        os.remove(metadata_filename(filename))
+    return np.lib.format.open_memmap(filename, mode = 'w+', dtype = dtype,
+                                     shape = (number_of_frames,) + tuple(frame_shape))
+
+
+def render_frame_stack(filename, renderer, batch_size,
+                       cached_frames = None,
+                       metadata = None,
+                       dtype = FRAME_STACK_DTYPE,
+                       progress = lambda x:x):
+    """
+        Renders all the frames of renderer into a memory mapped stack, batch_size frames at a time.
+        Every batch is rendered in place into its slab of the file (see FrameRenderer.render),
+        so neither the movie nor a batch is ever copied through memory, and movies larger
+        than the memory can be written. With cached_frames (e.g. from SimulationCache.load_frames)
+        the frames are copied from them instead of rendered.
+        The metadata of the renderer (RENDERER_METADATA) and metadata are saved with the stack.
+        Returns a FrameStack of the file.
+    """
+    all_metadata = {name : getattr(renderer, name) for name in RENDERER_METADATA}
+    all_metadata['axes'] = AXES
+    all_metadata.update(metadata or {})
+    stack = create_frame_stack(filename, renderer.number_of_frames, renderer.frame_shape, all_metadata, dtype)
+    for start in progress(range(0, renderer.number_of_frames, batch_size)):
+        stop = min(start + batch_size, renderer.number_of_frames)
+        if cached_frames is None:
+            renderer.render(range(start, stop), out = stack[start:stop])
+        else:
+            stack[start:stop] = cached_frames[start:stop]
+    stack.flush()
+    del stack
+    return FrameStack(filename)
+
+
+class FrameStack:
+    """
+        Lazy reader of a stack written by render_frame_stack (or any (frames, X, Y) .npy),
+        indexed [frame][x][y] (see create_frame_stack).
+        The file is memory mapped, indexing it (stack[i], stack[a:b], stack[i, x0:x1, y0:y1])
+        only reads the pages of the frames asked for, so stacks larger than the memory
+        can be analyzed frame by frame or batch by batch.
+        metadata is the dictionary saved with the stack (empty if there is none).
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.frames = np.load(filename, mmap_mode = 'r')
+        if self.frames.ndim != 3:
+            raise Exception("Expected a (frames, X, Y) stack, got shape {}".format(self.frames.shape))
+        self.metadata = {}
+        if os.path.exists(metadata_filename(filename)):
+            with open(metadata_filename(filename)) as f:
+                self.metadata = json.load(f)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, index):
+        return self.frames[index]
+
+    def __iter__(self):
+        return iter(self.frames)
+
+    @property
+    def shape(self):
+        return self.frames.shape
+
+    @property
+    def dtype(self):
+        return self.frames.dtype
+
+    @property
+    def frame_shape(self):
+        return self.frames.shape[1:]
+
+    @property
+    def number_of_frames(self):
+        return len(self.frames)
+
+    @property
+    def pixel_length_in_um(self):
+        return self.metadata.get('pixel_length_in_um')
+
+    def iter_batches(self, batch_size, frame_indices = None):
+        """
+            (frame_indices, frames) pairs of batch_size frames, as FrameRenderer.iter_batches,
+            so a stack can be written to a TIFF (see write_frames_streaming) or analyzed in batches
+        """
+        if frame_indices is None:
+            frame_indices = range(len(self))
+        frame_indices = list(frame_indices)
+        for start in range(0, len(frame_indices), batch_size):
+            batch = frame_indices[start:start + batch_size]
+            if batch == list(range(batch[0], batch[0] + len(batch))):
+                yield batch, self.frames[batch[0]:batch[-1] + 1]
+            else:
+                yield batch, self.frames[batch]
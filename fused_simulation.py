@@ -0,0 +1,303 @@
+import numpy as np
+from tqdm import tqdm_notebook as tqdm
+from simulation import Simulation
+from random_streams import SEED_KEY
+from trajectory_engine import move_molecules, move_molecules_coarse
+from trajectory_store import TrajectoryStore
+from renderer import FrameRenderer
+from parallel_rendering import ParallelFrameRenderer
+from tiff_export import write_frames_streaming, to_int16, DEFAULT_BATCH_SIZE, NO_COMPRESSION
+from cache import cached_render, cached_batches
+from trajectory_file import write_trajectory_file, TrajectoryFile
+from frame_stack import render_frame_stack
+from maximum_likelihood import summed_square_displacements, fit_two_species
+
+# What the species of one store have to agree on (TwoSpeciesSimulation only ever asked for the step time)
+SHARED_ATTRIBUTES = ['step_time_in_seconds', 'subframes_per_position']
+# What they have to agree on to be moved in one pass, otherwise they are moved one by one
+ENGINE_ATTRIBUTES = ['number_of_steps', 'screen_size_in_um', 'z_direction_depth_in_um']
+# What they have to agree on to be rendered in one movie
+RENDERING_ATTRIBUTES = ['number_of_frames', 'number_of_subframes_per_frame', 'pixel_length_in_um',
+                        'sigma_x_noise_in_um', 'sigma_y_noise_in_um', 'screen_size']
+
+
+def species_parameters(setup, species, index):
+    """
+        The parameters of the Simulation of one species : the setup and the species' own
+        fields (number_of_molecules, diffusion coefficient, intensity ...).
+        With a seed in the setup, every species gets its own streams from it.
+    """
+    parameters = dict(setup)
+    parameters.update(species)
+    if SEED_KEY in setup:
+        parameters[SEED_KEY] = [setup[SEED_KEY], index]
+    return parameters
+
+
+class _SpeciesStreams:
+    """
+        Maps the molecules of the fused store to the streams of their own species,
+        so every molecule moves exactly as in a simulation of its species alone
+    """
+    def __init__(self, simulations):
+        self.streams = [simulation.random_streams for simulation in simulations]
+        self.first_molecules = np.cumsum([0] + [len(simulation.trajectory_store) for simulation in simulations])
+
+    def molecule(self, index):
+        species = np.searchsorted(self.first_molecules, index, side = 'right') - 1
+        return self.streams[species].molecule(index - self.first_molecules[species])
+
+
+class FusedSimulation:
+    """
+        All the species of a movie in one engine : one TrajectoryStore with a species column
+        (molecules ordered by species), moved in one batched pass with the step size of every
+        molecule's species, and rendered in one pass.
+        Every species keeps its Simulation (simulations[i]) for its parameters, placement and streams,
+        and gets a view of its part of the store once the engine ran, so everything that works
+        on one species still does. Molecules draw from the streams of their species,
+        so the tracks are the same as when the species run one by one.
+        The species only have to agree on SHARED_ATTRIBUTES. Species that differ on ENGINE_ATTRIBUTES
+        (e.g. the slab depth) are moved one by one and then gathered, and RENDERING_ATTRIBUTES
+        are only checked when the species are rendered together.
+            setup   - the parameters shared by all the species
+            species - one dictionary per species (number_of_molecules, diffusion coefficient,
+                      intensity, ... the fields of molecule_default_values in gui.py)
+    """
+    def __init__(self, setup, species):
+        self._set_simulations([Simulation(species_parameters(setup, spec, index))
+                               for index, spec in enumerate(species)])
+
+    @classmethod
+    def from_simulations(cls, simulations):
+        fused = cls.__new__(cls)
+        fused._set_simulations(list(simulations))
+        return fused
+
+    def _differing_attribute(self, attributes):
+        """
+            The first of attributes on which the species differ, and their values (None if they all agree)
+        """
+        for attribute in attributes:
+            values = [np.asarray(getattr(simulation, attribute)).tolist() for simulation in self.simulations]
+            if any(value != values[0] for value in values):
+                return attribute, values
+        return None
+
+    def _check_shared(self, attributes, purpose):
+        differing = self._differing_attribute(attributes)
+        if differing is not None:
+            raise Exception("All the species need to have the same {} {}, got {}".format(differing[0], purpose,
+                                                                                          differing[1]))
+
+    def _set_simulations(self, simulations):
+        if not simulations:
+            raise Exception("Expected at least one species")
+        self.simulations = simulations
+        self._check_shared(SHARED_ATTRIBUTES, "to be fused")
+        self.simulation = simulations[0]
+        self.step_time_in_seconds = self.simulation.step_time_in_seconds
+        self.cache = self.simulation.cache
+        self.trajectories_key = None
+
+        stores = [simulation.trajectory_store for simulation in simulations]
+        self.species_molecules = np.cumsum([0] + [len(store) for store in stores])
+        self.trajectory_store = TrajectoryStore(np.concatenate([store.start_frames for store in stores]),
+                                                np.concatenate([store.positions[store.offsets[:-1]] for store in stores]),
+                                                self.simulation.screen_size_in_um,
+                                                self.simulation.z_direction_depth_in_um,
+                                                self.step_time_in_seconds,
+                                                species = np.repeat(np.arange(len(stores)), np.diff(self.species_molecules)),
+                                                diffusion_coefficients = [s.diffusion_coefficient for s in simulations],
+                                                intensities = [store.intensities[0] for store in stores])
+        self.did_run = all(simulation.did_run for simulation in simulations)
+        if self.did_run:
+            # The species come with their journeys (e.g. from a file), they are only gathered
+            self._gather()
+
+    def __len__(self):
+        return len(self.simulations)
+
+    def get_parameters(self):
+        return [simulation.get_parameters() for simulation in self.simulations]
+
+    def _gather(self):
+        stores = [simulation.trajectory_store for simulation in self.simulations]
+        first_rows = np.cumsum([0] + [len(store.positions) for store in stores])
+        offsets = np.concatenate([store.offsets[:-1] + first for store, first in zip(stores, first_rows)] +
+                                 [[first_rows[-1]]])
+        self.trajectory_store.set_buffers(np.concatenate([store.positions for store in stores]), offsets,
+                                          np.concatenate([store.end_subframes for store in stores]),
+                                          stores[0].subframes_per_position)
+
+    def _scatter(self):
+        for species, simulation in enumerate(self.simulations):
+            simulation.set_trajectory_store(self.trajectory_store.species_view(species))
+
+    def run(self, stop_when_out_of_frame = True, verbose = True):
+        if self.did_run:
+            return
+
+        if verbose:
+            _tqdm = tqdm
+        else:
+            _tqdm = lambda x:x
+
+        if self._differing_attribute(ENGINE_ATTRIBUTES) is not None:
+            # Every species in its own slab, screen or time : the same tracks, one species at a time
+            for simulation in self.simulations:
+                simulation.run(stop_when_out_of_frame, verbose)
+            self._gather()
+            self.did_run = True
+            return
+
+        store = self.trajectory_store
+        subframes_per_position = self.simulation.subframes_per_position
+        if self.cache is not None:
+            self.trajectories_key = self.cache.key('trajectories', self.get_parameters(), stop_when_out_of_frame)
+            arrays = self.cache.load_arrays(self.trajectories_key)
+            if arrays is not None:
+                store.set_buffers(arrays['positions'], arrays['offsets'], arrays['end_subframes'],
+                                  subframes_per_position)
+                self._scatter()
+                self.did_run = True
+                return
+
+        step_sizes = store.step_sizes[store.species]
+        streams = _SpeciesStreams(self.simulations)
+        if subframes_per_position == 1:
+            tracks = move_molecules(store.positions[store.offsets[:-1]],
+                                    step_sizes,
+                                    self.simulation.number_of_steps,
+                                    self.simulation.screen_size_in_um,
+                                    self.simulation.z_direction_depth_in_um,
+                                    stop_when_out_of_frame = stop_when_out_of_frame,
+                                    random_streams = streams,
+                                    progress = _tqdm)
+            store.set_tracks(tracks)
+        else:
+            tracks, end_subframes = move_molecules_coarse(store.positions[store.offsets[:-1]],
+                                                          store.start_frames,
+                                                          step_sizes,
+                                                          self.simulation.number_of_steps,
+                                                          self.simulation.screen_size_in_um,
+                                                          self.simulation.z_direction_depth_in_um,
+                                                          subframes_per_position,
+                                                          stop_when_out_of_frame = stop_when_out_of_frame,
+                                                          random_streams = streams,
+                                                          progress = _tqdm)
+            store.set_tracks(tracks, end_subframes, subframes_per_position)
+        if self.cache is not None:
+            self.cache.save_arrays(self.trajectories_key, positions = store.positions, offsets = store.offsets,
+                                   end_subframes = store.end_subframes)
+        self._scatter()
+        self.did_run = True
+
+    def save_trajectories(self, filename, setup = None, dtype = np.float32):
+        """
+            Writes the parameters and journeys of all the species to one binary file
+            (see trajectory_file.py), setup is kept in it as is
+        """
+        self.run()
+        write_trajectory_file(filename,
+                              [simulation.trajectory_store for simulation in self.simulations],
+                              self.get_parameters(),
+                              setup = setup,
+                              dtype = dtype)
+
+    @classmethod
+    def from_file(cls, filename, frames = None):
+        trajectory_file = TrajectoryFile(filename)
+        return cls.from_simulations([Simulation.from_file(filename, species, frames)
+                                     for species in range(trajectory_file.number_of_species)])
+
+    def get_renderer(self, number_of_workers = 1, batch_size = None):
+        self._check_shared(RENDERING_ATTRIBUTES, "to be rendered together")
+        simulation = self.simulation
+        args = [[self.trajectory_store],
+                simulation.number_of_frames,
+                simulation.number_of_subframes_per_frame,
+                simulation.pixel_length_in_um,
+                simulation.sigma_x_noise_in_um,
+                simulation.sigma_y_noise_in_um,
+                simulation.screen_size]
+        if number_of_workers == 1:
+            return FrameRenderer(*args, render_mode = simulation.render_mode, blur_tolerance = simulation.blur_tolerance)
+        return ParallelFrameRenderer(*args,
+                                     number_of_workers = number_of_workers,
+                                     batch_size = batch_size,
+                                     render_mode = simulation.render_mode,
+                                     blur_tolerance = simulation.blur_tolerance)
+
+    def frames_key(self, renderer):
+        """
+            Cache key of the frames of all the species, None if they are not cached
+        """
+        if self.cache is None or self.trajectories_key is None:
+            return None
+        return self.cache.key('frames', self.trajectories_key, renderer.parameters())
+
+    def create_frames(self, number_of_workers = 1):
+        self.run()
+        with self.get_renderer(number_of_workers) as renderer:
+            return cached_render(self.cache, self.frames_key(renderer), renderer)
+
+    def save_animation(self, filename, batch_size = DEFAULT_BATCH_SIZE, number_of_workers = 1,
+                       compression = NO_COMPRESSION, number_of_threads = None):
+        """
+            Renders and writes the frames batch by batch, without keeping the whole movie in memory.
+            The noise (or the camera) is the one of the first species.
+            Returns the statistics of the writer, as Simulation.save_animation.
+        """
+        self.run()
+        converter = np.int16(1)
+        with self.get_renderer(number_of_workers, batch_size) as renderer:
+            batches = cached_batches(self.cache, self.frames_key(renderer), renderer, batch_size)
+            if self.simulation.camera is not None:
+                return write_frames_streaming(filename, batches,
+                                              convert_batch = self.simulation.add_camera_noise,
+                                              compression = compression,
+                                              number_of_threads = number_of_threads,
+                                              **self.simulation.tiff_options())
+            return write_frames_streaming(filename,
+                                          batches,
+                                          lambda frame_index, frame : to_int16(self.simulation._add_noise_to_frame(frame, frame_index),
+                                                                               converter),
+                                          compression = compression,
+                                          number_of_threads = number_of_threads,
+                                          **self.simulation.tiff_options())
+
+    def save_frame_stack(self, filename, batch_size = DEFAULT_BATCH_SIZE, number_of_workers = 1):
+        """
+            All the species rendered into one memory mapped float32 stack, as Simulation.save_frame_stack
+        """
+        self.run()
+        with self.get_renderer(number_of_workers, batch_size) as renderer:
+            key = self.frames_key(renderer)
+            cached_frames = None if key is None else self.cache.load_frames(key)
+            return render_frame_stack(filename, renderer, batch_size,
+                                      cached_frames = cached_frames,
+                                      metadata = {'frame_time_in_seconds' : self.simulation.frame_time_in_seconds,
+                                                  'parameters' : self.get_parameters()})
+
+    def get_summed_square_displacements(self, journey_length = None, trajectory_store = None):
+        """
+            Per-track sums of square displacements and numbers of steps, of all the species
+            (or of the tracks of trajectory_store, e.g. linked from the movie, see linking.py).
+            With journey_length, only tracks that long are used, cut to journey_length - 1 steps.
+        """
+        if trajectory_store is None:
+            trajectory_store = self.trajectory_store
+        number_of_steps = None if journey_length is None else journey_length - 1
+        return list(summed_square_displacements(trajectory_store, number_of_steps))
+
+    def maximum_likelihood_diffusion_coefficients(self, journey_length = None, p0 = None, trajectory_store = None):
+        """
+            Fits D1, D2 and the fraction of species 1 by maximizing the two species likelihood
+            of the tracks directly (no histogram)
+        """
+        if trajectory_store is None:
+            trajectory_store = self.trajectory_store
+        sums, steps = self.get_summed_square_displacements(journey_length, trajectory_store)
+        estimate, _ = fit_two_species(sums, steps, trajectory_store.step_time_in_seconds, p0)
+        return estimate
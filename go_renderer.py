@@ -0,0 +1,115 @@
+import ctypes
+import os
+import sys
+import numpy as np
+from renderer import FrameRenderer
+
+# Built with : go build -buildmode=c-shared -o animation.go.so animation.go (in Animation/)
+LIBRARY_FILENAME = 'animation.go.dll' if sys.platform == 'win32' else 'animation.go.so'
+DEFAULT_LIBRARY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Animation', LIBRARY_FILENAME)
+
+_double_p = ctypes.POINTER(ctypes.c_double)
+_int64_p = ctypes.POINTER(ctypes.c_longlong)
+_float_p = ctypes.POINTER(ctypes.c_float)
+
+_libraries = {}
+
+
+def load_library(path = DEFAULT_LIBRARY_PATH):
+    if path not in _libraries:
+        lib = ctypes.cdll.LoadLibrary(path)
+        lib.renderFrames.argtypes = [_double_p, _int64_p, _int64_p, _double_p,
+                                     ctypes.c_longlong,
+                                     ctypes.c_longlong, ctypes.c_longlong, ctypes.c_longlong,
+                                     ctypes.c_double, ctypes.c_double, ctypes.c_double,
+                                     ctypes.c_longlong, ctypes.c_longlong,
+                                     _float_p]
+        lib.renderFrames.restype = None
+        _libraries[path] = lib
+    return _libraries[path]
+
+
+class GoFrameRenderer(FrameRenderer):
+    """
+        FrameRenderer that renders with renderFrames of Animation/animation.go.
+        The trajectory buffers and a float32 output stack are handed to Go as pointers,
+        so there are no temporary files and no JSON in either direction.
+        Go renders the frames of a call on all the cores.
+    """
+    def __init__(self, stores,
+                 number_of_frames,
+                 number_of_subframes_per_frame,
+                 pixel_length_in_um,
+                 sigma_x_in_um,
+                 sigma_y_in_um,
+                 screen_size,
+                 library_path = DEFAULT_LIBRARY_PATH):
+        FrameRenderer.__init__(self, stores,
+                               number_of_frames,
+                               number_of_subframes_per_frame,
+                               pixel_length_in_um,
+                               sigma_x_in_um,
+                               sigma_y_in_um,
+                               screen_size,
+                               dtype = np.float32)
+        if any(store.is_coarse for store in self.stores):
+            raise Exception("renderFrames needs a position for every subframe")
+        self.library = load_library(library_path)
+        # Go reads positions as doubles and offsets as int64, these are views when the store already is
+        self._buffers = [(np.ascontiguousarray(store.positions, dtype = np.float64),
+                          np.ascontiguousarray(store.offsets, dtype = np.int64),
+                          np.ascontiguousarray(store.start_frames, dtype = np.int64),
+                          np.ascontiguousarray(store.intensities[store.species], dtype = np.float64))
+                         for store in self.stores]
+
+    def _render_range(self, first_frame, out):
+        """
+            Adds frames [first_frame, first_frame + len(out)) to out, a C-contiguous float32 stack
+        """
+        for positions, offsets, start_frames, intensities in self._buffers:
+            self.library.renderFrames(positions.ctypes.data_as(_double_p),
+                                      offsets.ctypes.data_as(_int64_p),
+                                      start_frames.ctypes.data_as(_int64_p),
+                                      intensities.ctypes.data_as(_double_p),
+                                      len(start_frames),
+                                      first_frame, len(out),
+                                      self.number_of_subframes_per_frame,
+                                      self.pixel_length_in_um,
+                                      self.sigma_x_in_um,
+                                      self.sigma_y_in_um,
+                                      self.screen_size[0], self.screen_size[1],
+                                      out.ctypes.data_as(_float_p))
+        return out
+
+    def render_frame(self, frame_index, out = None):
+        frame = np.zeros((1,) + self.frame_shape, dtype = np.float32)
+        self._render_range(frame_index, frame)
+        if out is None:
+            return frame[0]
+        out[...] = frame[0]
+        return out
+
+    def render(self, frame_indices = None, progress = lambda x:x, out = None):
+        """
+            Renders the frames into a (number_of_frames, X, Y) float32 array (or into out),
+            one Go call for every run of consecutive frame indices.
+            A C-contiguous float32 out (e.g. a slab of a FrameStack) is written by Go directly.
+        """
+        if frame_indices is None:
+            frame_indices = range(self.number_of_frames)
+        frame_indices = np.asarray(list(frame_indices), dtype = np.int64)
+        if out is None:
+            frames = np.zeros((len(frame_indices),) + self.frame_shape, dtype = np.float32)
+        else:
+            frames = self._output_frames(out, len(frame_indices))
+            frames[...] = 0
+        target = frames
+        if frames.dtype != np.float32 or not frames.flags.c_contiguous:
+            target = np.zeros(frames.shape, dtype = np.float32)
+        runs = np.split(np.arange(len(frame_indices)), np.flatnonzero(np.diff(frame_indices) != 1) + 1)
+        for run in progress(runs):
+            if len(run):
+                self._render_range(int(frame_indices[run[0]]), target[run[0]:run[-1] + 1])
+        if target is not frames:
+            frames[...] = target
+        return frames
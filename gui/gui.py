@@ -9,6 +9,9 @@ from PyQt5.QtCore import Qt, pyqtSlot, QAbstractTableModel
 from PyQt5 import QtCore
 from simulation import Simulation, NUMBER_OF_FRAMES_KEY, MOLECULES_KEY
 from multispecies_simulation import MultiSpeciesSimulation
+from fused_simulation import species_parameters
+from random_streams import RandomStreams, SEED_KEY
+from trajectory_file import TRAJECTORY_FILE_EXTENSION
 
 MOLECULES_DICTIONARY_KEY = 'molecules'
 
@@ -189,6 +192,8 @@ class Example(QWidget):
         setup_dictionary = self.create_setup_dictionary()
         if setup_dictionary is None:
             return
+        # Saved with the setup, so the movie can be reproduced
+        setup_dictionary[SEED_KEY] = RandomStreams().seed
 
 
         options = QFileDialog.Options()
@@ -204,25 +209,19 @@ class Example(QWidget):
 
         def worker():
             self.set_status_label("Running Simulations")
-            simulations = []
-            for index, molecule_dict in enumerate(molecules_dictionaries):
-                simulation_dictionary = dict(setup_dictionary)
-                simulation_dictionary.update(molecule_dict)
-                simulation = Simulation(simulation_dictionary)
-                simulation.run()
-                simulations.append(simulation)
-                self.progress_bar.setValue(index)
-
+            # Every species gets its own streams, all of them move in one pass
+            simulations = [Simulation(species_parameters(setup_dictionary, molecule_dict, index))
+                           for index, molecule_dict in enumerate(molecules_dictionaries)]
             multispecies_simulation = MultiSpeciesSimulation(*simulations)
+            multispecies_simulation.run()
+            self.progress_bar.setValue(len(simulations) - 1)
 
             self.progress_bar.setValue(self.progress_bar.value() + 1)
-            self.set_status_label("Creating Frames")
-            multispecies_simulation.create_frames()
+            self.set_status_label("Creating Frames and saving to file")
+            multispecies_simulation.save_animation(filename)
 
             self.progress_bar.setValue(self.progress_bar.value() + 1)
-            self.set_status_label("Saving to file")
-            multispecies_simulation.save_frames_to_file(filename)
-            self.save_setup(setup_dictionary, molecules_dictionaries, simulations, filename)
+            self.save_setup(setup_dictionary, molecules_dictionaries, multispecies_simulation, filename)
 
             # self.progress_bar.setValue(self.progress_bar.value() + 1)
             self.finish_progress_bar()
@@ -272,18 +271,16 @@ class Example(QWidget):
                 
         return setup_dictionary
 
-    def create_simulation_dictionary(self, setup_dictionary, molecules_dictionaries, simulations):
+    def create_simulation_dictionary(self, setup_dictionary, molecules_dictionaries):
         d = dict(setup_dictionary)
-        molecules_dictionaries = list([dict(d) for d in molecules_dictionaries])
-        for molecule_dict, simulation in zip(molecules_dictionaries, simulations):
-            molecule_dict[MOLECULES_KEY] = simulation.to_dict()[MOLECULES_KEY]
-        d[MOLECULES_DICTIONARY_KEY] = molecules_dictionaries
+        d[MOLECULES_DICTIONARY_KEY] = list([dict(d) for d in molecules_dictionaries])
         return d
 
-    def save_setup(self, setup_dictionary, molecules_dictionaries, simulations, filename):
-        with open(filename + ".json", "w") as f:
-            f.write(json.dumps(self.create_simulation_dictionary(setup_dictionary, molecules_dictionaries, simulations)))
-
+    def save_setup(self, setup_dictionary, molecules_dictionaries, multispecies_simulation, filename):
+        # The journeys go to a binary file, a JSON of every position would take gigabytes
+        multispecies_simulation.save_trajectories(filename + TRAJECTORY_FILE_EXTENSION,
+                                                  setup = self.create_simulation_dictionary(setup_dictionary,
+                                                                                            molecules_dictionaries))
 
 
 if __name__ == '__main__':
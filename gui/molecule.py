@@ -1,47 +1,75 @@
 import numpy as np
 from matplotlib import pyplot as plt
+import shared_modules
+from msd import mean_square_displacement
 
 POSITIONS_KEY = 'positions'
 START_FRAME_KEY = 'start_frame'
 INTENSITY_KEY = 'intensity'
 
 class Molecule:
-    def __init__(self, screen_size, 
-                 pixel_length_in_um,
-                 screen_depth_in_um,
-                 diffusion_coefficient,
-                 step_time_in_seconds,
-                 number_of_frames,
-                 intensity):
-        
-        #Save variables
-        self.intensity = intensity
-        self.screen_size = screen_size
-        self.pixel_length_in_um = pixel_length_in_um
-        self.screen_depth_in_um = screen_depth_in_um
-        self.diffusion_coefficient = diffusion_coefficient
-        self.step_time_in_seconds = step_time_in_seconds
-        self.number_of_frames = number_of_frames
-
-        self.step_size = np.sqrt(2 * self.diffusion_coefficient * self.step_time_in_seconds)
-        self.screen_size_in_um = np.array([self.screen_size[0]*pixel_length_in_um, 
-                                           self.screen_size[1]*pixel_length_in_um])
-
-        self.start_frame = np.random.randint(0, self.number_of_frames)
-        self.frame_count = self.start_frame
-        
-        #Randomize X,Y,Z
-        self.x, self.y = np.random.uniform([0,0], 
-                         self.screen_size_in_um)
-        self.z = np.random.uniform(0, self.screen_depth_in_um)
-        
-        self.positions = [self.get_position()]
+    """
+        A thin view of one molecule in a TrajectoryStore.
+        All the data lives in the store, the molecule only knows its index.
+    """
+    __slots__ = ('store', 'index')
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    @property
+    def start_frame(self):
+        return int(self.store.start_frames[self.index])
+
+    @property
+    def positions(self):
+        return self.store.get_positions(self.index)
+
+    @property
+    def species(self):
+        return int(self.store.species[self.index])
+
+    @property
+    def diffusion_coefficient(self):
+        return float(self.store.diffusion_coefficients[self.species])
+
+    @property
+    def intensity(self):
+        return float(self.store.intensities[self.species])
+
+    @property
+    def step_time_in_seconds(self):
+        return self.store.step_time_in_seconds
+
+    @property
+    def step_size(self):
+        return self.store.step_sizes[self.species]
+
+    @property
+    def screen_size_in_um(self):
+        return self.store.screen_size_in_um
+
+    @property
+    def screen_depth_in_um(self):
+        return self.store.screen_depth_in_um
 
+    @property
+    def x(self):
+        return self.positions[-1, 0]
+
+    @property
+    def y(self):
+        return self.positions[-1, 1]
+
+    @property
+    def z(self):
+        return self.positions[-1, 2]
 
     def to_dict(self):
         d = {
             START_FRAME_KEY : self.start_frame,
-            POSITIONS_KEY  : list(map(list,self.get_positions().T)),
+            POSITIONS_KEY  : self.positions.tolist(),
             INTENSITY_KEY : self.intensity,
         }
         return d
@@ -82,17 +110,13 @@ class Molecule:
         return normalization_factor * np.sum(self._square_displacement_vector(n))
 
     def get_position(self):
-        return np.array([self.x, self.y, self.z])
+        return np.array(self.positions[-1])
 
     def get_position_in_frame(self, frame_number):
-
-        if frame_number - self.start_frame < 0 :
+        position = self.store.get_position_in_frame(self.index, frame_number)
+        if position is None:
             return None
-
-        if len(self.positions)  <= frame_number - self.start_frame :
-            return None
-
-        return np.array(self.positions[frame_number - self.start_frame])
+        return np.array(position)
 
     def get_distance_of_journey(self, length = None):
         if length == None:
@@ -104,11 +128,11 @@ class Molecule:
     def get_positions(self, limit_to_frame = False):
         if limit_to_frame:
             _filter = self._is_in_frame_filter()
-            return (np.array(self.positions)[_filter]).T
-        return np.array(self.positions).T
+            return self.positions[_filter].T
+        return self.positions.T
 
     def get_length_of_journey(self):
-        return len(self.positions)
+        return int(self.store.offsets[self.index + 1] - self.store.offsets[self.index])
 
     def get_mean_square_displacement(self, return_time_vector = True):
         """
@@ -116,28 +140,12 @@ class Molecule:
             Returns a time series and a MSD series, for easy plotting
         """
         N = np.arange(1, self._max_n_for_mean_square_displacement())
+        msd = mean_square_displacement(self.positions, len(N))
 
         if return_time_vector:
-            return [self.step_time_in_seconds * N,
-                   [self._mean_square_displacement_for_n(n)  for 
-                            n in N]]
+            return [self.step_time_in_seconds * N, msd]
         else :
-            return [self._mean_square_displacement_for_n(n)  for 
-                            n in N]
-
-
-    def move(self, number_of_steps = 1, stop_when_out_of_frame = False):
-        
-        for _ in range(number_of_steps):
-
-            # For movement in 3D
-            # self.x, self.y, self.z = self.get_position() + np.random.normal(0, self.diffusion_coefficient,[3])
-
-            self.x, self.y, self.z = self.get_position() + np.random.normal(0, self.step_size,[3])
-            if stop_when_out_of_frame and not self._is_in_frame():
-                self.x, self.y, self.z = self.positions[-1]
-                return 
-            self.positions.append(self.get_position())
+            return msd
 
 
     def plot(self, limit_to_frame = True):
@@ -148,4 +156,4 @@ class Molecule:
         x, y = self.get_mean_square_displacement()
         return plt.plot(x, y, *args)
 
-        
\ No newline at end of file
+        
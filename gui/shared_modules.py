@@ -0,0 +1,11 @@
+"""
+    Puts the root of the repository on the path : the engine, the renderers, the exporters
+    and the analysis modules are the ones of the notebooks, not copies.
+    The root goes last, so simulation, multispecies_simulation and molecule are still the gui's own.
+"""
+import os
+import sys
+
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIRECTORY not in sys.path:
+    sys.path.append(ROOT_DIRECTORY)
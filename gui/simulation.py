@@ -16,10 +16,21 @@ PSF_SIGMA_IN_UM_X_AXIS  = 'psf_sigma_in_um_x_axis'
 PSF_SIGMA_IN_UM_Y_AXIS  = 'psf_sigma_in_um_y_axis'
 BACKGROUND_NOISE_AMPLITUDE_KEY = 'background_noise_amplitude'
 INTENSITY_KEY = 'intensity'
+# Optional, > 1 keeps one position every that many subframes (see move_molecules_coarse)
+SUBFRAMES_PER_POSITION_KEY = 'subframes_per_position'
+# Optional, merges the subframe positions of slow molecules within this tolerance (see motion_blur.py)
+BLUR_TOLERANCE_KEY = 'blur_tolerance'
+# Optional, one of density_rendering.RENDER_MODES, the FFT modes are approximate (see renderer.py)
+RENDER_MODE_KEY = 'render_mode'
+# Optional, replaces number_of_molecules with a steady state population (see steady_state.py)
+MEAN_NUMBER_OF_EMITTERS_KEY = 'mean_number_of_emitters'
+# Optional, the keyword arguments of a CameraModel, replaces the background noise when writing frames
+CAMERA_KEY = 'camera'
 SECONDS_IN_MS = 1e-3
 
 MOLECULES_KEY = 'molecules'
 
+import shared_modules
 from molecule import *
 from scipy.special import erf
 from numpy import sqrt
@@ -32,24 +43,26 @@ from matplotlib.animation import FuncAnimation, ArtistAnimation
 import tifffile
 import json
 import os
-
-def frame_filename(idx):
-    return "{}.json".format(idx)
-
-def maximum_value(index_range):
-    filenames = [frame_filename(idx) for idx in index_range]
-    maximum = 0 
-    for filename in filenames:
-        with open(filename) as f:
-            maximum = np.max([np.max(json.loads(f.read())), maximum])
-    return maximum
+from trajectory_engine import move_molecules, move_molecules_coarse
+from random_streams import RandomStreams, random_placement, SEED_KEY
+from steady_state import steady_state_placement, steady_state_report
+from trajectory_store import TrajectoryStore
+from renderer import FrameRenderer
+from density_rendering import WINDOW_RENDER_MODE
+from parallel_rendering import ParallelFrameRenderer
+from tiff_export import write_frames_streaming, to_int16, DEFAULT_BATCH_SIZE, NO_COMPRESSION
+from msd import mean_square_displacements, ensemble_mean_square_displacement
+from cache import get_default_cache, cached_render, cached_batches
+from trajectory_file import write_trajectory_file, TrajectoryFile
+from camera import CameraModel
+from frame_stack import render_frame_stack
 
 class Simulation:
     def __init__(self, parameters):
         self.parameters =  parameters
         self.intensity = parameters[INTENSITY_KEY]
         self.pixel_length_in_um = parameters[PIXEL_LENGTH_IN_UM_KEY]
-        self.number_of_molecules = parameters[NUMBER_OF_MOLECULES_KEY]
+        self.mean_number_of_emitters = parameters.get(MEAN_NUMBER_OF_EMITTERS_KEY)
         self.screen_size = [parameters[SCREEN_SIZE_IN_PIXELS_X_KEY],
                             parameters[SCREEN_SIZE_IN_PIXELS_Y_KEY]]
         self.z_direction_depth_in_um = parameters[Z_DIRECTION_DEPTH_IN_UM_KEY]
@@ -61,23 +74,54 @@ class Simulation:
         self.sigma_y_noise_in_um = parameters[PSF_SIGMA_IN_UM_Y_AXIS]
         self.number_of_subframes_per_frame = parameters[NUMBER_OF_SUBFRAMES_PER_FRAME_KEY]
         self.background_noise_amplitude = parameters[BACKGROUND_NOISE_AMPLITUDE_KEY]
+        self.subframes_per_position = parameters.get(SUBFRAMES_PER_POSITION_KEY, 1)
+        if self.number_of_subframes_per_frame % self.subframes_per_position != 0:
+            raise Exception("{} ({}) has to divide {} ({})".format(SUBFRAMES_PER_POSITION_KEY, self.subframes_per_position,
+                                                                  NUMBER_OF_SUBFRAMES_PER_FRAME_KEY, self.number_of_subframes_per_frame))
+        self.blur_tolerance = parameters.get(BLUR_TOLERANCE_KEY)
+        self.render_mode = parameters.get(RENDER_MODE_KEY, WINDOW_RENDER_MODE)
+        self.camera = CameraModel(**parameters[CAMERA_KEY]) if CAMERA_KEY in parameters else None
         
         self.number_of_steps = self.number_of_frames * self.number_of_subframes_per_frame
         self.step_time_in_seconds = self.total_time_in_seconds / self.number_of_steps 
         self.frame_time_in_seconds = self.total_time_in_seconds / self.number_of_frames
 
         self.step_size = np.sqrt(2 * self.diffusion_coefficient * self.step_time_in_seconds)
+        self.screen_size_in_um = np.array(self.screen_size) * self.pixel_length_in_um
 
         
-        self.molecules = [Molecule(self.screen_size, 
-                                   self.pixel_length_in_um,
-                                   self.z_direction_depth_in_um,
-                                   self.diffusion_coefficient,
-                                   self.step_time_in_seconds,
-                                   self.number_of_steps,
-                                   self.intensity) 
-                          for _ in range(self.number_of_molecules)]
+        self.random_streams = RandomStreams(parameters.get(SEED_KEY))
+        self.seed = self.random_streams.seed
+
+        if self.mean_number_of_emitters is None:
+            self.number_of_molecules = parameters[NUMBER_OF_MOLECULES_KEY]
+            start_frames, initial_positions = random_placement(self.random_streams, 0,
+                                                               self.number_of_molecules,
+                                                               self.number_of_steps,
+                                                               self.screen_size_in_um,
+                                                               self.z_direction_depth_in_um)
+        else:
+            start_frames, initial_positions = steady_state_placement(self.random_streams,
+                                                                     self.mean_number_of_emitters,
+                                                                     self.number_of_steps,
+                                                                     self.step_size,
+                                                                     self.screen_size_in_um,
+                                                                     self.z_direction_depth_in_um)
+            self.number_of_molecules = len(start_frames)
+        self.trajectory_store = TrajectoryStore(start_frames,
+                                                initial_positions,
+                                                self.screen_size_in_um,
+                                                self.z_direction_depth_in_um,
+                                                self.step_time_in_seconds,
+                                                diffusion_coefficients = [self.diffusion_coefficient],
+                                                intensities = [self.intensity])
+        self.molecules = [Molecule(self.trajectory_store, index)
+                          for index in range(self.number_of_molecules)]
         self.did_run = False
+
+        # Without a seed in the parameters nothing could ever be reused
+        self.cache = get_default_cache() if SEED_KEY in parameters else None
+        self.trajectories_key = None
     def to_dict(self):
         d = {
             PIXEL_LENGTH_IN_UM_KEY : self.pixel_length_in_um,
@@ -88,6 +132,7 @@ class Simulation:
             SCREEN_SIZE_IN_PIXELS_Y_KEY : self.screen_size[1],
             PSF_SIGMA_IN_UM_X_AXIS : self.sigma_x_noise_in_um,
             PSF_SIGMA_IN_UM_Y_AXIS : self.sigma_y_noise_in_um,
+            SEED_KEY : self.seed,
             MOLECULES_KEY : [m.to_dict() for m in self.molecules]
         }
         return d
@@ -99,13 +144,50 @@ class Simulation:
         with open(filename,"w") as f:
             f.write(self.to_json())
 
+    def get_parameters(self):
+        """
+            The parameters the simulation was created with, with the seed that was used
+        """
+        parameters = dict(self.parameters)
+        parameters[SEED_KEY] = self.seed
+        return parameters
+
+    def save_trajectories(self, filename, dtype = np.float32):
+        """
+            Writes the parameters and the journeys to a binary file (see trajectory_file.py),
+            much smaller and faster than write_to_file. Load it back with Simulation.from_file.
+        """
+        self.run()
+        write_trajectory_file(filename, [self.trajectory_store], [self.get_parameters()], dtype = dtype)
+
+    @classmethod
+    def from_file(cls, filename, species = 0, frames = None):
+        """
+            Loads a simulation saved by save_trajectories (or one species of a multi-species file).
+            The positions stay memory mapped, so only what is used is read from disk.
+            With frames = (first, last), only the positions in those frames are read.
+        """
+        trajectory_file = TrajectoryFile(filename)
+        simulation = cls(trajectory_file.parameters[species])
+        steps = None
+        if frames is not None:
+            steps = [frame * simulation.number_of_subframes_per_frame for frame in frames]
+        simulation.set_trajectory_store(trajectory_file.read_store(species, steps))
+        return simulation
+
+    def set_trajectory_store(self, store):
+        """
+            Uses journeys computed elsewhere instead of running the simulation
+        """
+        if len(store) != self.number_of_molecules:
+            raise Exception("Expected {} molecules, got {}".format(self.number_of_molecules, len(store)))
+        self.trajectory_store = store
+        self.molecules = [Molecule(store, index) for index in range(len(store))]
+        self.did_run = True
+
     def _get_positions_in_frame(self,n):
-        positions = []
-        for m in self.molecules:
-            pos = m.get_position_in_frame(n)
-            if pos is not None:
-                positions.append(pos)
-        return positions
+        index = self.trajectory_store.get_subframe_index(self.number_of_steps)
+        return self.trajectory_store.positions[index.rows_in_subframes(n, n + 1)]
 
     def _create_frame(self, n, verbose = False):
         x_axis= np.arange(self.screen_size[0]) * self.pixel_length_in_um
@@ -139,83 +221,151 @@ class Simulation:
     def plot_frame(self, n, verbose = True):
         return plt.imshow(self._create_frame(n, verbose = verbose), cmap = 'Greys_r')
 
-    def _add_noise_to_frame(self, frame):
+    def _add_noise_to_frame(self, frame, frame_index):
         frame = np.array(frame)
-        return frame + np.random.exponential(self.background_noise_amplitude, self.screen_size)
-                    # np.abs(np.random.normal(0, self.background_noise_sigma * np.sqrt(self.number_of_subframes_per_frame), self.screen_size))
-
-    def save_animation(self, filename, verbose = False):
+        generator = self.random_streams.noise(frame_index)
+        return frame + generator.exponential(self.background_noise_amplitude, self.screen_size)
+                    # np.abs(generator.normal(0, self.background_noise_sigma * np.sqrt(self.number_of_subframes_per_frame), self.screen_size))
+
+    def add_camera_noise(self, frame_indices, frames):
+        """
+            The camera counts of a block of rendered frames (see CameraModel.apply)
+        """
+        return self.camera.apply(frames, frame_indices, self.random_streams)
+
+    def get_renderer(self, number_of_workers = 1, batch_size = None):
+        """
+            A FrameRenderer, or a ParallelFrameRenderer when more than one worker is requested
+            (number_of_workers = None uses all the cores)
+        """
+        args = [[self.trajectory_store],
+                self.number_of_frames,
+                self.number_of_subframes_per_frame,
+                self.pixel_length_in_um,
+                self.sigma_x_noise_in_um,
+                self.sigma_y_noise_in_um,
+                self.screen_size]
+        if number_of_workers == 1:
+            return FrameRenderer(*args, render_mode = self.render_mode, blur_tolerance = self.blur_tolerance)
+        return ParallelFrameRenderer(*args,
+                                     number_of_workers = number_of_workers,
+                                     batch_size = batch_size,
+                                     render_mode = self.render_mode,
+                                     blur_tolerance = self.blur_tolerance)
+
+    def create_frames(self, verbose = False, number_of_workers = 1):
+        """
+            Renders all the frames (without noise) into a (number_of_frames, X, Y) array
+        """
+        self.run()
+        if verbose:
+            _tqdm = tqdm
+        else :
+            _tqdm = lambda x:x
+        with self.get_renderer(number_of_workers) as renderer:
+            return cached_render(self.cache, self.frames_key(renderer), renderer, progress = _tqdm)
+
+    def frames_key(self, renderer):
+        """
+            Cache key of the frames rendered by renderer, None if they are not cached
+        """
+        if self.cache is None or self.trajectories_key is None:
+            return None
+        return self.cache.key('frames', self.trajectories_key, renderer.parameters())
+
+    def save_animation(self, filename, verbose = False,
+                       batch_size = DEFAULT_BATCH_SIZE,
+                       max_norm = None,
+                       number_of_workers = 1,
+                       compression = NO_COMPRESSION,
+                       number_of_threads = None):
+        """
+            Renders the frames in batches and writes them to the TIFF while the next
+            batch is rendered, so the memory used does not depend on the number of frames.
+            Unless max_norm is given, the frames are normalized by the analytic bound
+            on a pixel value, so no pass over all the frames is needed.
+            With a camera in the parameters, the frames are camera counts (uint16) instead.
+            compression is one of tiff_export.COMPRESSIONS, done on number_of_threads threads.
+            Returns the statistics of the writer (see tiff_export.write_frames).
+        """
         self.run()
         if verbose:
             _tqdm = tqdm
         else :
             _tqdm = lambda x:x
 
-        from ctypes import c_char_p, c_int, cdll
-        # lib = cdll.LoadLibrary("./Animation/animation.go.so")
-        lib = cdll.LoadLibrary("./Animation/animation.go.dll")
-        lib.createAnimation.argtypes = [c_char_p]
-
-
-        temp_file ="_temp_animation_file.json" 
-        with open(temp_file ,"w") as f:
-            f.write(self.to_json())
-        lib.createAnimation(temp_file.encode())
-        os.remove(temp_file)
-
-        max_norm = maximum_value(range(self.number_of_frames))
-        MAX_INT16 = np.int16((2**15-1))
-        converter = np.int16(MAX_INT16 / max_norm)
-        constant = np.int16(0)
-
-        with tifffile.TiffWriter(filename, imagej = True) as stack:
-            for idx in _tqdm(range(self.number_of_frames)):
-                image_filename = "{}.json".format(idx)
-                with open(image_filename) as f:
-                    frame = json.loads(f.read())
-                os.remove(image_filename)
-                stack.save(np.array(constant + self._add_noise_to_frame(frame) * converter,
-                                 dtype = np.int16))
+        with self.get_renderer(number_of_workers, batch_size) as renderer:
+            batches = cached_batches(self.cache, self.frames_key(renderer), renderer, batch_size)
+            if self.camera is not None:
+                statistics = write_frames_streaming(filename, batches,
+                                                    convert_batch = self.add_camera_noise,
+                                                    progress = _tqdm,
+                                                    compression = compression,
+                                                    number_of_threads = number_of_threads,
+                                                    **self.tiff_options())
+            else:
+                if max_norm is None:
+                    max_norm = renderer.maximum_value_bound()
+                MAX_INT16 = np.int16((2**15-1))
+                converter = MAX_INT16 / max_norm
+
+                statistics = write_frames_streaming(filename,
+                                                    batches,
+                                                    lambda frame_index, frame : to_int16(self._add_noise_to_frame(frame, frame_index),
+                                                                                         converter),
+                                                    progress = _tqdm,
+                                                    compression = compression,
+                                                    number_of_threads = number_of_threads,
+                                                    **self.tiff_options())
+        if verbose:
+            print("Wrote {number_of_frames} frames in {seconds:.2f}s : {frames_per_second:.1f} frames/s, "
+                  "{megabytes_per_second:.1f} MB/s, compression ratio {compression_ratio:.2f}".format(**statistics))
+        return statistics
+
+    def tiff_options(self):
+        """
+            The ImageJ metadata of the movie, and its number of frames for write_frames_streaming
+        """
+        return {'number_of_frames' : self.number_of_frames,
+                'frame_interval_in_seconds' : self.frame_time_in_seconds,
+                'pixel_length_in_um' : self.pixel_length_in_um}
+
+    def save_frame_stack(self, filename, verbose = False,
+                         batch_size = DEFAULT_BATCH_SIZE,
+                         number_of_workers = 1):
+        """
+            Renders the frames (without noise, not quantized) straight into a memory mapped float32
+            (number_of_frames, X, Y) .npy stack, with the parameters in filename + '.json'.
+            Returns a FrameStack that reads it lazily (see frame_stack.py).
+        """
+        self.run()
+        if verbose:
+            _tqdm = tqdm
+        else :
+            _tqdm = lambda x:x
+        with self.get_renderer(number_of_workers, batch_size) as renderer:
+            key = self.frames_key(renderer)
+            cached_frames = None if key is None else self.cache.load_frames(key)
+            return render_frame_stack(filename, renderer, batch_size,
+                                      cached_frames = cached_frames,
+                                      metadata = {'frame_time_in_seconds' : self.frame_time_in_seconds,
+                                                  'parameters' : self.get_parameters()},
+                                      progress = _tqdm)
 
 
     def get_animation(self):
-        self.run()
-        from ctypes import c_char_p, c_int, cdll
-        # lib = cdll.LoadLibrary("./Animation/animation.go.so")
-        lib = cdll.LoadLibrary("./Animation/animation.go.dll")
-        lib.createAnimation.argtypes = [c_char_p]
-
-        temp_file ="_temp_animation_file.json" 
-        with open(temp_file ,"w") as f:
-            f.write(self.to_json())
-        lib.createAnimation(temp_file.encode())
-        os.remove(temp_file)
+        frames = self.create_frames()
 
         fig = plt.figure()
 
         max_norm = np.mean([self.sigma_y_noise_in_um, self.sigma_x_noise_in_um])/self.step_size 
         norm =  plt.Normalize(0, max_norm * np.sqrt(self.number_of_subframes_per_frame))
 
-        # with tifffile.TiffWriter(filename) as stack:
-        #     for idx in tqdm(range(1, self.number_of_frames)):
-        #         with open("/tmp/{}.json".format(idx)) as f:
-        #             frame = json.loads(f.read())
-        #         # im = plt.imshow(frame, animated = True, 
-        #         #                 cmap = 'Greys_r', norm = norm)
-        #         stack.save(np.array(frame, dtype = np.float64))
-
-
-        with open("0.json") as f:
-            frame = json.loads(f.read())
-        im = plt.imshow(frame, animated = True, 
+        im = plt.imshow(frames[0], animated = True, 
                 cmap = 'Greys_r', norm = norm)
 
         def updatefig(idx):
-            frame_filename = frame_filename(idx)
-            with open(frame_filename) as f:
-                frame = json.loads(f.read())
-            os.remove(image_filename)
-            im.set_array(self._add_noise_to_frame(frame))
+            im.set_array(self._add_noise_to_frame(frames[idx], idx))
             return im,
 
         ani = FuncAnimation(fig, updatefig,
@@ -230,10 +380,10 @@ class Simulation:
         return display.HTML(self.get_animation().to_html5_video())
     
 
-    def _get_diffusion_coefficient_slopes(self):
-        vectors = [m._square_displacement_vector(1) for m in self.molecules
-                                if m.get_length_of_journey() > 1]
-        slopes = np.concatenate(vectors)
+    def _get_diffusion_coefficient_slopes(self, trajectory_store = None):
+        if trajectory_store is None:
+            trajectory_store = self.trajectory_store
+        slopes, _ = trajectory_store.square_displacements(1)
         return slopes 
 
     def run(self, stop_when_out_of_frame = True, verbose = True):
@@ -245,26 +395,95 @@ class Simulation:
         else:
             _tqdm = lambda x:x
             
-        for molecule in _tqdm(self.molecules):
-            molecule.move(self.number_of_steps, 
-                          stop_when_out_of_frame = stop_when_out_of_frame)
+        store = self.trajectory_store
+        if self.cache is not None:
+            self.trajectories_key = self.cache.key('trajectories', self.get_parameters(), stop_when_out_of_frame)
+            arrays = self.cache.load_arrays(self.trajectories_key)
+            if arrays is not None:
+                store.set_buffers(arrays['positions'], arrays['offsets'], arrays['end_subframes'],
+                                  self.subframes_per_position)
+                self.did_run = True
+                return
+
+        if self.subframes_per_position == 1:
+            tracks = move_molecules(store.positions[store.offsets[:-1]],
+                                    self.step_size,
+                                    self.number_of_steps,
+                                    self.screen_size_in_um,
+                                    self.z_direction_depth_in_um,
+                                    stop_when_out_of_frame = stop_when_out_of_frame,
+                                    random_streams = self.random_streams,
+                                    progress = _tqdm)
+            store.set_tracks(tracks)
+        else:
+            tracks, end_subframes = move_molecules_coarse(store.positions[store.offsets[:-1]],
+                                                          store.start_frames,
+                                                          self.step_size,
+                                                          self.number_of_steps,
+                                                          self.screen_size_in_um,
+                                                          self.z_direction_depth_in_um,
+                                                          self.subframes_per_position,
+                                                          stop_when_out_of_frame = stop_when_out_of_frame,
+                                                          random_streams = self.random_streams,
+                                                          progress = _tqdm)
+            store.set_tracks(tracks, end_subframes, self.subframes_per_position)
+        if self.cache is not None:
+            self.cache.save_arrays(self.trajectories_key, positions = store.positions, offsets = store.offsets,
+                                   end_subframes = store.end_subframes)
         self.did_run = True
 
     def get_journies_by_length(self, length = 2):
-        return [m for m in self.molecules if m.get_length_of_journey() >= length]
+        indices = np.flatnonzero(self.trajectory_store.lengths >= length)
+        return [self.molecules[index] for index in indices]
 
     def get_length_of_journies(self):
-        return [m.get_length_of_journey() for m in self.molecules]
-
-    def approximate_diffusion_ceofficient(self, number_of_dimensions_of_diffusion = 2, verbose = True):
-        slopes = self._get_diffusion_coefficient_slopes()
-        approximation = np.mean(slopes) / number_of_dimensions_of_diffusion / self.step_time_in_seconds /2
+        return self.trajectory_store.lengths.tolist()
+
+    def approximate_diffusion_ceofficient(self, number_of_dimensions_of_diffusion = 2, verbose = True,
+                                          trajectory_store = None):
+        """
+            Mean square step estimate of D, from the simulated journeys or from trajectory_store
+            (e.g. tracks linked from the movie, see linking.py), against the simulated value
+        """
+        if trajectory_store is None:
+            trajectory_store = self.trajectory_store
+        slopes = self._get_diffusion_coefficient_slopes(trajectory_store)
+        approximation = np.mean(slopes) / number_of_dimensions_of_diffusion / trajectory_store.step_time_in_seconds /2
         print("Approximation : {}\nValue : {}\nRatio : {}".format(approximation, self.diffusion_coefficient, approximation/self.diffusion_coefficient))
         return approximation
 
+    def get_steady_state_report(self, verbose = True):
+        """
+            Achieved mean number of emitters in the frame and the track lengths (see steady_state_report)
+        """
+        self.run(verbose = verbose)
+        report = steady_state_report(self.trajectory_store, self.number_of_steps, self.mean_number_of_emitters)
+        if verbose:
+            print("Mean number of emitters : {}\nTarget : {}\nMolecules : {}\nMean track length (subframes) : {}".format(
+                      report['mean_number_of_emitters'], self.mean_number_of_emitters,
+                      report['number_of_molecules'], report['mean_track_length']))
+        return report
+
+    def get_mean_square_displacements(self, max_lag):
+        """
+            Time averaged MSD of every molecule for the lags 1..max_lag, computed in batches.
+            Returns a time vector and a (number_of_molecules, max_lag) array,
+            NaN where the journey is too short for the lag.
+        """
+        return [self.step_time_in_seconds * np.arange(1, max_lag + 1),
+                mean_square_displacements(self.trajectory_store, max_lag)]
+
+    def get_ensemble_mean_square_displacement(self, max_lag):
+        return [self.step_time_in_seconds * np.arange(1, max_lag + 1),
+                ensemble_mean_square_displacement(self.trajectory_store, max_lag)]
+
     def plot_mean_square_displacement_curves(self, *args):
-        for m in tqdm(self.molecules):
-            m.plot_mean_square_displacement(*args)
+        # Same lags as Molecule.get_mean_square_displacement : 1 .. length // 10 - 1,
+        # journeys shorter than 20 positions have no lag and an empty curve
+        max_lags = np.maximum(self.trajectory_store.lengths // 10 - 1, 0)
+        time, msds = self.get_mean_square_displacements(int(max_lags.max()))
+        for max_lag, msd in zip(max_lags, msds):
+            plt.plot(time[:max_lag], msd[:max_lag], *args)
 
     def plot_length_of_journies(self, *args):
         return plt.hist(self.get_length_of_journies(), *args)
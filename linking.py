@@ -0,0 +1,152 @@
+import numpy as np
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.optimize import linear_sum_assignment
+from trajectory_store import TrajectoryStore
+
+NO_TRACK = -1
+
+
+def _assign(ends, points, costs):
+    """
+        Globally optimal links between track ends and points for a set of candidate links
+        (ends[k], points[k], costs[k]) : as many links as possible, and the smallest total cost
+        among those. The candidate graph is split in its connected components, components
+        with a single candidate link (the common case at low density) are linked at once,
+        and every other one is solved by linear_sum_assignment on its own small cost matrix.
+        Returns the linked ends and points.
+    """
+    if len(ends) == 0:
+        return ends, points
+    end_nodes, end_index = np.unique(ends, return_inverse = True)
+    point_nodes, point_index = np.unique(points, return_inverse = True)
+    number_of_nodes = len(end_nodes) + len(point_nodes)
+    graph = coo_matrix((np.ones(len(ends)), (end_index, len(end_nodes) + point_index)),
+                       shape = (number_of_nodes, number_of_nodes))
+    _, labels = connected_components(graph, directed = False)
+    components = labels[end_index]
+
+    links_per_component = np.bincount(components)
+    single = links_per_component[components] == 1
+    linked_ends, linked_points = [ends[single]], [points[single]]
+
+    crowded = np.flatnonzero(~single)
+    order = crowded[np.argsort(components[crowded], kind = 'stable')]
+    boundaries = np.flatnonzero(np.diff(components[order])) + 1
+    for links in np.split(order, boundaries):
+        if len(links) == 0:
+            continue
+        rows, row_index = np.unique(ends[links], return_inverse = True)
+        columns, column_index = np.unique(points[links], return_inverse = True)
+        # Not linking costs more than all the links of the component together,
+        # so the assignment first maximizes the number of links
+        no_link = costs[links].sum() + 1
+        matrix = np.full((len(rows), len(columns)), no_link)
+        matrix[row_index, column_index] = costs[links]
+        assigned_rows, assigned_columns = linear_sum_assignment(matrix)
+        real = matrix[assigned_rows, assigned_columns] < no_link
+        linked_ends.append(rows[assigned_rows[real]])
+        linked_points.append(columns[assigned_columns[real]])
+    return np.concatenate(linked_ends), np.concatenate(linked_points)
+
+
+def link_tracks(frames, xs, ys, maximum_step_in_um, maximum_gap = 0, progress = lambda x:x):
+    """
+        Links localizations (frame, x, y) into tracks, frame after frame.
+        The localizations of every frame can continue the tracks that ended in the previous
+        maximum_gap + 1 frames (gap closing : up to maximum_gap frames in which the molecule
+        was missed). A track that was last seen gap frames ago may move up to
+        maximum_step_in_um * sqrt(gap), as a diffusing molecule, and a link costs its square
+        distance over gap, so links of different gaps compare by their likelihood.
+        Candidate links are found with cKDTree (only pairs within reach are ever looked at),
+        and every frame is assigned globally (see _assign), so the cost is close to linear
+        in the number of localizations.
+        Returns the track of every localization, tracks are numbered in the order they start.
+    """
+    frames = np.asarray(frames, dtype = np.int64)
+    coordinates = np.stack([np.asarray(xs, dtype = np.float64), np.asarray(ys, dtype = np.float64)], axis = 1)
+    track_ids = np.full(len(frames), NO_TRACK, dtype = np.int64)
+    if len(frames) == 0:
+        return track_ids
+
+    order = np.argsort(frames, kind = 'stable')
+    frame_numbers, first_rows = np.unique(frames[order], return_index = True)
+    frame_rows = np.split(order, first_rows[1:])
+    # Last localization and last frame of every track
+    last_rows = np.empty(len(frames), dtype = np.int64)
+    last_frames = np.empty(len(frames), dtype = np.int64)
+    number_of_tracks = 0
+    live_tracks = np.zeros(0, dtype = np.int64)
+    largest_reach = maximum_step_in_um * np.sqrt(maximum_gap + 1)
+
+    for frame, rows in progress(list(zip(frame_numbers, frame_rows))):
+        live_tracks = live_tracks[last_frames[live_tracks] >= frame - 1 - maximum_gap]
+        linked_tracks, linked_rows = np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64)
+        if len(live_tracks):
+            end_tree = cKDTree(coordinates[last_rows[live_tracks]])
+            point_tree = cKDTree(coordinates[rows])
+            pairs = end_tree.sparse_distance_matrix(point_tree, largest_reach, output_type = 'ndarray')
+            gaps = frame - last_frames[live_tracks[pairs['i']]]
+            within = pairs['v'] <= maximum_step_in_um * np.sqrt(gaps)
+            pairs, gaps = pairs[within], gaps[within]
+            ends, points = _assign(pairs['i'], pairs['j'], pairs['v'] ** 2 / gaps)
+            linked_tracks, linked_rows = live_tracks[ends], rows[points]
+
+        new_rows = np.setdiff1d(rows, linked_rows, assume_unique = True)
+        new_tracks = np.arange(number_of_tracks, number_of_tracks + len(new_rows))
+        number_of_tracks += len(new_rows)
+
+        tracks = np.concatenate([linked_tracks, new_tracks])
+        track_rows = np.concatenate([linked_rows, new_rows])
+        track_ids[track_rows] = tracks
+        last_rows[tracks] = track_rows
+        last_frames[tracks] = frame
+        live_tracks = np.union1d(live_tracks, new_tracks)
+    return track_ids
+
+
+def tracks_to_store(frames, xs, ys, track_ids, frame_time_in_seconds, screen_size_in_um, minimum_length = 1):
+    """
+        A TrajectoryStore of linked tracks, with one step per frame (step_time_in_seconds = frame_time_in_seconds),
+        so it goes to everything that takes the store of a simulation (square_displacements,
+        summed_square_displacements and the two species fitters, MSDs, Molecule ...).
+        The store has a position for every step, so a track is split where gap closing skipped
+        frames, and the steps over a gap are not used (they are not one frame long).
+        Parts shorter than minimum_length localizations are dropped. Positions have z = 0.
+    """
+    frames = np.asarray(frames, dtype = np.int64)
+    track_ids = np.asarray(track_ids, dtype = np.int64)
+    order = np.lexsort([frames, track_ids])
+    frames, track_ids = frames[order], track_ids[order]
+    positions = np.zeros((len(order), 3))
+    positions[:, 0] = np.asarray(xs, dtype = np.float64)[order]
+    positions[:, 1] = np.asarray(ys, dtype = np.float64)[order]
+
+    is_start = np.r_[True, (np.diff(track_ids) != 0) | (np.diff(frames) != 1)][:len(order)]
+    parts = np.cumsum(is_start) - 1
+    lengths = np.bincount(parts, minlength = is_start.sum())
+    kept = lengths >= minimum_length
+    starts, lengths = np.flatnonzero(is_start)[kept], lengths[kept]
+    rows = np.flatnonzero(kept[parts])
+
+    store = TrajectoryStore(frames[starts], positions[starts], screen_size_in_um, 0., frame_time_in_seconds)
+    offsets = np.r_[0, np.cumsum(lengths)]
+    store.set_buffers(positions[rows], offsets)
+    return store
+
+
+def link_localizations(table, maximum_step_in_um, frame_time_in_seconds, screen_size_in_um,
+                       maximum_gap = 0,
+                       minimum_length = 1,
+                       progress = lambda x:x):
+    """
+        Links a localization table (see localization.LOCALIZATION_DTYPE) into tracks.
+        maximum_step_in_um is the "max step length" of a tracker (in pixels times pixel_length_in_um).
+        Returns the track of every localization and the TrajectoryStore of the tracks (see tracks_to_store).
+    """
+    track_ids = link_tracks(table['frame'], table['x_in_um'], table['y_in_um'], maximum_step_in_um,
+                            maximum_gap, progress)
+    store = tracks_to_store(table['frame'], table['x_in_um'], table['y_in_um'], track_ids,
+                            frame_time_in_seconds, screen_size_in_um, minimum_length)
+    return track_ids, store
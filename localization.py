@@ -0,0 +1,359 @@
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from scipy import ndimage
+
+BAND_PASS_FILTER = 'band_pass'
+LOG_FILTER = 'log'
+FILTERS = [BAND_PASS_FILTER, LOG_FILTER]
+
+LEAST_SQUARES_FIT = 'least_squares'
+# Poisson maximum likelihood, for frames in photons
+MAXIMUM_LIKELIHOOD_FIT = 'maximum_likelihood'
+FITS = [LEAST_SQUARES_FIT, MAXIMUM_LIKELIHOOD_FIT]
+
+# The band pass subtracts the mean of a box this many PSF sigmas around every pixel as the background
+BACKGROUND_SIGMAS = 5
+# The median and noise of the filtered frames are estimated from every NOISE_SUBSAMPLING-th pixel
+NOISE_SUBSAMPLING = 7
+# Candidates are local maxima of the filtered frame this many noise sigmas over its median
+DEFAULT_THRESHOLD_IN_SIGMAS = 5.
+# Fits use the pixels within this many PSF sigmas of the candidate
+ROI_SIGMAS = 3
+MAXIMUM_ITERATIONS = 30
+# A fit converged when its position moves by less than this, in pixels
+POSITION_TOLERANCE = 1e-3
+INITIAL_DAMPING = 1e-3
+MAXIMUM_DAMPING = 1e10
+# Normal equations worse conditioned than this are degenerate (e.g. a spot that left its ROI,
+# whose jacobian vanishes), the fit of the ROI stops there and it is dropped
+MAXIMUM_CONDITION_NUMBER = 1e12
+# Fitted widths out of this range (relative to the PSF) are not single molecules
+SIGMA_RANGE = (.5, 3.)
+# Median absolute deviation to sigma, for gaussian noise
+MAD_TO_SIGMA = 1.4826
+
+X, Y, AMPLITUDE, BACKGROUND, SIGMA_X, SIGMA_Y = range(6)
+
+LOCALIZATION_DTYPE = np.dtype([('frame', np.int64),
+                               ('x_in_um', np.float64),
+                               ('y_in_um', np.float64),
+                               ('amplitude', np.float64),
+                               ('background', np.float64),
+                               ('sigma_x_in_um', np.float64),
+                               ('sigma_y_in_um', np.float64),
+                               ('photons', np.float64),
+                               ('uncertainty_in_um', np.float64),
+                               ('iterations', np.int64)])
+
+
+def _well_conditioned(matrices):
+    """
+        Whether every matrix of a stack is finite and can be solved safely
+    """
+    finite = np.all(np.isfinite(matrices), axis = (1, 2))
+    well_conditioned = np.zeros(len(matrices), dtype = bool)
+    if finite.any():
+        well_conditioned[finite] = np.linalg.cond(matrices[finite]) < MAXIMUM_CONDITION_NUMBER
+    return well_conditioned
+
+
+class Localizer:
+    """
+        Finds and fits the molecules of frame stacks, in the coordinates of the simulation
+        (frames are indexed [x][y], pixel i is centered at i * pixel_length_in_um).
+            filtering  - BAND_PASS_FILTER smooths with the PSF and subtracts the mean of a box of
+                         BACKGROUND_SIGMAS PSF sigmas (Crocker & Grier), LOG_FILTER is the (negative, scale normalized)
+                         laplacian of gaussian. Both work on a whole batch of frames at once.
+            candidates - local maxima of the filtered frames (over min_distance pixels) that are
+                         threshold over its median. threshold = None takes DEFAULT_THRESHOLD_IN_SIGMAS
+                         times a robust estimate of the noise of every filtered frame.
+            fitting    - every candidate gets a square ROI of the pixels within ROI_SIGMAS of it (moved
+                         inside the frame at the borders), and all the ROIs are fitted together with
+                         a vectorized Levenberg-Marquardt, to amplitude * gaussian + background.
+                         fit = MAXIMUM_LIKELIHOOD_FIT maximizes the Poisson likelihood instead of least
+                         squares (Fisher scoring, for frames in photons). With fit_sigma the widths are
+                         fitted on both axes (motion blur stretches the spots), otherwise they stay
+                         at the PSF sigmas.
+        localize_batches localizes number_of_threads batches at a time (the filters and the fits
+        release the GIL).
+        Fits that do not converge, leave their ROI or whose width is out of SIGMA_RANGE are dropped.
+        Returns a table (a LOCALIZATION_DTYPE structured array), photons is the integral of the
+        fitted gaussian and uncertainty_in_um the standard error of the position from the fit.
+    """
+    def __init__(self, pixel_length_in_um, sigma_x_in_um, sigma_y_in_um = None,
+                 filtering = BAND_PASS_FILTER,
+                 fit = LEAST_SQUARES_FIT,
+                 threshold = None,
+                 min_distance = None,
+                 fit_sigma = True,
+                 maximum_iterations = MAXIMUM_ITERATIONS,
+                 number_of_threads = 1):
+        if filtering not in FILTERS:
+            raise Exception("Unknown filter {}, expected one of {}".format(filtering, FILTERS))
+        if fit not in FITS:
+            raise Exception("Unknown fit {}, expected one of {}".format(fit, FITS))
+        if sigma_y_in_um is None:
+            sigma_y_in_um = sigma_x_in_um
+        self.pixel_length_in_um = pixel_length_in_um
+        self.sigma_x_in_um = sigma_x_in_um
+        self.sigma_y_in_um = sigma_y_in_um
+        self.sigmas = np.array([sigma_x_in_um, sigma_y_in_um]) / pixel_length_in_um
+        self.filtering = filtering
+        self.fit = fit
+        self.threshold = threshold
+        if min_distance is None:
+            min_distance = max(1, int(np.ceil(np.max(self.sigmas))))
+        self.min_distance = min_distance
+        self.fit_sigma = fit_sigma
+        self.maximum_iterations = maximum_iterations
+        self.roi_half_width = max(2, int(np.ceil(ROI_SIGMAS * np.max(self.sigmas))))
+        self.number_of_threads = number_of_threads
+
+    @classmethod
+    def for_stack(cls, frame_stack, **kwargs):
+        """
+            A Localizer with the pixel length and PSF of a FrameStack (from its metadata)
+        """
+        metadata = frame_stack.metadata
+        return cls(metadata['pixel_length_in_um'], metadata['sigma_x_in_um'], metadata['sigma_y_in_um'], **kwargs)
+
+    def filter_frames(self, frames):
+        frames = np.asarray(frames, dtype = np.float32)
+        sigmas = (0,) + tuple(self.sigmas)
+        if self.filtering == LOG_FILTER:
+            # Only over the axes of the frames, gaussian_laplace would also differentiate along time
+            laplacian = ndimage.gaussian_filter(frames, sigmas, order = (0, 2, 0)) + \
+                            ndimage.gaussian_filter(frames, sigmas, order = (0, 0, 2))
+            return -laplacian * np.mean(self.sigmas) ** 2
+        # A box is as good a background as a wide gaussian, and costs the same for any width
+        box = (1,) + tuple(2 * int(np.ceil(BACKGROUND_SIGMAS * s)) + 1 for s in self.sigmas)
+        filtered = ndimage.gaussian_filter(frames, sigmas)
+        filtered -= ndimage.uniform_filter(frames, box)
+        return filtered
+
+    def find_candidates(self, filtered):
+        """
+            (slot, x, y) of the local maxima of a (frames, X, Y) filtered batch over its threshold
+        """
+        size = (1, 2 * self.min_distance + 1, 2 * self.min_distance + 1)
+        is_maximum = ndimage.maximum_filter(filtered, size = size, mode = 'nearest') == filtered
+        flat = filtered.reshape(len(filtered), -1)[:, ::NOISE_SUBSAMPLING]
+        median = np.median(flat, axis = 1)
+        if self.threshold is None:
+            noise = MAD_TO_SIGMA * np.median(np.abs(flat - median[:, np.newaxis]), axis = 1)
+            threshold = DEFAULT_THRESHOLD_IN_SIGMAS * noise
+        else:
+            threshold = np.full(len(filtered), self.threshold)
+        # Flat regions (e.g. an empty noiseless frame) are maxima of themselves
+        over = filtered > (median + np.maximum(threshold, np.finfo(np.float32).eps))[:, np.newaxis, np.newaxis]
+        return np.nonzero(is_maximum & over)
+
+    def extract_rois(self, frames, slots, xs, ys):
+        """
+            The (n, R, R) ROIs around the candidates and the pixel of their first corner
+        """
+        width = 2 * self.roi_half_width + 1
+        _, size_x, size_y = frames.shape
+        if size_x < width or size_y < width:
+            raise Exception("Frames of {} pixels are smaller than the ROIs ({} pixels)".format(frames.shape[1:], width))
+        corner_x = np.clip(xs - self.roi_half_width, 0, size_x - width)
+        corner_y = np.clip(ys - self.roi_half_width, 0, size_y - width)
+        pixels = np.arange(width)
+        rois = frames[slots[:, np.newaxis, np.newaxis],
+                      corner_x[:, np.newaxis, np.newaxis] + pixels[np.newaxis, :, np.newaxis],
+                      corner_y[:, np.newaxis, np.newaxis] + pixels[np.newaxis, np.newaxis, :]]
+        return np.asarray(rois, dtype = np.float64), corner_x, corner_y
+
+    def _model(self, parameters, width):
+        """
+            The model of every ROI, flattened to (n, R * R), and its jacobian (n, R * R, number_of_parameters)
+        """
+        pixels = np.arange(width, dtype = np.float64)
+        u = pixels[np.newaxis, :] - parameters[:, X, np.newaxis]
+        v = pixels[np.newaxis, :] - parameters[:, Y, np.newaxis]
+        sigma_x, sigma_y = parameters[:, SIGMA_X, np.newaxis], parameters[:, SIGMA_Y, np.newaxis]
+        # Separable : the gaussian is the outer product of its two profiles
+        profile_x = np.exp(-u ** 2 / (2 * sigma_x ** 2))
+        profile_y = np.exp(-v ** 2 / (2 * sigma_y ** 2))
+        gaussian = (profile_x[:, :, np.newaxis] * profile_y[:, np.newaxis, :]).reshape(len(parameters), -1)
+        amplitude = parameters[:, AMPLITUDE, np.newaxis]
+        model = amplitude * gaussian + parameters[:, BACKGROUND, np.newaxis]
+
+        u = np.repeat(u, width, axis = 1)
+        v = np.tile(v, width)
+        columns = [amplitude * gaussian * u / sigma_x ** 2,
+                   amplitude * gaussian * v / sigma_y ** 2,
+                   gaussian,
+                   np.ones_like(gaussian)]
+        if self.fit_sigma:
+            columns += [amplitude * gaussian * u ** 2 / sigma_x ** 3,
+                        amplitude * gaussian * v ** 2 / sigma_y ** 3]
+        return model, np.stack(columns, axis = 2)
+
+    def _cost(self, data, model):
+        if self.fit == LEAST_SQUARES_FIT:
+            return np.sum((data - model) ** 2, axis = 1)
+        # Poisson negative log likelihood, without the terms of the data alone
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            cost = np.sum(model - data * np.log(model), axis = 1)
+        return np.where(np.all(model > 0, axis = 1), cost, np.inf)
+
+    def _normal_equations(self, data, model, jacobian):
+        if self.fit == LEAST_SQUARES_FIT:
+            weighted = jacobian
+        else:
+            # Fisher scoring : the weights of the Poisson likelihood are 1 / model
+            weighted = jacobian / np.maximum(model, np.finfo(np.float64).tiny)[:, :, np.newaxis]
+        hessian = np.matmul(weighted.transpose(0, 2, 1), jacobian)
+        gradient = np.einsum('npi,np->ni', weighted, data - model)
+        return hessian, gradient
+
+    def fit_rois(self, rois, initial_positions = None):
+        """
+            Fits all the (n, R, R) rois at once, from initial_positions ((n, 2), in pixels of the ROI,
+            the center by default).
+            Returns the parameters (X, Y, AMPLITUDE, BACKGROUND, SIGMA_X, SIGMA_Y, in pixels of the ROI),
+            the standard error of the position, the number of iterations and whether every fit converged
+            (degenerate fits, see MAXIMUM_CONDITION_NUMBER, did not)
+        """
+        number_of_rois, width = len(rois), rois.shape[1]
+        data = rois.reshape(number_of_rois, -1)
+        number_of_parameters = 6 if self.fit_sigma else 4
+
+        parameters = np.empty((number_of_rois, 6))
+        if initial_positions is None:
+            parameters[:, X] = parameters[:, Y] = self.roi_half_width
+        else:
+            parameters[:, [X, Y]] = initial_positions
+        parameters[:, BACKGROUND] = np.min(data, axis = 1)
+        parameters[:, AMPLITUDE] = np.maximum(np.max(data, axis = 1) - parameters[:, BACKGROUND], np.finfo(np.float64).eps)
+        parameters[:, SIGMA_X], parameters[:, SIGMA_Y] = self.sigmas
+        if self.fit == MAXIMUM_LIKELIHOOD_FIT:
+            parameters[:, BACKGROUND] = np.maximum(parameters[:, BACKGROUND], np.finfo(np.float32).eps)
+
+        model, _ = self._model(parameters, width)
+        cost = self._cost(data, model)
+        damping = np.full(number_of_rois, INITIAL_DAMPING)
+        iterations = np.zeros(number_of_rois, dtype = np.int64)
+        converged = np.zeros(number_of_rois, dtype = bool)
+        active = np.arange(number_of_rois)
+        for _ in range(self.maximum_iterations):
+            if len(active) == 0:
+                break
+            model, jacobian = self._model(parameters[active], width)
+            hessian, gradient = self._normal_equations(data[active], model, jacobian)
+            # Marquardt : damping relative to the diagonal, so the parameters may have any scale
+            diagonal = np.einsum('nii->ni', hessian)
+            damped = hessian + (damping[active, np.newaxis] * diagonal)[:, :, np.newaxis] * np.eye(number_of_parameters)
+            damped += np.eye(number_of_parameters) * np.finfo(np.float64).eps
+            # Degenerate ROIs leave active without converging
+            well_conditioned = _well_conditioned(damped)
+            active, damped, gradient = active[well_conditioned], damped[well_conditioned], gradient[well_conditioned]
+            if len(active) == 0:
+                break
+            steps = np.linalg.solve(damped, gradient[:, :, np.newaxis])[:, :, 0]
+
+            trial = parameters[active].copy()
+            trial[:, :number_of_parameters] += steps
+            trial_model, _ = self._model(trial, width)
+            trial_cost = self._cost(data[active], trial_model)
+            if self.fit_sigma:
+                trial_cost[np.any(trial[:, [SIGMA_X, SIGMA_Y]] <= 0, axis = 1)] = np.inf
+            better = trial_cost < cost[active]
+
+            improved = active[better]
+            parameters[improved] = trial[better]
+            cost[improved] = trial_cost[better]
+            damping[improved] /= 10
+            damping[active[~better]] *= 10
+            iterations[active] += 1
+
+            small_step = np.all(np.abs(steps[:, [X, Y]]) < POSITION_TOLERANCE, axis = 1)
+            converged[active[better & small_step]] = True
+            # A step that does not improve the cost with a huge damping is as small as it gets
+            converged[active[~better & (damping[active] > MAXIMUM_DAMPING)]] = True
+            active = active[~converged[active]]
+
+        model, jacobian = self._model(parameters, width)
+        hessian, _ = self._normal_equations(data, model, jacobian)
+        covariance = np.full(hessian.shape, np.nan)
+        finite = np.all(np.isfinite(hessian), axis = (1, 2))
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            covariance[finite] = np.linalg.pinv(hessian[finite])
+            if self.fit == LEAST_SQUARES_FIT:
+                residual_variance = cost / max(width ** 2 - number_of_parameters, 1)
+                covariance *= residual_variance[:, np.newaxis, np.newaxis]
+            uncertainty = np.sqrt((covariance[:, X, X] + covariance[:, Y, Y]) / 2)
+        return parameters, uncertainty, iterations, converged
+
+    def localize(self, frames, frame_indices = None):
+        """
+            The localizations of a (frames, X, Y) batch, frame_indices are the frame numbers
+            to write in the table (range(len(frames)) by default)
+        """
+        frames = np.asarray(frames)
+        if frame_indices is None:
+            frame_indices = range(len(frames))
+        frame_indices = np.asarray(list(frame_indices), dtype = np.int64)
+        if len(frames) == 0:
+            return np.zeros(0, dtype = LOCALIZATION_DTYPE)
+
+        slots, xs, ys = self.find_candidates(self.filter_frames(frames))
+        if len(slots) == 0:
+            return np.zeros(0, dtype = LOCALIZATION_DTYPE)
+        rois, corner_x, corner_y = self.extract_rois(frames, slots, xs, ys)
+        parameters, uncertainty, iterations, converged = self.fit_rois(rois, np.stack([xs - corner_x, ys - corner_y], axis = 1))
+
+        sigma_range = np.array(SIGMA_RANGE)[:, np.newaxis] * self.sigmas
+        width = rois.shape[1]
+        with np.errstate(invalid = 'ignore'):
+            valid = converged & (parameters[:, AMPLITUDE] > 0) & np.isfinite(uncertainty) & \
+                        np.all((parameters[:, [X, Y]] >= -.5) & (parameters[:, [X, Y]] <= width - .5), axis = 1) & \
+                        np.all((parameters[:, [SIGMA_X, SIGMA_Y]] >= sigma_range[0]) &
+                               (parameters[:, [SIGMA_X, SIGMA_Y]] <= sigma_range[1]), axis = 1)
+        parameters = parameters[valid]
+
+        table = np.zeros(len(parameters), dtype = LOCALIZATION_DTYPE)
+        table['frame'] = frame_indices[slots[valid]]
+        table['x_in_um'] = (corner_x[valid] + parameters[:, X]) * self.pixel_length_in_um
+        table['y_in_um'] = (corner_y[valid] + parameters[:, Y]) * self.pixel_length_in_um
+        table['amplitude'] = parameters[:, AMPLITUDE]
+        table['background'] = parameters[:, BACKGROUND]
+        table['sigma_x_in_um'] = parameters[:, SIGMA_X] * self.pixel_length_in_um
+        table['sigma_y_in_um'] = parameters[:, SIGMA_Y] * self.pixel_length_in_um
+        table['photons'] = 2 * np.pi * parameters[:, AMPLITUDE] * parameters[:, SIGMA_X] * parameters[:, SIGMA_Y]
+        table['uncertainty_in_um'] = uncertainty[valid] * self.pixel_length_in_um
+        table['iterations'] = iterations[valid]
+        return table
+
+    def localize_batches(self, batches, progress = lambda x:x):
+        """
+            The localizations of (frame_indices, frames) batches (FrameStack.iter_batches,
+            FrameRenderer.iter_batches ...), in one table ordered by frame
+        """
+        if self.number_of_threads == 1:
+            tables = [self.localize(frames, frame_indices) for frame_indices, frames in progress(batches)]
+        else:
+            tables = []
+            with ThreadPoolExecutor(self.number_of_threads) as threads:
+                # At most number_of_threads batches are read (and in memory) at once
+                pending = deque()
+                for frame_indices, frames in progress(batches):
+                    if len(pending) == self.number_of_threads:
+                        tables.append(pending.popleft().result())
+                    pending.append(threads.submit(self.localize, frames, frame_indices))
+                tables += [future.result() for future in pending]
+        if not tables:
+            return np.zeros(0, dtype = LOCALIZATION_DTYPE)
+        table = np.concatenate(tables)
+        return table[np.argsort(table['frame'], kind = 'stable')]
+
+
+def localize_stack(frame_stack, batch_size = 64, progress = lambda x:x, **kwargs):
+    """
+        Localizes all the frames of a FrameStack, batch_size frames at a time,
+        with a Localizer for its PSF (kwargs go to the Localizer)
+    """
+    localizer = Localizer.for_stack(frame_stack, **kwargs)
+    return localizer.localize_batches(frame_stack.iter_batches(batch_size), progress)
@@ -0,0 +1,84 @@
+import numpy as np
+from scipy import optimize
+from scipy.special import expit
+
+
+def summed_square_displacements(store, number_of_steps = None):
+    """
+        The sufficient statistics of every track for the diffusion likelihood :
+        the sum of the 2D square displacements of its steps, and its number of steps.
+        With number_of_steps, only the tracks that have at least that many steps are used,
+        cut to their first number_of_steps steps (like approxiamte_diffusion_coefficients).
+        Returns (sums, steps), two arrays with one entry per track used.
+    """
+    displacements, molecule_ids = store.square_displacements(1)
+    steps = np.bincount(molecule_ids, minlength = len(store))
+
+    if number_of_steps is not None:
+        first = np.cumsum(steps) - steps
+        step_index = np.arange(len(displacements)) - first[molecule_ids]
+        keep = (step_index < number_of_steps) & (steps[molecule_ids] >= number_of_steps)
+        displacements, molecule_ids = displacements[keep], molecule_ids[keep]
+        steps = np.bincount(molecule_ids, minlength = len(store))
+
+    sums = np.bincount(molecule_ids, weights = displacements, minlength = len(store))
+    used = steps > 0
+    return sums[used], steps[used]
+
+
+def _single_species_log_likelihood(diffusion_coefficient, sums, steps, step_time_in_seconds):
+    """
+        log of the product of the 2D gaussian step densities of every track,
+        each step has variance 2 D dt per axis
+    """
+    four_d_dt = 4 * diffusion_coefficient * step_time_in_seconds
+    return -steps * np.log(np.pi * four_d_dt) - sums / four_d_dt
+
+
+def two_species_log_likelihood(D1, D2, fraction, sums, steps, step_time_in_seconds):
+    """
+        Log likelihood of the tracks under a mixture of two diffusing species,
+        fraction being the probability of species 1.
+        Evaluated in log space (log-sum-exp), so long tracks do not underflow.
+        Returns the log likelihood and its gradient with respect to (D1, D2, fraction).
+    """
+    log_1 = np.log(fraction) + _single_species_log_likelihood(D1, sums, steps, step_time_in_seconds)
+    log_2 = np.log1p(-fraction) + _single_species_log_likelihood(D2, sums, steps, step_time_in_seconds)
+    log_likelihoods = np.logaddexp(log_1, log_2)
+
+    # Posterior probability of every track to belong to species 1
+    responsibility = np.exp(log_1 - log_likelihoods)
+
+    gradient = np.array([
+        np.sum(responsibility * (sums / (4 * D1 ** 2 * step_time_in_seconds) - steps / D1)),
+        np.sum((1 - responsibility) * (sums / (4 * D2 ** 2 * step_time_in_seconds) - steps / D2)),
+        np.sum(responsibility / fraction - (1 - responsibility) / (1 - fraction)),
+    ])
+    return np.sum(log_likelihoods), gradient
+
+
+def fit_two_species(sums, steps, step_time_in_seconds, p0 = None):
+    """
+        Maximum likelihood D1, D2 and fraction (of species 1) for per-track summed
+        square displacements and step counts.
+        The optimization runs on log D1, log D2 and logit(fraction), with analytic gradients.
+        p0 = [D1, D2, fraction], by default spread around the single species estimate.
+        Returns the estimate and the scipy OptimizeResult.
+    """
+    sums = np.asarray(sums, dtype = np.float64)
+    steps = np.asarray(steps, dtype = np.float64)
+    if p0 is None:
+        single_species = np.sum(sums) / (4 * step_time_in_seconds * np.sum(steps))
+        p0 = [single_species / 3, single_species * 3, .5]
+    D1, D2, fraction = p0
+    x0 = [np.log(D1), np.log(D2), np.log(fraction / (1 - fraction))]
+
+    def minus_log_likelihood(x):
+        D1, D2, fraction = np.exp(x[0]), np.exp(x[1]), expit(x[2])
+        value, gradient = two_species_log_likelihood(D1, D2, fraction, sums, steps, step_time_in_seconds)
+        chain = np.array([D1, D2, fraction * (1 - fraction)])
+        return -value, -gradient * chain
+
+    result = optimize.minimize(minus_log_likelihood, x0, jac = True, method = 'L-BFGS-B')
+    estimate = np.array([np.exp(result.x[0]), np.exp(result.x[1]), expit(result.x[2])])
+    return estimate, result
@@ -0,0 +1,80 @@
+import numpy as np
+
+# Bound on the second derivatives of a 2-D gaussian with a peak of 1, in units of 1 / sigma^2 :
+# 1 along an axis, exp(-1) across them (also holds for the pixel integrated PSF, a mean of gaussians)
+MAXIMUM_CURVATURE = (1 + np.exp(-1)) / 2
+
+
+def merge_radius(tolerance):
+    """
+        Largest distance (in sigmas) of the merged positions from their centroid
+        for which a pixel changes by at most tolerance per unit of intensity.
+        The first order terms of the PSF around the centroid cancel, what is left is
+        at most MAXIMUM_CURVATURE * distance^2.
+    """
+    return np.sqrt(tolerance / MAXIMUM_CURVATURE)
+
+
+def _segment_spread(xs, ys, weights, starts, ends):
+    """
+        Weighted centroid of every segment [start, end) of the emitters,
+        and the largest square distance of its emitters from it
+    """
+    lengths = ends - starts
+    total = np.add.reduceat(weights, starts)
+    center_x = np.add.reduceat(weights * xs, starts) / total
+    center_y = np.add.reduceat(weights * ys, starts) / total
+    square_distances = (xs - np.repeat(center_x, lengths)) ** 2 + (ys - np.repeat(center_y, lengths)) ** 2
+    return center_x, center_y, total, np.maximum.reduceat(square_distances, starts)
+
+
+def merge_emitters(xs, ys, intensities, groups, sigma_x_in_um, sigma_y_in_um, tolerance):
+    """
+        Merges the blur samples of every group (one molecule in one frame, consecutive in time)
+        into as few emitters as the tolerance allows, each at the intensity weighted centroid
+        of the samples it replaces and with their summed intensity.
+        A group first gets as many emitters as its path length (in sigmas) needs
+        for samples 2 * merge_radius apart, then every emitter whose samples spread over more
+        than merge_radius from it is split in two, until none is. So a slow molecule
+        becomes a single emitter and a fast one keeps all of its samples, and every pixel
+        is off by at most tolerance times the intensity of the merged samples.
+            groups - the group of every emitter, emitters of a group have to be contiguous
+                     and in time order
+        Returns the merged xs, ys and intensities.
+    """
+    xs = np.asarray(xs, dtype = np.float64)
+    ys = np.asarray(ys, dtype = np.float64)
+    intensities = np.asarray(intensities, dtype = np.float64)
+    groups = np.asarray(groups)
+    # Dark samples add nothing, and would have no centroid
+    lit = intensities > 0
+    xs, ys, intensities, groups = xs[lit], ys[lit], intensities[lit], groups[lit]
+    if len(xs) == 0:
+        return xs, ys, intensities
+    # Distances in sigmas, so both axes use the same radius
+    scaled_x, scaled_y = xs / sigma_x_in_um, ys / sigma_y_in_um
+    radius = merge_radius(tolerance)
+
+    group_starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    group_lengths = np.diff(np.r_[group_starts, len(xs)])
+    steps = np.hypot(np.diff(scaled_x), np.diff(scaled_y))
+    steps[group_starts[1:] - 1] = 0
+    path_lengths = np.add.reduceat(np.r_[steps, 0.], group_starts)
+    number_of_samples = np.clip(np.ceil(path_lengths / (2 * radius)), 1, group_lengths).astype(np.int64)
+
+    # Equal parts of every group
+    segment_groups = np.repeat(np.arange(len(group_starts)), number_of_samples)
+    part = np.arange(number_of_samples.sum()) - np.repeat(np.cumsum(number_of_samples) - number_of_samples,
+                                                          number_of_samples)
+    starts = group_starts[segment_groups] + part * group_lengths[segment_groups] // number_of_samples[segment_groups]
+    ends = np.r_[starts[1:], len(xs)]
+
+    while True:
+        center_x, center_y, total, spread = _segment_spread(scaled_x, scaled_y, intensities, starts, ends)
+        split = (spread > radius ** 2) & (ends - starts > 1)
+        if not split.any():
+            break
+        starts = np.sort(np.r_[starts, (starts[split] + ends[split]) // 2])
+        ends = np.r_[starts[1:], len(xs)]
+
+    return center_x * sigma_x_in_um, center_y * sigma_y_in_um, total
@@ -0,0 +1,104 @@
+import numpy as np
+
+# Number of padded positions processed together
+DEFAULT_BATCH_SIZE = 2 ** 21
+
+
+def _fft_size(n):
+    """
+        Smallest power of 2 that is at least 2n, so the circular correlation has no wrap around
+    """
+    return 1 << int(np.ceil(np.log2(max(2 * n, 2))))
+
+
+def _padded_mean_square_displacements(tracks, lengths, max_lag):
+    """
+        Time averaged MSD of a batch of zero padded tracks, for the lags 1..max_lag.
+        tracks is (number_of_tracks, length, 2), lengths the real length of every track.
+        Uses MSD(m) = S1(m) - 2 S2(m), where S2 is the position autocorrelation (by FFT)
+        and S1 comes from cumulative sums of the square norms, O(N log N) for all the lags.
+        Lags that are not shorter than the track are NaN.
+    """
+    number_of_tracks, length, _ = tracks.shape
+    rows = np.arange(number_of_tracks)[:, np.newaxis]
+    lags = np.arange(1, max_lag + 1)[np.newaxis, :]
+
+    spectrum = np.fft.rfft(tracks, n = _fft_size(length), axis = 1)
+    autocorrelation = np.fft.irfft(np.abs(spectrum) ** 2, axis = 1)[:, :max_lag + 1].sum(axis = 2)
+
+    square_norms = np.sum(tracks ** 2, axis = 2)
+    cumulative = np.zeros([number_of_tracks, length + 1])
+    np.cumsum(square_norms, axis = 1, out = cumulative[:, 1:])
+
+    N = lengths[:, np.newaxis]
+    valid = lags < N
+    last = cumulative[rows, np.minimum(N, length)]
+    before_end = cumulative[rows, np.clip(N - lags, 0, length)]
+    s1 = last - cumulative[rows, np.minimum(lags, length)] + before_end
+    s2 = autocorrelation[:, 1:max_lag + 1]
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        msd = (s1 - 2 * s2) / (N - lags)
+    msd[~valid] = np.nan
+    return msd
+
+
+def mean_square_displacement(positions, max_lag = None):
+    """
+        Time averaged 2D MSD of one track, for the lags 1..max_lag.
+        positions is (N, 2) or (N, 3), z is ignored like in Molecule._square_displacement_vector.
+    """
+    positions = np.asarray(positions, dtype = np.float64)[:, :2]
+    if max_lag is None:
+        max_lag = len(positions) - 1
+    if max_lag < 1:
+        return np.zeros(0)
+    positions = positions - positions.mean(axis = 0)
+    return _padded_mean_square_displacements(positions[np.newaxis], np.array([len(positions)]), max_lag)[0]
+
+
+def mean_square_displacements(store, max_lag, molecules = None, batch_size = DEFAULT_BATCH_SIZE):
+    """
+        Time averaged MSD of many tracks of a TrajectoryStore, for the lags 1..max_lag.
+        Returns a (number_of_molecules, max_lag) array, NaN where the lag is not shorter than the track.
+        Tracks are sorted by length and processed in batches of similar lengths, so little
+        is wasted on padding. A batch holds about batch_size padded positions.
+    """
+    store._check_not_coarse()
+    if molecules is None:
+        molecules = np.arange(len(store))
+    molecules = np.asarray(molecules)
+    lengths = store.lengths[molecules]
+    result = np.full([len(molecules), max_lag], np.nan)
+
+    order = np.argsort(lengths, kind = 'stable')
+    sorted_lengths = lengths[order]
+    start = 0
+    while start < len(order):
+        # Lengths are sorted, so the padded size of [start, end) grows with end
+        padded_sizes = np.arange(1, len(order) - start + 1) * sorted_lengths[start:]
+        end = start + max(1, np.searchsorted(padded_sizes, batch_size, side = 'right'))
+        batch = order[start:end]
+        start = end
+        batch_lengths = lengths[batch]
+        length = int(batch_lengths.max())
+        steps = np.arange(length)[np.newaxis, :]
+        inside = steps < batch_lengths[:, np.newaxis]
+        rows = np.where(inside, store.offsets[molecules[batch]][:, np.newaxis] + steps, 0)
+        tracks = store.positions[rows, :2].astype(np.float64)
+        tracks -= (tracks * inside[:, :, np.newaxis]).sum(axis = 1, keepdims = True) / \
+                        batch_lengths[:, np.newaxis, np.newaxis]
+        tracks *= inside[:, :, np.newaxis]
+        result[batch] = _padded_mean_square_displacements(tracks, batch_lengths, max_lag)
+    return result
+
+
+def ensemble_mean_square_displacement(store, max_lag, molecules = None, batch_size = DEFAULT_BATCH_SIZE):
+    """
+        Ensemble average of the time averaged MSDs, for the lags 1..max_lag.
+        Every lag is averaged over the tracks that are long enough for it.
+    """
+    msds = mean_square_displacements(store, max_lag, molecules, batch_size)
+    counts = np.sum(~np.isnan(msds), axis = 0)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return np.nansum(msds, axis = 0) / counts
@@ -2,21 +2,19 @@ import numpy as np
 from itertools import chain
 from matplotlib import pyplot as plt
 from scipy import optimize
+from fused_simulation import FusedSimulation
 
-class TwoSpeciesSimulation:
+class TwoSpeciesSimulation(FusedSimulation):
+    """
+        Two (or more) species, simulated together by FusedSimulation
+    """
     def __init__(self, *subsimulations):
-        self.subsimulations = subsimulations
+        self._set_simulations(list(subsimulations))
+        self.run()
 
-        self._check_simulations()
-        self.step_time_in_seconds = self.subsimulations[0].step_time_in_seconds
-
-        for simulation in self.subsimulations:
-            simulation.run()
-
-
-    def _check_simulations(self):
-        if len(set([sim.step_time_in_seconds for sim in self.subsimulations])) != 1:
-            raise Exception("All simulations need to have the same step_time_in_seconds")
+    @property
+    def subsimulations(self):
+        return self.simulations
 
     def get_msds(self, number_of_steps):
         #at the moment, assumes 2 particle types
@@ -0,0 +1,143 @@
+import multiprocessing
+import numpy as np
+from renderer import FrameRenderer, DEFAULT_TILE_SIZE
+from psf_kernels import GAUSSIAN_PSF
+from density_rendering import WINDOW_RENDER_MODE, DEFAULT_TOLERANCE
+from trajectory_store import TrajectoryStore, SubframeIndex
+
+TASKS_PER_WORKER = 4
+
+# Set in every worker process by _init_worker
+_worker = {}
+
+
+def share_array(array):
+    """
+        Copies an array into shared memory, returns something that can be passed
+        to worker processes and turned back into an array with shared_to_array
+    """
+    array = np.ascontiguousarray(array)
+    raw = multiprocessing.RawArray('b', max(array.nbytes, 1))
+    shared_to_array((raw, array.dtype.str, array.shape))[...] = array
+    return raw, array.dtype.str, array.shape
+
+
+def shared_to_array(shared):
+    raw, dtype, shape = shared
+    return np.frombuffer(raw, dtype = dtype, count = int(np.prod(shape))).reshape(shape)
+
+
+def _share_store(store, number_of_subframes):
+    index = store.get_subframe_index(number_of_subframes)
+    arrays = {name : share_array(getattr(store, name))
+                for name in ['positions', 'offsets', 'start_frames', 'species',
+                             'diffusion_coefficients', 'intensities', 'end_subframes']}
+    arrays['index_rows'] = share_array(index.rows)
+    arrays['index_offsets'] = share_array(index.offsets)
+    scalars = {'screen_size_in_um' : store.screen_size_in_um,
+               'screen_depth_in_um' : store.screen_depth_in_um,
+               'step_time_in_seconds' : store.step_time_in_seconds,
+               'subframes_per_position' : store.subframes_per_position}
+    return arrays, scalars
+
+
+def _unshare_store(shared_store):
+    arrays, scalars = shared_store
+    arrays = {name : shared_to_array(shared) for name, shared in arrays.items()}
+    store = TrajectoryStore.from_arrays(arrays['positions'], arrays['offsets'],
+                                        arrays['start_frames'], arrays['species'],
+                                        diffusion_coefficients = arrays['diffusion_coefficients'],
+                                        intensities = arrays['intensities'],
+                                        end_subframes = arrays['end_subframes'],
+                                        **scalars)
+    store.set_subframe_index(SubframeIndex.from_arrays(arrays['index_rows'],
+                                                       arrays['index_offsets']))
+    return store
+
+
+def _init_worker(shared_stores, renderer_parameters, shared_output):
+    _worker['renderer'] = FrameRenderer([_unshare_store(s) for s in shared_stores],
+                                        **renderer_parameters)
+    _worker['output'] = shared_to_array(shared_output)
+
+
+def _render_frames(task):
+    first_slot, frame_indices = task
+    renderer, output = _worker['renderer'], _worker['output']
+    for slot, frame_index in enumerate(frame_indices, first_slot):
+        renderer.render_frame(frame_index, out = output[slot])
+
+
+class ParallelFrameRenderer(FrameRenderer):
+    """
+        FrameRenderer that renders on a pool of processes.
+        The trajectories (and their subframe index) are copied once into shared memory,
+        the workers render their frames straight into a shared output stack of batch_size
+        frames, and every frame has a fixed slot, so the output order is deterministic.
+        Use as a context manager, or call close() to stop the workers.
+    """
+    def __init__(self, stores,
+                 number_of_frames,
+                 number_of_subframes_per_frame,
+                 pixel_length_in_um,
+                 sigma_x_in_um,
+                 sigma_y_in_um,
+                 screen_size,
+                 dtype = np.float64,
+                 number_of_workers = None,
+                 batch_size = None,
+                 tile_size = DEFAULT_TILE_SIZE,
+                 psf = GAUSSIAN_PSF,
+                 subpixel_steps = None,
+                 render_mode = WINDOW_RENDER_MODE,
+                 fft_tolerance = DEFAULT_TOLERANCE,
+                 blur_tolerance = None):
+        super().__init__(stores, number_of_frames, number_of_subframes_per_frame,
+                         pixel_length_in_um, sigma_x_in_um, sigma_y_in_um,
+                         screen_size, dtype, tile_size,
+                         psf = psf, subpixel_steps = subpixel_steps,
+                         render_mode = render_mode, fft_tolerance = fft_tolerance,
+                         blur_tolerance = blur_tolerance)
+        if number_of_workers is None:
+            number_of_workers = multiprocessing.cpu_count()
+        if batch_size is None:
+            batch_size = number_of_frames
+        self.number_of_workers = number_of_workers
+        self.batch_size = max(1, min(batch_size, number_of_frames))
+        self._pool = None
+
+    def _start(self):
+        if self._pool is not None:
+            return
+        number_of_subframes = self.number_of_frames * self.number_of_subframes_per_frame
+        shared_stores = [_share_store(store, number_of_subframes) for store in self.stores]
+        shared_output = share_array(np.zeros((self.batch_size,) + self.frame_shape, dtype = self.dtype))
+        self._output = shared_to_array(shared_output)
+        self._pool = multiprocessing.Pool(self.number_of_workers,
+                                          initializer = _init_worker,
+                                          initargs = (shared_stores,
+                                                      FrameRenderer.parameters(self),
+                                                      shared_output))
+
+    def close(self):
+        super().close()
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def render(self, frame_indices = None, progress = lambda x:x, out = None):
+        if frame_indices is None:
+            frame_indices = range(self.number_of_frames)
+        frame_indices = list(frame_indices)
+        self._start()
+
+        frames = self._output_frames(out, len(frame_indices))
+        batch_starts = range(0, len(frame_indices), self.batch_size)
+        for batch_start in progress(batch_starts):
+            batch = frame_indices[batch_start:batch_start + self.batch_size]
+            task_size = max(1, -(-len(batch) // (TASKS_PER_WORKER * self.number_of_workers)))
+            tasks = [(slot, batch[slot:slot + task_size]) for slot in range(0, len(batch), task_size)]
+            self._pool.map(_render_frames, tasks)
+            frames[batch_start:batch_start + len(batch)] = self._output[:len(batch)]
+        return frames
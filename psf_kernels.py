@@ -0,0 +1,98 @@
+import numpy as np
+from scipy.special import erf
+
+GAUSSIAN_PSF = 'gaussian'
+# The gaussian averaged over the area of the pixel (the erf version of Simulation.PSF)
+PIXEL_INTEGRATED_PSF = 'pixel_integrated'
+PSF_TYPES = [GAUSSIAN_PSF, PIXEL_INTEGRATED_PSF]
+
+DEFAULT_SUBPIXEL_STEPS = 32
+
+# Largest slope of exp(-u^2 / 2) (at u = 1)
+MAXIMUM_GAUSSIAN_SLOPE = np.exp(-.5)
+
+
+def round_half_away_from_zero(x):
+    """
+        Same rounding as Go's math.Round, so the windows match animation.go
+    """
+    return np.sign(x) * np.floor(np.abs(x) + .5)
+
+
+def psf_profile(distance_in_um, sigma_in_um, pixel_length_in_um, psf = GAUSSIAN_PSF):
+    """
+        1-D PSF at a distance from the emitter, with a peak of 1 like the Go PSF.
+        PIXEL_INTEGRATED_PSF is the mean of the gaussian over the pixel, which tends
+        to the gaussian for small pixels.
+    """
+    if psf == GAUSSIAN_PSF:
+        return np.exp(-distance_in_um ** 2 / (2 * sigma_in_um ** 2))
+    if psf == PIXEL_INTEGRATED_PSF:
+        scale = np.sqrt(2) * sigma_in_um
+        half_pixel = pixel_length_in_um / 2
+        return (erf((distance_in_um + half_pixel) / scale) - erf((distance_in_um - half_pixel) / scale)) * \
+                    np.sqrt(np.pi / 2) * sigma_in_um / pixel_length_in_um
+    raise Exception("Unknown PSF {}, expected one of {}".format(psf, PSF_TYPES))
+
+
+class ExactKernel:
+    """
+        1-D kernels of a window of 2 * half_width pixels around the nearest pixel of every emitter,
+        evaluated for the exact position of the emitter
+    """
+    def __init__(self, sigma_in_um, pixel_length_in_um, half_width, psf = GAUSSIAN_PSF):
+        self.sigma_in_um = sigma_in_um
+        self.pixel_length_in_um = pixel_length_in_um
+        self.half_width = half_width
+        self.psf = psf
+
+    def __call__(self, centers):
+        """
+            Returns the nearest pixel of every emitter and its (number_of_emitters, 2 * half_width) kernel
+        """
+        nearest_pixel = round_half_away_from_zero(centers / self.pixel_length_in_um).astype(np.int64)
+        pixels = nearest_pixel[:, np.newaxis] + np.arange(-self.half_width, self.half_width)
+        distance = pixels * self.pixel_length_in_um - centers[:, np.newaxis]
+        return nearest_pixel, psf_profile(distance, self.sigma_in_um, self.pixel_length_in_um, self.psf)
+
+    def error_bound(self):
+        return 0.
+
+
+class KernelBank(ExactKernel):
+    """
+        Precomputed kernels for subpixel_steps + 1 offsets of the emitter from its nearest pixel
+        (-1/2 .. 1/2 pixel), so a kernel is a table lookup instead of 2 * half_width exp calls.
+        The offset of every emitter is rounded to the nearest step, which moves the emitter
+        by at most half a step. Both profiles have a slope of at most exp(-1/2) / sigma,
+        so every kernel value is off by at most
+            exp(-1/2) * pixel_length / (2 * subpixel_steps * sigma)
+        (error_bound), and a pixel of the 2-D PSF by at most the sum of the x and y bounds
+        times the intensity.
+    """
+    def __init__(self, sigma_in_um, pixel_length_in_um, half_width, psf = GAUSSIAN_PSF,
+                 subpixel_steps = DEFAULT_SUBPIXEL_STEPS):
+        ExactKernel.__init__(self, sigma_in_um, pixel_length_in_um, half_width, psf)
+        self.subpixel_steps = subpixel_steps
+        offsets = np.arange(subpixel_steps + 1) / subpixel_steps - .5
+        pixels = np.arange(-half_width, half_width)
+        distance = (pixels[np.newaxis, :] - offsets[:, np.newaxis]) * pixel_length_in_um
+        self.kernels = psf_profile(distance, sigma_in_um, pixel_length_in_um, psf)
+
+    def __call__(self, centers):
+        scaled = centers / self.pixel_length_in_um
+        nearest_pixel = round_half_away_from_zero(scaled)
+        steps = np.rint((scaled - nearest_pixel + .5) * self.subpixel_steps).astype(np.int64)
+        return nearest_pixel.astype(np.int64), self.kernels[np.clip(steps, 0, self.subpixel_steps)]
+
+    def error_bound(self):
+        return MAXIMUM_GAUSSIAN_SLOPE * self.pixel_length_in_um / (2 * self.subpixel_steps * self.sigma_in_um)
+
+
+def make_kernel(sigma_in_um, pixel_length_in_um, half_width, psf = GAUSSIAN_PSF, subpixel_steps = None):
+    """
+        A KernelBank, or an ExactKernel when subpixel_steps is None
+    """
+    if subpixel_steps is None:
+        return ExactKernel(sigma_in_um, pixel_length_in_um, half_width, psf)
+    return KernelBank(sigma_in_um, pixel_length_in_um, half_width, psf, subpixel_steps)
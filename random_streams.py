@@ -0,0 +1,60 @@
+import numpy as np
+
+SEED_KEY = 'seed'
+
+PLACEMENT_STREAM = 0
+MOLECULES_STREAM = 1
+NOISE_STREAM = 2
+BIRTH_STREAM = 3
+
+# Every molecule uses exactly one Philox block (4 doubles) of the placement stream :
+# start frame, x, y, z
+PLACEMENT_DRAWS_PER_MOLECULE = 4
+
+
+class RandomStreams:
+    """
+        Hierarchy of independent counter-based (Philox) streams derived from one seed :
+            placement        - start frames and initial positions of all the molecules
+            molecule(i)      - the steps of molecule i
+            noise(frame)     - the camera noise of a frame
+            births           - the molecules of the steady state mode (see steady_state.py)
+        Every stream only depends on the seed and its own key, so any chunk of molecules
+        or frames can be regenerated on its own, in any process, with the same result.
+        seed = None draws fresh entropy, which is kept in self.seed so the run can be repeated.
+    """
+    def __init__(self, seed = None):
+        self.seed = np.random.SeedSequence(seed).entropy
+
+    def _generator(self, *key):
+        return np.random.Generator(np.random.Philox(np.random.SeedSequence(self.seed, spawn_key = key)))
+
+    def placement(self, first_molecule = 0):
+        """
+            The placement stream, positioned at the draws of first_molecule
+        """
+        bit_generator = np.random.Philox(np.random.SeedSequence(self.seed, spawn_key = (PLACEMENT_STREAM,)))
+        return np.random.Generator(bit_generator.advance(first_molecule))
+
+    def molecule(self, index):
+        return self._generator(MOLECULES_STREAM, int(index))
+
+    def noise(self, frame_index):
+        return self._generator(NOISE_STREAM, int(frame_index))
+
+    def births(self):
+        return self._generator(BIRTH_STREAM)
+
+
+def random_placement(streams, first_molecule, number_of_molecules,
+                     number_of_steps, screen_size_in_um, screen_depth_in_um):
+    """
+        Start frames and uniform initial positions (in the screen and the slab)
+        of molecules [first_molecule, first_molecule + number_of_molecules)
+    """
+    uniform = streams.placement(first_molecule).random([number_of_molecules,
+                                                        PLACEMENT_DRAWS_PER_MOLECULE])
+    start_frames = np.minimum(np.floor(uniform[:, 0] * number_of_steps).astype(np.int64),
+                              number_of_steps - 1)
+    positions = uniform[:, 1:] * [screen_size_in_um[0], screen_size_in_um[1], screen_depth_in_um]
+    return start_frames, positions
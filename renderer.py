@@ -0,0 +1,291 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from psf_kernels import round_half_away_from_zero, make_kernel, GAUSSIAN_PSF
+from density_rendering import DensityGrid, WINDOW_RENDER_MODE, FFT_RENDER_MODE, AUTOMATIC_RENDER_MODE, \
+                              RENDER_MODES, DEFAULT_TOLERANCE
+from motion_blur import merge_emitters
+
+NUMBER_OF_SIGMAS_IN_WINDOW = 5
+# 256 x 256 float64 tiles (512KB) stay in the L2 cache while their emitters are added
+DEFAULT_TILE_SIZE = 256
+
+
+def window_half_width(sigma_in_um, pixel_length_in_um):
+    return int(NUMBER_OF_SIGMAS_IN_WINDOW * (round_half_away_from_zero(sigma_in_um / pixel_length_in_um) + 1))
+
+
+class FrameRenderer:
+    """
+        Renders frames from trajectory stores, in process and without any text serialization.
+        Matches add_molecule_at_position_to_frame in Animation/animation.go :
+        every emitter adds a gaussian (peak value = intensity) truncated to a window
+        of 5 * (round(sigma / pixel_length) + 1) pixels around its nearest pixel.
+        Frames are indexed [x][y], same as the Go Frames.
+        The PSF is separable, so every emitter only needs two 1-D kernels, and all
+        the emitters of a tile are scatter-added together with a single bincount.
+        Frames are split in tile_size x tile_size tiles, every emitter is binned to the
+        tiles its window (the 5 sigma halo) touches, and the tiles are rendered independently
+        into the frame, on number_of_threads threads. The work per pixel does not grow
+        with the size of the frame.
+        psf = PIXEL_INTEGRATED_PSF averages the gaussian over every pixel instead, and with
+        subpixel_steps the 1-D kernels come from a precomputed KernelBank (see psf_kernels.py)
+        instead of being evaluated for every emitter. quantization_error_bound() bounds
+        the error this adds to a pixel, per unit of intensity.
+        Dense frames are cheaper to render on a DensityGrid (FFT_RENDER_MODE, see density_rendering.py),
+        within fft_tolerance of the windows. AUTOMATIC_RENDER_MODE picks the cheaper of the two
+        for every frame, from its number of emitters. Both are approximations and have to be asked for,
+        the default WINDOW_RENDER_MODE is exact.
+        With a blur_tolerance, the subframe positions of every molecule in a frame are merged
+        into as few weighted emitters as its path allows (see motion_blur.py), within blur_tolerance
+        per unit of intensity. A molecule that hardly moves during the exposure costs one emitter
+        instead of number_of_subframes_per_frame. None renders every subframe.
+    """
+    def __init__(self, stores,
+                 number_of_frames,
+                 number_of_subframes_per_frame,
+                 pixel_length_in_um,
+                 sigma_x_in_um,
+                 sigma_y_in_um,
+                 screen_size,
+                 dtype = np.float64,
+                 tile_size = DEFAULT_TILE_SIZE,
+                 number_of_threads = 1,
+                 psf = GAUSSIAN_PSF,
+                 subpixel_steps = None,
+                 render_mode = WINDOW_RENDER_MODE,
+                 fft_tolerance = DEFAULT_TOLERANCE,
+                 blur_tolerance = None):
+        if render_mode not in RENDER_MODES:
+            raise Exception("Unknown render mode {}, expected one of {}".format(render_mode, RENDER_MODES))
+        self.stores = list(stores)
+        self.number_of_frames = number_of_frames
+        self.number_of_subframes_per_frame = number_of_subframes_per_frame
+        self.pixel_length_in_um = pixel_length_in_um
+        self.sigma_x_in_um = sigma_x_in_um
+        self.sigma_y_in_um = sigma_y_in_um
+        self.screen_size = [int(screen_size[0]), int(screen_size[1])]
+        self.dtype = dtype
+        self.tile_size = int(tile_size)
+        self.number_of_threads = number_of_threads
+        self._threads = None
+
+        self.half_width_x = window_half_width(sigma_x_in_um, pixel_length_in_um)
+        self.half_width_y = window_half_width(sigma_y_in_um, pixel_length_in_um)
+
+        self.psf = psf
+        self.subpixel_steps = subpixel_steps
+        self.kernel_x = make_kernel(sigma_x_in_um, pixel_length_in_um, self.half_width_x, psf, subpixel_steps)
+        self.kernel_y = make_kernel(sigma_y_in_um, pixel_length_in_um, self.half_width_y, psf, subpixel_steps)
+
+        self.render_mode = render_mode
+        self.fft_tolerance = fft_tolerance
+        self.blur_tolerance = blur_tolerance
+        self.density_grid = None
+        if render_mode != WINDOW_RENDER_MODE:
+            self.density_grid = DensityGrid(self.screen_size, pixel_length_in_um, sigma_x_in_um, sigma_y_in_um,
+                                            self.half_width_x, self.half_width_y, psf, fft_tolerance)
+
+    def parameters(self):
+        """
+            Everything but the stores, as keyword arguments of the constructor
+        """
+        return {'number_of_frames' : self.number_of_frames,
+                'number_of_subframes_per_frame' : self.number_of_subframes_per_frame,
+                'pixel_length_in_um' : self.pixel_length_in_um,
+                'sigma_x_in_um' : self.sigma_x_in_um,
+                'sigma_y_in_um' : self.sigma_y_in_um,
+                'screen_size' : self.screen_size,
+                'dtype' : self.dtype,
+                'tile_size' : self.tile_size,
+                'psf' : self.psf,
+                'subpixel_steps' : self.subpixel_steps,
+                'render_mode' : self.render_mode,
+                'fft_tolerance' : self.fft_tolerance,
+                'blur_tolerance' : self.blur_tolerance}
+
+    def close(self):
+        if self._threads is not None:
+            self._threads.shutdown()
+            self._threads = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def frame_shape(self):
+        return tuple(self.screen_size)
+
+    def _output_frames(self, out, number_of_frames):
+        shape = (number_of_frames,) + self.frame_shape
+        if out is None:
+            return np.zeros(shape, dtype = self.dtype)
+        if out.shape != shape:
+            raise Exception("Expected an output of shape {}, got {}".format(shape, out.shape))
+        return out
+
+    def _emitters_in_store(self, store, frame_index):
+        """
+            Returns the rows of store.positions that are alive in the subframes of frame_index,
+            and the molecule each row belongs to
+        """
+        index = store.get_subframe_index(self.number_of_frames * self.number_of_subframes_per_frame)
+        first = frame_index * self.number_of_subframes_per_frame
+        rows = index.rows_in_subframes(first, first + self.number_of_subframes_per_frame)
+        return rows, store.molecule_ids_of_rows(rows)
+
+    def get_emitters(self, frame_index):
+        """
+            All the (x, y, intensity) of the frame, as three arrays
+        """
+        xs, ys, intensities = [], [], []
+        for store in self.stores:
+            rows, molecules = self._emitters_in_store(store, frame_index)
+            store_xs = store.positions[rows, 0]
+            store_ys = store.positions[rows, 1]
+            store_intensities = store.intensities[store.species[molecules]] * store.row_weights(rows)
+            if self.blur_tolerance is not None:
+                # Rows are in subframe order, a stable sort by molecule keeps every path in time order
+                order = np.argsort(molecules, kind = 'stable')
+                store_xs, store_ys, store_intensities = merge_emitters(store_xs[order], store_ys[order],
+                                                                       store_intensities[order], molecules[order],
+                                                                       self.sigma_x_in_um, self.sigma_y_in_um,
+                                                                       self.blur_tolerance)
+            xs.append(store_xs)
+            ys.append(store_ys)
+            intensities.append(store_intensities)
+        return np.concatenate(xs), np.concatenate(ys), np.concatenate(intensities)
+
+    def quantization_error_bound(self):
+        return self.kernel_x.error_bound() + self.kernel_y.error_bound()
+
+    def _kernels(self, kernel, centers, size, first_pixel = 0):
+        """
+            1-D PSF kernels of all the emitters along one axis, on the pixels
+            [first_pixel, first_pixel + size) (the screen, or a tile of it).
+            Returns the pixel indices relative to first_pixel (clipped into the range)
+            and the kernel values, which are zero for the pixels that fall outside it.
+        """
+        nearest_pixel, kernels = kernel(centers)
+        pixels = nearest_pixel[:, np.newaxis] + np.arange(-kernel.half_width, kernel.half_width) - first_pixel
+        inside = (pixels >= 0) & (pixels < size)
+        return np.clip(pixels, 0, size - 1), kernels * inside
+
+    def add_emitters_to_frame(self, frame, xs, ys, intensities, origin = (0, 0)):
+        """
+            Adds the emitters to frame, which covers the pixels from origin on
+            (the whole screen, or a tile of it)
+        """
+        if len(xs) == 0:
+            return frame
+        size_x, size_y = frame.shape
+        pixels_x, kernels_x = self._kernels(self.kernel_x, np.asarray(xs, dtype = np.float64), size_x, origin[0])
+        pixels_y, kernels_y = self._kernels(self.kernel_y, np.asarray(ys, dtype = np.float64), size_y, origin[1])
+
+        flat_indices = pixels_x[:, :, np.newaxis] * size_y + pixels_y[:, np.newaxis, :]
+        values = (intensities[:, np.newaxis] * kernels_x)[:, :, np.newaxis] * kernels_y[:, np.newaxis, :]
+        frame += np.bincount(flat_indices.ravel(), weights = values.ravel(),
+                             minlength = size_x * size_y).reshape(frame.shape)
+        return frame
+
+    def _tile_ranges(self, nearest_pixels, half_width, size):
+        """
+            First and last tile (inclusive) touched by the window of every emitter along one axis,
+            last < first when the window misses the screen
+        """
+        first = np.maximum(nearest_pixels - half_width, 0) // self.tile_size
+        last = np.minimum(nearest_pixels + half_width - 1, size - 1) // self.tile_size
+        last[(nearest_pixels + half_width <= 0) | (nearest_pixels - half_width >= size)] = -1
+        return first, last
+
+    def bin_emitters_by_tile(self, xs, ys):
+        """
+            Returns {(tile_x, tile_y) : indices of the emitters whose window touches the tile}.
+            Emitters near a tile border are in all the tiles they touch.
+        """
+        size_x, size_y = self.screen_size
+        nearest_x = round_half_away_from_zero(np.asarray(xs) / self.pixel_length_in_um).astype(np.int64)
+        nearest_y = round_half_away_from_zero(np.asarray(ys) / self.pixel_length_in_um).astype(np.int64)
+        first_x, last_x = self._tile_ranges(nearest_x, self.half_width_x, size_x)
+        first_y, last_y = self._tile_ranges(nearest_y, self.half_width_y, size_y)
+        count_x = np.maximum(last_x - first_x + 1, 0)
+        count_y = np.maximum(last_y - first_y + 1, 0)
+
+        # One entry per (emitter, tile) pair
+        counts = count_x * count_y
+        emitters = np.repeat(np.arange(len(counts)), counts)
+        pair = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        tiles_x = first_x[emitters] + pair // count_y[emitters]
+        tiles_y = first_y[emitters] + pair % count_y[emitters]
+
+        number_of_tiles_y = -(-size_y // self.tile_size)
+        tile_ids = tiles_x * number_of_tiles_y + tiles_y
+        order = np.argsort(tile_ids, kind = 'stable')
+        tile_ids, emitters = tile_ids[order], emitters[order]
+        if len(tile_ids) == 0:
+            return {}
+        starts = np.flatnonzero(np.r_[True, tile_ids[1:] != tile_ids[:-1]])
+        ends = np.r_[starts[1:], len(tile_ids)]
+        return {divmod(int(tile_ids[start]), number_of_tiles_y) : emitters[start:end]
+                    for start, end in zip(starts, ends)}
+
+    def _map(self, function, items):
+        if self.number_of_threads == 1:
+            return list(map(function, items))
+        if self._threads is None:
+            self._threads = ThreadPoolExecutor(self.number_of_threads)
+        return list(self._threads.map(function, items))
+
+    def render_frame(self, frame_index, out = None):
+        if out is None:
+            out = np.zeros(self.frame_shape, dtype = self.dtype)
+        else:
+            out[...] = 0
+        xs, ys, intensities = self.get_emitters(frame_index)
+        if self.render_mode == FFT_RENDER_MODE or \
+                (self.render_mode == AUTOMATIC_RENDER_MODE and self.density_grid.is_cheaper(len(xs))):
+            return self.density_grid.add_emitters_to_frame(out, xs, ys, intensities)
+
+        def render_tile(item):
+            (tile_x, tile_y), emitters = item
+            origin = (tile_x * self.tile_size, tile_y * self.tile_size)
+            # Tiles do not overlap, so the threads never write to the same pixels
+            tile = out[origin[0]:origin[0] + self.tile_size, origin[1]:origin[1] + self.tile_size]
+            self.add_emitters_to_frame(tile, xs[emitters], ys[emitters], intensities[emitters], origin)
+
+        self._map(render_tile, self.bin_emitters_by_tile(xs, ys).items())
+        return out
+
+    def render(self, frame_indices = None, progress = lambda x:x, out = None):
+        """
+            Renders the frames into a (number_of_frames, X, Y) array,
+            or in place into out (e.g. a slab of a memory mapped FrameStack, of any float dtype)
+        """
+        if frame_indices is None:
+            frame_indices = range(self.number_of_frames)
+        frame_indices = list(frame_indices)
+        frames = self._output_frames(out, len(frame_indices))
+        for idx, frame_index in enumerate(progress(frame_indices)):
+            self.render_frame(frame_index, out = frames[idx])
+        return frames
+
+    def iter_batches(self, batch_size, frame_indices = None):
+        """
+            Renders the frames batch_size at a time, yielding (frame_indices, frames) pairs,
+            so only one batch has to be in memory
+        """
+        if frame_indices is None:
+            frame_indices = range(self.number_of_frames)
+        frame_indices = list(frame_indices)
+        for start in range(0, len(frame_indices), batch_size):
+            batch = frame_indices[start:start + batch_size]
+            yield batch, self.render(batch)
+
+    def maximum_value_bound(self):
+        """
+            Upper bound on a pixel value coming from a single molecule :
+            a molecule that stays on a pixel for all the subframes of the frame
+        """
+        return self.number_of_subframes_per_frame * max(np.max(store.intensities) for store in self.stores)
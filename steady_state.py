@@ -0,0 +1,100 @@
+import numpy as np
+from scipy.special import ndtr
+
+# Mean of the positive part of a gaussian step, in units of the step size
+MEAN_POSITIVE_STEP = 1 / np.sqrt(2 * np.pi)
+
+
+def _mean_overlap(length, step_size):
+    """
+        E[(length - |step|)+] for a gaussian step : how much of a slab of that width
+        is still inside it after the step moved it
+    """
+    if step_size == 0:
+        return length
+    ratio = length / step_size
+    inside = 2 * ndtr(ratio) - 1
+    return length * inside - 2 * step_size * MEAN_POSITIVE_STEP * (1 - np.exp(-ratio ** 2 / 2))
+
+
+def _faces(screen_size_in_um, screen_depth_in_um):
+    """
+        (axis, area, width) of the three pairs of faces of the box
+    """
+    size_x, size_y = screen_size_in_um
+    return [(0, size_y * screen_depth_in_um, size_x),
+            (1, size_x * screen_depth_in_um, size_y),
+            (2, size_x * size_y, screen_depth_in_um)]
+
+
+def entry_rate(step_size, screen_size_in_um, screen_depth_in_um):
+    """
+        Mean number of molecules that enter the box (the screen times the slab) in one step,
+        per unit of concentration outside of it. Through a pair of faces of area A, a width L
+        apart, it is A * (L - E[(L - |step|)+]). Steps that cross two faces at once
+        (near the edges of the box) are neglected, they are O(step_size^2).
+    """
+    return sum(area * (width - _mean_overlap(width, step_size))
+               for _, area, width in _faces(screen_size_in_um, screen_depth_in_um))
+
+
+def steady_state_placement(streams, mean_number_of_emitters, number_of_steps, step_size,
+                           screen_size_in_um, screen_depth_in_um):
+    """
+        Start frames and initial positions of a steady state population : the box is part
+        of an infinite medium with mean_number_of_emitters molecules per box volume,
+        so it starts with a Poisson number of uniform molecules, and molecules enter
+        through the six faces as a Poisson process, at entry_rate per step.
+        A molecule that enters through a face has been at a uniform distance u
+        outside of it and made a step over u, so its depth in the box has a density
+        proportional to P(step > depth) : a step drawn from the positive steps weighted by
+        their length (Rayleigh), and a depth uniform within it. Entries deeper than
+        the box are dropped, which is what makes the rate A * (L - E[(L - |step|)+]).
+        Molecules are ordered by start frame, all the draws come from streams.births().
+        Returns start_frames and positions, like random_placement.
+    """
+    generator = streams.births()
+    size_x, size_y = screen_size_in_um
+    volume = size_x * size_y * screen_depth_in_um
+    concentration = mean_number_of_emitters / volume
+
+    number_of_initial = generator.poisson(mean_number_of_emitters)
+    start_frames = [np.zeros(number_of_initial, dtype = np.int64)]
+    positions = [generator.random([number_of_initial, 3]) * [size_x, size_y, screen_depth_in_um]]
+
+    if number_of_steps > 1 and step_size > 0:
+        box = np.array([size_x, size_y, screen_depth_in_um], dtype = np.float64)
+        for axis, area, width in _faces(screen_size_in_um, screen_depth_in_um):
+            for side in [0, 1]:
+                number_of_candidates = generator.poisson(concentration * area * step_size * MEAN_POSITIVE_STEP *
+                                                         (number_of_steps - 1))
+                steps = step_size * np.sqrt(-2 * np.log1p(-generator.random(number_of_candidates)))
+                depths = generator.random(number_of_candidates) * steps
+                face_positions = generator.random([number_of_candidates, 3]) * box
+                face_start_frames = generator.integers(1, number_of_steps, number_of_candidates)
+                entered = (depths > 0) & (depths < width)
+                face_positions[:, axis] = depths if side == 0 else width - depths
+                start_frames.append(face_start_frames[entered])
+                positions.append(face_positions[entered])
+
+    start_frames = np.concatenate(start_frames)
+    positions = np.concatenate(positions)
+    order = np.argsort(start_frames, kind = 'stable')
+    return start_frames[order], positions[order]
+
+
+def steady_state_report(store, number_of_steps, target_mean_number_of_emitters = None):
+    """
+        Achieved mean number of in-frame emitters per subframe (and per um^2 of the screen)
+        and the distribution of the track lengths, in subframes
+    """
+    ends = np.minimum(store.end_subframes, number_of_steps)
+    track_lengths = np.maximum(ends - store.start_frames, 0)
+    mean_number_of_emitters = track_lengths.sum() / number_of_steps
+    return {'target_mean_number_of_emitters' : target_mean_number_of_emitters,
+            'mean_number_of_emitters' : mean_number_of_emitters,
+            'emitters_per_um2' : mean_number_of_emitters / np.prod(store.screen_size_in_um),
+            'number_of_molecules' : len(store),
+            'mean_track_length' : track_lengths.mean() if len(store) else 0.,
+            'track_lengths' : track_lengths,
+            'track_length_counts' : np.bincount(track_lengths)}
@@ -0,0 +1,146 @@
+import json
+import multiprocessing
+import os
+from itertools import product
+import numpy as np
+from simulation import Simulation
+from multispecies_simulation import TwoSpeciesSimulation
+from random_streams import SEED_KEY
+
+POINT_KEY = 'point'
+REPLICATE_KEY = 'replicate'
+RESULT_KEY = 'result'
+ERROR_KEY = 'error'
+
+
+def read_parameters(filename):
+    with open(filename) as f:
+        return json.loads(f.read())
+
+
+def estimate_diffusion_coefficient(simulation):
+    """
+        Default estimator : the mean square step estimate of approximate_diffusion_ceofficient
+    """
+    slopes = simulation._get_diffusion_coefficient_slopes()
+    return {'diffusion_coefficient' : np.mean(slopes) / 2 / simulation.step_time_in_seconds / 2,
+            'number_of_steps' : len(slopes)}
+
+
+def _axis_name(key):
+    """
+        Axes are a parameter key (applied to every setup) or a (setup_index, key) pair
+    """
+    if isinstance(key, tuple):
+        return "{}:{}".format(*key)
+    return key
+
+
+def _point_parameters(setups, point):
+    all_parameters = [dict(parameters) for parameters in setups]
+    for key, value in point:
+        if isinstance(key, tuple):
+            all_parameters[key[0]][key[1]] = value
+        else:
+            for parameters in all_parameters:
+                parameters[key] = value
+    return all_parameters
+
+
+def _run_point(task):
+    setups, point, point_index, replicate, seed, estimator = task
+    row = {POINT_KEY : {_axis_name(key) : value for key, value in point},
+           REPLICATE_KEY : replicate,
+           SEED_KEY : [seed, point_index, replicate]}
+    try:
+        simulations = []
+        for setup_index, parameters in enumerate(_point_parameters(setups, point)):
+            parameters[SEED_KEY] = [seed, point_index, replicate, setup_index]
+            simulation = Simulation(parameters)
+            simulation.run(verbose = False)
+            simulations.append(simulation)
+
+        if len(simulations) == 1:
+            result = estimator(simulations[0])
+        else:
+            result = estimator(TwoSpeciesSimulation(*simulations))
+        row[RESULT_KEY] = np.asarray(result).tolist() if not isinstance(result, dict) else \
+                            {k : np.asarray(v).tolist() for k, v in result.items()}
+    except Exception as e:
+        row[ERROR_KEY] = "{}: {}".format(type(e).__name__, e)
+    return row
+
+
+def _row_key(point, replicate):
+    return json.dumps([sorted(point.items()), replicate])
+
+
+def read_sweep_results(results_filename, include_errors = False):
+    """
+        The rows written by run_sweep, one dictionary per (point, replicate)
+    """
+    if not os.path.exists(results_filename):
+        return []
+    rows = []
+    with open(results_filename) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            row = json.loads(line)
+            if include_errors or ERROR_KEY not in row:
+                rows.append(row)
+    return rows
+
+
+def run_sweep(setup_filenames, axes, results_filename,
+              estimator = estimate_diffusion_coefficient,
+              replicates = 1,
+              number_of_workers = None,
+              seed = 0,
+              progress = lambda x:x):
+    """
+        Runs a simulation for every point of the grid of axes, replicates times, on a process pool.
+            setup_filenames - a setup JSON (e.g. "setups/parameters_quick_slow_diffusion.json"),
+                              or a list of them to simulate several species together
+            axes            - {key : values}. A key is a parameter key applied to every setup,
+                              or a (setup_index, key) pair for one species
+            estimator       - called with the Simulation (or TwoSpeciesSimulation for several setups),
+                              returns a number, an array or a dictionary of them.
+                              It has to be picklable (defined at the top level of a module)
+        Every replicate of every point gets its own seed [seed, point_index, replicate], so
+        results do not depend on the number of workers.
+        Results are appended to results_filename (JSON lines) as soon as they are ready,
+        and points already in the file are skipped, so an interrupted sweep can be restarted.
+        Points that raised are written with an error and retried on restart.
+    """
+    if isinstance(setup_filenames, str):
+        setup_filenames = [setup_filenames]
+    setups = [read_parameters(filename) for filename in setup_filenames]
+
+    keys = list(axes)
+    # Plain python values, so the points can be written to JSON and compared with the file
+    values = [[np.asarray(value).tolist() for value in axes[key]] for key in keys]
+    points = [list(zip(keys, point_values)) for point_values in product(*values)]
+
+    done = set(_row_key(row[POINT_KEY], row[REPLICATE_KEY])
+                    for row in read_sweep_results(results_filename))
+    tasks = [(setups, point, point_index, replicate, seed, estimator)
+                for point_index, point in enumerate(points)
+                for replicate in range(replicates)
+                if _row_key({_axis_name(k) : v for k, v in point}, replicate) not in done]
+
+    if not tasks:
+        return read_sweep_results(results_filename)
+
+    pool = multiprocessing.Pool(number_of_workers)
+    try:
+        with open(results_filename, "a") as f:
+            for row in progress(pool.imap_unordered(_run_point, tasks)):
+                f.write(json.dumps(row) + "\n")
+                f.flush()
+    finally:
+        pool.close()
+        pool.join()
+
+    return read_sweep_results(results_filename)
@@ -0,0 +1,50 @@
+import json
+import os
+import sys
+import pytest
+
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The modules live at the root of the repository, next to the notebooks that import them
+sys.path.insert(0, ROOT_DIRECTORY)
+
+from simulation import Simulation, NUMBER_OF_MOLECULES_KEY, NUMBER_OF_FRAMES_KEY, TOTAL_TIME_IN_SECONDS_KEY, \
+                       NUMBER_OF_SUBFRAMES_PER_FRAME_KEY, SCREEN_SIZE_IN_PIXELS_X_KEY, SCREEN_SIZE_IN_PIXELS_Y_KEY
+from random_streams import SEED_KEY
+
+# The PSF, pixel size and diffusion of the shipped tracking setup
+SETUP_FILENAME = os.path.join(ROOT_DIRECTORY, 'setups', 'for_tracking.json')
+# On a small screen and a few frames, tests override what they need
+SMALL_SETUP = {NUMBER_OF_MOLECULES_KEY : 100,
+               NUMBER_OF_FRAMES_KEY : 20,
+               TOTAL_TIME_IN_SECONDS_KEY : 1,
+               NUMBER_OF_SUBFRAMES_PER_FRAME_KEY : 10,
+               SCREEN_SIZE_IN_PIXELS_X_KEY : 64,
+               SCREEN_SIZE_IN_PIXELS_Y_KEY : 64,
+               SEED_KEY : 1}
+
+
+@pytest.fixture
+def setup_parameters():
+    """
+        parameters(overrides) : the parameters of the small setup, updated with the overrides dictionary
+    """
+    def parameters(overrides = None):
+        with open(SETUP_FILENAME) as f:
+            parameters = json.load(f)
+        parameters.update(SMALL_SETUP)
+        parameters.update(overrides or {})
+        return parameters
+    return parameters
+
+
+@pytest.fixture
+def setup_simulation(setup_parameters):
+    """
+        simulation(overrides, run = True) : a Simulation of setup_parameters(overrides), already run
+    """
+    def simulation(overrides = None, run = True):
+        simulation = Simulation(setup_parameters(overrides))
+        if run:
+            simulation.run(verbose = False)
+        return simulation
+    return simulation
@@ -0,0 +1,114 @@
+import os
+import time
+import numpy as np
+import pytest
+import simulation as simulation_module
+from simulation import Simulation
+from random_streams import SEED_KEY
+from cache import SimulationCache, cached_render, code_files, REPOSITORY_DIRECTORY, FRAMES_EXTENSION
+
+
+class BatchRenderer:
+    """
+        Stands in for a FrameRenderer with two frames
+    """
+    number_of_frames = 2
+    frame_shape = (3, 4)
+    dtype = np.float64
+
+    def iter_batches(self, batch_size):
+        for start in range(0, self.number_of_frames, batch_size):
+            frame_indices = list(range(start, min(start + batch_size, self.number_of_frames)))
+            yield frame_indices, np.ones((len(frame_indices),) + self.frame_shape) * np.array(frame_indices)[:, None, None]
+
+
+class CountingRenderer:
+    """
+        Stands in for a FrameRenderer, counts the renders
+    """
+    def __init__(self):
+        self.number_of_renders = 0
+
+    def render(self, progress = lambda x:x):
+        self.number_of_renders += 1
+        return np.arange(24, dtype = np.float64).reshape(2, 3, 4)
+
+
+def test_cached_render_returns_writable_arrays_on_a_miss_and_a_hit(tmp_path):
+    cache = SimulationCache(str(tmp_path))
+    renderer = CountingRenderer()
+    key = cache.key('frames')
+
+    miss = cached_render(cache, key, renderer)
+    hit = cached_render(cache, key, renderer)
+    assert renderer.number_of_renders == 1
+    for frames in [miss, hit]:
+        assert type(frames) is np.ndarray
+        assert frames.flags.writeable
+    assert np.array_equal(miss, hit)
+
+    hit[0] = -1
+    assert np.array_equal(cached_render(cache, key, renderer), miss)
+
+
+def test_the_code_version_covers_every_module_of_the_simulations():
+    files = [os.path.relpath(filename, REPOSITORY_DIRECTORY) for filename in code_files()]
+    for module in ['simulation', 'fused_simulation', 'trajectory_engine', 'renderer', 'density_rendering',
+                   'parallel_rendering', 'go_renderer', 'steady_state', 'camera']:
+        assert module + '.py' in files
+    assert all(not filename.startswith('..') for filename in files)
+
+
+def cached_simulation(setup_parameters, cache, seed = 1):
+    simulation = Simulation(setup_parameters({SEED_KEY : seed}))
+    simulation.cache = cache
+    return simulation
+
+
+def test_a_seeded_simulation_is_loaded_from_the_cache(tmp_path, setup_parameters, monkeypatch):
+    cache = SimulationCache(str(tmp_path))
+    simulation = cached_simulation(setup_parameters, cache)
+    simulation.run(verbose = False)
+    frames = simulation.create_frames()
+
+    def fail(*args, **kwargs):
+        raise Exception("Should come from the cache")
+    monkeypatch.setattr(simulation_module, 'move_molecules', fail)
+    monkeypatch.setattr(simulation_module.FrameRenderer, 'render', fail)
+    loaded = cached_simulation(setup_parameters, cache)
+    loaded.run(verbose = False)
+    assert np.array_equal(loaded.trajectory_store.positions, simulation.trajectory_store.positions)
+    assert np.array_equal(loaded.trajectory_store.offsets, simulation.trajectory_store.offsets)
+    assert np.array_equal(loaded.create_frames(), frames)
+
+    # Another seed is another entry
+    with pytest.raises(Exception, match = 'Should come from the cache'):
+        cached_simulation(setup_parameters, cache, seed = 2).run(verbose = False)
+
+
+def test_batches_are_cached_once_they_were_all_consumed(tmp_path):
+    cache = SimulationCache(str(tmp_path))
+    renderer = BatchRenderer()
+    key = cache.key('frames')
+    next(cache.cached_batches(key, renderer, 1))
+    assert cache.load_frames(key) is None
+    batches = list(cache.cached_batches(key, renderer, 1))
+    assert cache.load_frames(key) is not None
+    assert [frame_indices for frame_indices, _ in cache.cached_batches(key, renderer, 1)] == [[0], [1]]
+    assert np.array_equal(cache.load_frames(key), np.concatenate([frames for _, frames in batches]))
+    assert not [filename for filename in os.listdir(str(tmp_path)) if filename.endswith('.tmp')]
+
+
+def test_the_least_recently_used_entries_are_evicted(tmp_path):
+    array = np.zeros(1000)
+    cache = SimulationCache(str(tmp_path), maximum_bytes = 2.5 * array.nbytes)
+    keys = [cache.key('entry', index) for index in range(3)]
+    for age, key in zip([200, 100], keys):
+        cache.save_frames(key, array)
+        # Older entries, whatever the resolution of the modification times
+        os.utime(cache._path(key, FRAMES_EXTENSION), (time.time() - age, time.time() - age))
+    # A hit makes the oldest entry the most recently used one
+    assert cache.load_frames(keys[0]) is not None
+    cache.save_frames(keys[2], array)
+    assert cache.load_frames(keys[1]) is None
+    assert cache.load_frames(keys[0]) is not None and cache.load_frames(keys[2]) is not None
@@ -0,0 +1,27 @@
+import numpy as np
+from renderer import FrameRenderer
+from density_rendering import FFT_RENDER_MODE
+from camera import CameraModel, DEFAULT_OFFSET
+from random_streams import RandomStreams
+
+
+def test_camera_counts_of_fft_rendered_frames(setup_simulation):
+    simulation = setup_simulation()
+    renderer = FrameRenderer([simulation.trajectory_store],
+                             simulation.number_of_frames,
+                             simulation.number_of_subframes_per_frame,
+                             simulation.pixel_length_in_um,
+                             simulation.sigma_x_noise_in_um,
+                             simulation.sigma_y_noise_in_um,
+                             simulation.screen_size,
+                             render_mode = FFT_RENDER_MODE)
+    frames = renderer.render()
+    counts = CameraModel(quantum_efficiency = 50.).apply(frames, range(len(frames)), RandomStreams(1))
+    assert counts.shape == frames.shape and counts.dtype == np.uint16
+    assert counts.max() > DEFAULT_OFFSET
+
+
+def test_camera_clips_round_off_below_zero():
+    frames = np.full((2, 8, 8), -3e-16)
+    counts = CameraModel().apply(frames, range(len(frames)), RandomStreams(1))
+    assert np.all(counts == DEFAULT_OFFSET)
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+from simulation import NUMBER_OF_MOLECULES_KEY, NUMBER_OF_FRAMES_KEY, NUMBER_OF_SUBFRAMES_PER_FRAME_KEY, RENDER_MODE_KEY
+from renderer import FrameRenderer
+from psf_kernels import GAUSSIAN_PSF, PIXEL_INTEGRATED_PSF
+from density_rendering import WINDOW_RENDER_MODE, FFT_RENDER_MODE, DEFAULT_TOLERANCE
+
+# Few molecules and one subframe per frame, so no pixel is lit by more than one emitter
+# and the per emitter error bound applies to the frames
+SPARSE_SETUP = {NUMBER_OF_MOLECULES_KEY : 10, NUMBER_OF_FRAMES_KEY : 10, NUMBER_OF_SUBFRAMES_PER_FRAME_KEY : 1}
+
+
+@pytest.mark.parametrize('psf', [GAUSSIAN_PSF, PIXEL_INTEGRATED_PSF])
+def test_fft_mode_is_within_the_error_bound_of_the_window_mode(setup_simulation, psf):
+    simulation = setup_simulation(SPARSE_SETUP)
+    args = [[simulation.trajectory_store],
+            simulation.number_of_frames,
+            simulation.number_of_subframes_per_frame,
+            simulation.pixel_length_in_um,
+            simulation.sigma_x_noise_in_um,
+            simulation.sigma_y_noise_in_um,
+            simulation.screen_size]
+    window_renderer = FrameRenderer(*args, psf = psf, render_mode = WINDOW_RENDER_MODE)
+    fft_renderer = FrameRenderer(*args, psf = psf, render_mode = FFT_RENDER_MODE, fft_tolerance = DEFAULT_TOLERANCE)
+
+    window_frames = window_renderer.render()
+    fft_frames = fft_renderer.render()
+    assert window_frames.max() > 0
+    error_bound = fft_renderer.density_grid.error_bound()
+    assert error_bound <= DEFAULT_TOLERANCE
+    assert np.abs(window_frames - fft_frames).max() <= error_bound
+
+
+def test_fft_mode_is_opt_in_and_never_negative(setup_simulation):
+    simulation = setup_simulation({NUMBER_OF_MOLECULES_KEY : 1000})
+    with simulation.get_renderer() as renderer:
+        assert renderer.render_mode == WINDOW_RENDER_MODE
+        assert renderer.density_grid is None
+
+    simulation = setup_simulation({NUMBER_OF_MOLECULES_KEY : 1000, RENDER_MODE_KEY : FFT_RENDER_MODE})
+    with simulation.get_renderer() as renderer:
+        assert renderer.render_mode == FFT_RENDER_MODE
+        frames = renderer.render()
+    assert frames.min() >= 0
@@ -0,0 +1,19 @@
+import numpy as np
+from simulation import SCREEN_SIZE_IN_PIXELS_X_KEY, SCREEN_SIZE_IN_PIXELS_Y_KEY
+from frame_stack import FrameStack, AXES
+
+# A screen that is not square, so the axes of the stack cannot be mixed up
+WIDE_SCREEN = {SCREEN_SIZE_IN_PIXELS_X_KEY : 64, SCREEN_SIZE_IN_PIXELS_Y_KEY : 32}
+
+
+def test_the_stack_is_indexed_frame_x_y_like_the_renderer(tmp_path, setup_simulation):
+    simulation = setup_simulation(WIDE_SCREEN)
+    filename = str(tmp_path / 'frames.npy')
+    stack = simulation.save_frame_stack(filename, batch_size = 7)
+    assert stack.shape == (simulation.number_of_frames, 64, 32)
+    assert stack.metadata['axes'] == AXES == 'TXY'
+
+    with simulation.get_renderer() as renderer:
+        frames = renderer.render()
+    assert frames.max() > 0
+    assert np.allclose(FrameStack(filename)[:], frames, rtol = 1e-6, atol = 1e-6)
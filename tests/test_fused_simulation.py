@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+from simulation import Simulation, NUMBER_OF_MOLECULES_KEY, NUMBER_OF_FRAMES_KEY, NUMBER_OF_SUBFRAMES_PER_FRAME_KEY, \
+                       SCREEN_SIZE_IN_PIXELS_X_KEY, SCREEN_SIZE_IN_PIXELS_Y_KEY, DIFFUSION_COEFFICIENT_KEY, \
+                       Z_DIRECTION_DEPTH_IN_UM_KEY, INTENSITY_KEY
+from random_streams import SEED_KEY
+from fused_simulation import FusedSimulation
+
+
+def species_parameters(setup_parameters, diffusion_coefficient, seed):
+    return setup_parameters({NUMBER_OF_MOLECULES_KEY : 200,
+                             NUMBER_OF_FRAMES_KEY : 50,
+                             NUMBER_OF_SUBFRAMES_PER_FRAME_KEY : 4,
+                             SCREEN_SIZE_IN_PIXELS_X_KEY : 256,
+                             SCREEN_SIZE_IN_PIXELS_Y_KEY : 256,
+                             DIFFUSION_COEFFICIENT_KEY : diffusion_coefficient,
+                             SEED_KEY : seed})
+
+
+def test_maximum_likelihood_recovers_both_diffusion_coefficients(setup_parameters):
+    simulation = FusedSimulation.from_simulations([Simulation(species_parameters(setup_parameters, 0.2, 1)),
+                                                   Simulation(species_parameters(setup_parameters, 2., 2))])
+    simulation.run(verbose = False)
+    sums, steps = simulation.get_summed_square_displacements(journey_length = 5)
+    assert len(sums) == len(steps) > 0
+    assert np.all(steps == 4)
+
+    slow, fast, _ = simulation.maximum_likelihood_diffusion_coefficients(journey_length = 5)
+    assert abs(slow - 0.2) < 0.05
+    assert abs(fast - 2.) < 0.5
+
+
+def test_species_in_different_slabs_are_moved_one_by_one(setup_parameters):
+    thin = species_parameters(setup_parameters, 1., 1)
+    thick = dict(species_parameters(setup_parameters, 1., 2), **{Z_DIRECTION_DEPTH_IN_UM_KEY : 2.})
+    simulation = FusedSimulation.from_simulations([Simulation(thin), Simulation(thick)])
+    simulation.run(verbose = False)
+
+    for parameters, species in [(thin, 0), (thick, 1)]:
+        alone = Simulation(parameters)
+        alone.run(verbose = False)
+        view = simulation.trajectory_store.species_view(species)
+        assert np.array_equal(view.positions, alone.trajectory_store.positions)
+        assert np.array_equal(view.offsets, alone.trajectory_store.offsets)
+    # Both slabs fit under the same PSF and pixels, so they still make one movie
+    assert simulation.create_frames().max() > 0
+
+    wider = dict(thick, **{SCREEN_SIZE_IN_PIXELS_X_KEY : 128})
+    simulation = FusedSimulation.from_simulations([Simulation(thin), Simulation(wider)])
+    simulation.run(verbose = False)
+    with pytest.raises(Exception, match = 'same screen_size to be rendered together'):
+        simulation.create_frames()
+
+
+def test_intensity_scales_the_frames_of_a_species(setup_parameters):
+    frames = []
+    for intensity in [1., 3.]:
+        simulation = Simulation(dict(species_parameters(setup_parameters, 1., 1), **{INTENSITY_KEY : intensity}))
+        simulation.run(verbose = False)
+        assert simulation.trajectory_store.intensities.tolist() == [intensity]
+        frames.append(simulation.create_frames())
+    assert frames[0].max() > 0
+    assert np.allclose(frames[1], 3 * frames[0])
@@ -0,0 +1,44 @@
+import os
+import numpy as np
+import pytest
+from simulation import NUMBER_OF_MOLECULES_KEY, NUMBER_OF_FRAMES_KEY, NUMBER_OF_SUBFRAMES_PER_FRAME_KEY
+from go_renderer import GoFrameRenderer, DEFAULT_LIBRARY_PATH
+from renderer import FrameRenderer
+from frame_stack import create_frame_stack
+
+# The library is a build product, see go_renderer.py
+pytestmark = pytest.mark.skipif(not os.path.exists(DEFAULT_LIBRARY_PATH),
+                                reason = "{} is not built".format(DEFAULT_LIBRARY_PATH))
+
+SMALL_MOVIE = {NUMBER_OF_MOLECULES_KEY : 200, NUMBER_OF_FRAMES_KEY : 12, NUMBER_OF_SUBFRAMES_PER_FRAME_KEY : 4}
+
+
+def test_go_frames_match_the_numpy_renderer(tmp_path, setup_simulation):
+    simulation = setup_simulation(SMALL_MOVIE)
+    args = [[simulation.trajectory_store],
+            simulation.number_of_frames,
+            simulation.number_of_subframes_per_frame,
+            simulation.pixel_length_in_um,
+            simulation.sigma_x_noise_in_um,
+            simulation.sigma_y_noise_in_um,
+            simulation.screen_size]
+    with FrameRenderer(*args) as renderer:
+        frames = renderer.render()
+    assert frames.max() > 0
+
+    with GoFrameRenderer(*args) as go_renderer:
+        go_frames = go_renderer.render()
+        assert go_frames.dtype == np.float32
+        assert np.allclose(go_frames, frames, rtol = 1e-5, atol = 1e-5)
+
+        # Runs of consecutive frames and single frames, in any order
+        frame_indices = [5, 6, 7, 0, 11, 2, 3]
+        assert np.allclose(go_renderer.render(frame_indices), frames[frame_indices], rtol = 1e-5, atol = 1e-5)
+
+        # Straight into a slab of a memory mapped stack, and into a float64 array
+        stack = create_frame_stack(str(tmp_path / 'frames.npy'), 4, go_renderer.frame_shape)
+        go_renderer.render(range(4, 8), out = stack)
+        assert np.array_equal(stack, go_frames[4:8])
+        out = np.full((2,) + go_renderer.frame_shape, -1.)
+        go_renderer.render([1, 2], out = out)
+        assert np.array_equal(out, go_frames[1:3])
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+from linking import link_tracks, link_localizations, NO_TRACK
+from localization import LOCALIZATION_DTYPE
+from maximum_likelihood import summed_square_displacements
+
+DIFFUSION_COEFFICIENT = 0.1
+FRAME_TIME_IN_SECONDS = 0.05
+# Per axis step of 0.1 um, molecules 3 um apart, which never come within reach of each other
+STEP_SIZE = np.sqrt(2 * DIFFUSION_COEFFICIENT * FRAME_TIME_IN_SECONDS)
+SPACING_IN_UM = 3.
+MAXIMUM_STEP_IN_UM = 6 * STEP_SIZE
+NUMBER_OF_FRAMES = 30
+SCREEN_SIZE_IN_UM = (30., 30.)
+
+
+def synthetic_localizations(seed = 0):
+    """
+        Localizations of molecules on a grid that diffuse from a random start frame to a random end frame,
+        shuffled, with the molecule of every localization
+    """
+    generator = np.random.default_rng(seed)
+    grid = np.arange(SPACING_IN_UM / 2, SCREEN_SIZE_IN_UM[0], SPACING_IN_UM)
+    starts = np.stack(np.meshgrid(grid, grid), axis = -1).reshape(-1, 2)
+    frames, positions, molecules = [], [], []
+    for molecule, start in enumerate(starts):
+        first, last = np.sort(generator.integers(0, NUMBER_OF_FRAMES, 2))
+        length = last - first + 2
+        steps = STEP_SIZE * generator.standard_normal((length - 1, 2))
+        frames.append(np.arange(first, first + length))
+        positions.append(start + np.r_[np.zeros((1, 2)), np.cumsum(steps, axis = 0)])
+        molecules.append(np.full(length, molecule))
+    frames, positions, molecules = np.concatenate(frames), np.concatenate(positions), np.concatenate(molecules)
+    order = generator.permutation(len(frames))
+    return frames[order], positions[order, 0], positions[order, 1], molecules[order]
+
+
+def assert_same_partition(track_ids, molecules):
+    """
+        Every molecule is one track and every track is one molecule
+    """
+    pairs = np.unique(np.stack([track_ids, molecules], axis = 1), axis = 0)
+    assert len(pairs) == len(np.unique(track_ids)) == len(np.unique(molecules))
+
+
+def test_recovers_the_synthetic_tracks():
+    frames, xs, ys, molecules = synthetic_localizations()
+    track_ids = link_tracks(frames, xs, ys, MAXIMUM_STEP_IN_UM)
+    assert np.all(track_ids != NO_TRACK)
+    assert_same_partition(track_ids, molecules)
+    # Tracks are numbered in the order they start
+    first_frames = [frames[track_ids == track].min() for track in range(track_ids.max() + 1)]
+    assert np.all(np.diff(first_frames) >= 0)
+
+
+def test_gap_closing_bridges_missed_frames():
+    frames, xs, ys, molecules = synthetic_localizations(1)
+    # Drop one localization of every other frame inside the tracks
+    firsts = np.array([frames[molecules == molecule].min() for molecule in molecules])
+    missed = ((frames - firsts) % 4 == 2)
+    frames, xs, ys, molecules = frames[~missed], xs[~missed], ys[~missed], molecules[~missed]
+
+    assert len(np.unique(link_tracks(frames, xs, ys, MAXIMUM_STEP_IN_UM))) > len(np.unique(molecules))
+    track_ids = link_tracks(frames, xs, ys, MAXIMUM_STEP_IN_UM, maximum_gap = 1)
+    assert_same_partition(track_ids, molecules)
+
+
+def test_assignment_maximizes_the_number_of_links():
+    # The nearest end of the point at x = 0.6 is the one at x = 1, but linking it there
+    # leaves the other end without a point within reach
+    frames = [0, 0, 1, 1]
+    xs = [0., 1., 0.6, 1.5]
+    ys = [0., 0., 0., 0.]
+    track_ids = link_tracks(frames, xs, ys, maximum_step_in_um = 0.7)
+    assert track_ids.tolist() == [0, 1, 0, 1]
+
+
+def test_linked_store_feeds_the_diffusion_fit():
+    frames, xs, ys, molecules = synthetic_localizations(2)
+    table = np.zeros(len(frames), dtype = LOCALIZATION_DTYPE)
+    table['frame'], table['x_in_um'], table['y_in_um'] = frames, xs, ys
+    track_ids, store = link_localizations(table, MAXIMUM_STEP_IN_UM, FRAME_TIME_IN_SECONDS, SCREEN_SIZE_IN_UM,
+                                          minimum_length = 2)
+    assert_same_partition(track_ids, molecules)
+    assert store.step_time_in_seconds == FRAME_TIME_IN_SECONDS
+    assert store.lengths.sum() == len(frames)
+
+    sums, steps = summed_square_displacements(store)
+    # Every step adds two gaussians of variance 2 D dt
+    estimate = sums.sum() / (4 * steps.sum() * FRAME_TIME_IN_SECONDS)
+    assert estimate == pytest.approx(DIFFUSION_COEFFICIENT, rel = 4 / np.sqrt(steps.sum()))
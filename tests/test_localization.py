@@ -0,0 +1,27 @@
+import json
+import numpy as np
+import pytest
+from frame_stack import FrameStack
+from localization import localize_stack, LEAST_SQUARES_FIT, MAXIMUM_LIKELIHOOD_FIT, LOCALIZATION_DTYPE
+
+@pytest.mark.parametrize('fit', [LEAST_SQUARES_FIT, MAXIMUM_LIKELIHOOD_FIT])
+@pytest.mark.parametrize('noisy', [False, True])
+def test_localizes_a_stack_of_the_default_setup(tmp_path, setup_simulation, fit, noisy):
+    simulation = setup_simulation()
+    stack = simulation.save_frame_stack(str(tmp_path / 'frames.npy'))
+    if noisy:
+        generator = np.random.default_rng(0)
+        filename = str(tmp_path / 'noisy.npy')
+        np.save(filename, generator.poisson(50 * np.asarray(stack[:]) + 2).astype(np.float32))
+        with open(filename + '.json', 'w') as f:
+            json.dump(stack.metadata, f)
+        stack = FrameStack(filename)
+
+    table = localize_stack(stack, fit = fit)
+    assert table.dtype == LOCALIZATION_DTYPE
+    assert len(table) > 0
+    assert np.all(np.isfinite(table['x_in_um'])) and np.all(np.isfinite(table['y_in_um']))
+    assert np.all((table['frame'] >= 0) & (table['frame'] < simulation.number_of_frames))
+    screen_size_in_um = simulation.screen_size_in_um
+    assert np.all((table['x_in_um'] > -1) & (table['x_in_um'] < screen_size_in_um[0] + 1))
+    assert np.all((table['y_in_um'] > -1) & (table['y_in_um'] < screen_size_in_um[1] + 1))
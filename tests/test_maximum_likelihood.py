@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+from maximum_likelihood import two_species_log_likelihood, fit_two_species, summed_square_displacements
+from trajectory_store import TrajectoryStore
+
+STEP_TIME_IN_SECONDS = 0.01
+
+
+def mixture_statistics(D1, D2, fraction, number_of_tracks, number_of_steps, seed = 0):
+    """
+        Summed 2D square displacements of tracks of number_of_steps steps, a fraction of them diffusing with D1
+    """
+    generator = np.random.default_rng(seed)
+    diffusion_coefficients = np.where(generator.random(number_of_tracks) < fraction, D1, D2)
+    # Every step adds two gaussians of variance 2 D dt
+    sums = 2 * diffusion_coefficients * STEP_TIME_IN_SECONDS * generator.chisquare(2 * number_of_steps, number_of_tracks)
+    return sums, np.full(number_of_tracks, number_of_steps)
+
+
+def test_fit_recovers_the_mixture():
+    sums, steps = mixture_statistics(0.1, 1., 0.3, 3000, 10)
+    (D1, D2, fraction), result = fit_two_species(sums, steps, STEP_TIME_IN_SECONDS)
+    assert result.success
+    assert D1 == pytest.approx(0.1, rel = 0.05)
+    assert D2 == pytest.approx(1., rel = 0.05)
+    assert fraction == pytest.approx(0.3, abs = 0.03)
+
+
+def test_gradient_matches_finite_differences():
+    sums, steps = mixture_statistics(0.2, 0.8, 0.5, 50, 20)
+    point = np.array([0.3, 0.9, 0.4])
+    _, gradient = two_species_log_likelihood(*point, sums, steps, STEP_TIME_IN_SECONDS)
+    for axis in range(3):
+        delta = np.zeros(3)
+        delta[axis] = 1e-6
+        plus, _ = two_species_log_likelihood(*(point + delta), sums, steps, STEP_TIME_IN_SECONDS)
+        minus, _ = two_species_log_likelihood(*(point - delta), sums, steps, STEP_TIME_IN_SECONDS)
+        assert gradient[axis] == pytest.approx((plus - minus) / 2e-6, rel = 1e-5)
+
+
+def test_long_tracks_do_not_underflow():
+    # The likelihood of one such track is far below the smallest double
+    sums, steps = mixture_statistics(0.1, 1., 0.5, 100, 5000)
+    value, gradient = two_species_log_likelihood(0.1, 1., 0.5, sums, steps, STEP_TIME_IN_SECONDS)
+    assert np.isfinite(value) and np.all(np.isfinite(gradient))
+
+
+def test_summed_square_displacements_of_a_store():
+    generator = np.random.default_rng(1)
+    tracks = [generator.normal(0, 1, [length, 3]) for length in [5, 1, 3, 8]]
+    store = TrajectoryStore(np.zeros(len(tracks)), [track[0] for track in tracks], (10., 10.), 1., STEP_TIME_IN_SECONDS)
+    store.set_tracks(tracks)
+
+    sums, steps = summed_square_displacements(store)
+    expected = [np.sum(np.diff(track[:, :2], axis = 0) ** 2) for track in tracks if len(track) > 1]
+    assert np.allclose(sums, expected)
+    assert steps.tolist() == [4, 2, 7]
+
+    sums, steps = summed_square_displacements(store, number_of_steps = 4)
+    expected = [np.sum(np.diff(track[:5, :2], axis = 0) ** 2) for track in tracks if len(track) > 4]
+    assert np.allclose(sums, expected)
+    assert steps.tolist() == [4, 4]
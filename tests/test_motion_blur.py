@@ -0,0 +1,51 @@
+import numpy as np
+from simulation import NUMBER_OF_MOLECULES_KEY, NUMBER_OF_FRAMES_KEY, NUMBER_OF_SUBFRAMES_PER_FRAME_KEY, \
+                       DIFFUSION_COEFFICIENT_KEY
+from motion_blur import merge_emitters
+from renderer import FrameRenderer
+
+SIGMA_IN_UM = 0.1
+TOLERANCE = 1e-3
+# Steps of about 1/50 of the PSF, so a molecule moves less than a sigma during a frame
+SLOW_DIFFUSION = {NUMBER_OF_MOLECULES_KEY : 50, NUMBER_OF_FRAMES_KEY : 5,
+                  NUMBER_OF_SUBFRAMES_PER_FRAME_KEY : 50, DIFFUSION_COEFFICIENT_KEY : 1e-4}
+FRAME_TOLERANCE = 1e-2
+
+
+def test_merging_keeps_the_intensity_of_every_group():
+    generator = np.random.default_rng(0)
+    # A molecule that does not move, one that hardly moves and one that crosses many sigmas
+    paths = [np.zeros((20, 2)),
+             np.cumsum(generator.normal(0, 1e-4, (20, 2)), axis = 0),
+             np.cumsum(generator.normal(0, 2 * SIGMA_IN_UM, (20, 2)), axis = 0) + 10]
+    xs, ys = np.concatenate(paths).T
+    intensities = generator.uniform(0.5, 1, len(xs))
+    groups = np.repeat(np.arange(len(paths)), 20)
+
+    merged_xs, merged_ys, merged_intensities = merge_emitters(xs, ys, intensities, groups,
+                                                              SIGMA_IN_UM, SIGMA_IN_UM, TOLERANCE)
+    assert np.isclose(merged_intensities.sum(), intensities.sum())
+    # Emitters of the last group are far from the other two
+    fast = merged_xs > 5
+    assert np.isclose(merged_intensities[fast].sum(), intensities[40:].sum())
+    assert fast.sum() == 20
+    assert len(merged_xs) == 22
+    assert np.allclose([merged_xs[0], merged_ys[0]], 0)
+
+
+def test_blurred_frames_are_within_the_tolerance(setup_simulation):
+    simulation = setup_simulation(SLOW_DIFFUSION)
+    args = [[simulation.trajectory_store],
+            simulation.number_of_frames,
+            simulation.number_of_subframes_per_frame,
+            simulation.pixel_length_in_um,
+            simulation.sigma_x_noise_in_um,
+            simulation.sigma_y_noise_in_um,
+            simulation.screen_size]
+    with FrameRenderer(*args) as exact, FrameRenderer(*args, blur_tolerance = FRAME_TOLERANCE) as blurred:
+        for frame_index in range(simulation.number_of_frames):
+            _, _, intensities = exact.get_emitters(frame_index)
+            _, _, merged_intensities = blurred.get_emitters(frame_index)
+            assert len(merged_intensities) < len(intensities) / 5
+            error = np.abs(blurred.render_frame(frame_index) - exact.render_frame(frame_index)).max()
+            assert error <= FRAME_TOLERANCE * intensities.sum()
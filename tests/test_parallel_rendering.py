@@ -0,0 +1,17 @@
+import numpy as np
+from simulation import NUMBER_OF_MOLECULES_KEY
+from parallel_rendering import ParallelFrameRenderer
+
+
+def test_parallel_frames_are_the_serial_frames(setup_simulation):
+    simulation = setup_simulation({NUMBER_OF_MOLECULES_KEY : 200})
+    with simulation.get_renderer() as renderer:
+        frames = renderer.render()
+    assert frames.max() > 0
+
+    # Batches smaller than the movie, that do not divide it, so the output slots are reused
+    with simulation.get_renderer(number_of_workers = 2, batch_size = 7) as renderer:
+        assert isinstance(renderer, ParallelFrameRenderer)
+        assert np.array_equal(renderer.render(), frames)
+        frame_indices = [12, 3, 3, 19, 0]
+        assert np.array_equal(renderer.render(frame_indices), frames[frame_indices])
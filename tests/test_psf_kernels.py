@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+from scipy import integrate
+from simulation import NUMBER_OF_MOLECULES_KEY, NUMBER_OF_FRAMES_KEY, NUMBER_OF_SUBFRAMES_PER_FRAME_KEY
+from psf_kernels import ExactKernel, KernelBank, psf_profile, GAUSSIAN_PSF, PIXEL_INTEGRATED_PSF
+from renderer import FrameRenderer
+
+PIXEL_LENGTH_IN_UM = 0.1
+SIGMA_IN_UM = 0.15
+HALF_WIDTH = 10
+
+
+def random_centers(number_of_centers = 5000):
+    return np.random.default_rng(0).uniform(-1, 3, number_of_centers)
+
+
+@pytest.mark.parametrize('psf', [GAUSSIAN_PSF, PIXEL_INTEGRATED_PSF])
+@pytest.mark.parametrize('subpixel_steps', [4, 32, 256])
+def test_kernel_bank_is_within_its_bound_of_the_exact_kernels(psf, subpixel_steps):
+    exact = ExactKernel(SIGMA_IN_UM, PIXEL_LENGTH_IN_UM, HALF_WIDTH, psf)
+    bank = KernelBank(SIGMA_IN_UM, PIXEL_LENGTH_IN_UM, HALF_WIDTH, psf, subpixel_steps)
+    centers = random_centers()
+    exact_pixels, exact_kernels = exact(centers)
+    bank_pixels, bank_kernels = bank(centers)
+    assert np.array_equal(bank_pixels, exact_pixels)
+    error = np.abs(bank_kernels - exact_kernels).max()
+    assert 0 < error <= bank.error_bound()
+    # The bound is not loose by more than the slope of a single step
+    assert error > bank.error_bound() / 4
+
+
+def test_pixel_integrated_profile_is_the_mean_of_the_gaussian_over_the_pixel():
+    distances = np.linspace(-0.5, 0.5, 11)
+    half_pixel = PIXEL_LENGTH_IN_UM / 2
+    means = [integrate.quad(psf_profile, distance - half_pixel, distance + half_pixel,
+                            args = (SIGMA_IN_UM, PIXEL_LENGTH_IN_UM))[0] / PIXEL_LENGTH_IN_UM
+             for distance in distances]
+    assert np.allclose(psf_profile(distances, SIGMA_IN_UM, PIXEL_LENGTH_IN_UM, PIXEL_INTEGRATED_PSF), means,
+                       rtol = 0, atol = 1e-9)
+
+
+def test_frames_of_the_kernel_bank_are_within_the_quantization_bound(setup_simulation):
+    simulation = setup_simulation({NUMBER_OF_MOLECULES_KEY : 50, NUMBER_OF_FRAMES_KEY : 5,
+                                   NUMBER_OF_SUBFRAMES_PER_FRAME_KEY : 1})
+    args = [[simulation.trajectory_store],
+            simulation.number_of_frames,
+            simulation.number_of_subframes_per_frame,
+            simulation.pixel_length_in_um,
+            simulation.sigma_x_noise_in_um,
+            simulation.sigma_y_noise_in_um,
+            simulation.screen_size]
+    with FrameRenderer(*args) as exact, FrameRenderer(*args, subpixel_steps = 16) as bank:
+        for frame_index in range(simulation.number_of_frames):
+            number_of_emitters = len(exact.get_emitters(frame_index)[0])
+            error = np.abs(bank.render_frame(frame_index) - exact.render_frame(frame_index)).max()
+            # Each emitter is off by at most the bound, times its peak of 1
+            assert error <= number_of_emitters * bank.quantization_error_bound()
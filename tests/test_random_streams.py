@@ -0,0 +1,43 @@
+import numpy as np
+from simulation import Simulation
+from random_streams import RandomStreams, random_placement, SEED_KEY
+
+NUMBER_OF_STEPS = 1000
+SCREEN_SIZE_IN_UM = (10., 20.)
+SCREEN_DEPTH_IN_UM = 1.
+
+
+def test_placement_of_any_chunk_of_molecules_is_the_same():
+    streams = RandomStreams(7)
+    start_frames, positions = random_placement(streams, 0, 100, NUMBER_OF_STEPS, SCREEN_SIZE_IN_UM, SCREEN_DEPTH_IN_UM)
+    for first, number in [(0, 40), (40, 60), (57, 1)]:
+        chunk_start_frames, chunk_positions = random_placement(streams, first, number, NUMBER_OF_STEPS,
+                                                               SCREEN_SIZE_IN_UM, SCREEN_DEPTH_IN_UM)
+        assert np.array_equal(chunk_start_frames, start_frames[first:first + number])
+        assert np.array_equal(chunk_positions, positions[first:first + number])
+    assert np.all((start_frames >= 0) & (start_frames < NUMBER_OF_STEPS))
+    assert np.all((positions > 0) & (positions < [10., 20., 1.]))
+
+
+def test_streams_only_depend_on_the_seed_and_their_key():
+    streams, other_streams = RandomStreams(7), RandomStreams(7)
+    assert np.array_equal(streams.molecule(3).random(5), other_streams.molecule(3).random(5))
+    assert np.array_equal(streams.noise(3).random(5), other_streams.noise(3).random(5))
+    draws = [streams.molecule(0).random(5), streams.molecule(1).random(5), streams.noise(0).random(5),
+             streams.births().random(5), RandomStreams(8).molecule(0).random(5)]
+    assert len({tuple(d) for d in draws}) == len(draws)
+
+    # Fresh entropy is kept, so the run can be repeated
+    fresh = RandomStreams()
+    assert np.array_equal(RandomStreams(fresh.seed).molecule(0).random(5), fresh.molecule(0).random(5))
+
+
+def test_a_seed_reproduces_the_simulation(setup_parameters):
+    simulations = [Simulation(setup_parameters({SEED_KEY : seed})) for seed in [1, 1, 2]]
+    for simulation in simulations:
+        simulation.cache = None
+        simulation.run(verbose = False)
+    stores = [simulation.trajectory_store for simulation in simulations]
+    assert np.array_equal(stores[0].positions, stores[1].positions)
+    assert np.array_equal(stores[0].offsets, stores[1].offsets)
+    assert not np.array_equal(stores[0].start_frames, stores[2].start_frames)
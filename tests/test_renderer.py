@@ -0,0 +1,66 @@
+import numpy as np
+from simulation import NUMBER_OF_MOLECULES_KEY, NUMBER_OF_FRAMES_KEY, NUMBER_OF_SUBFRAMES_PER_FRAME_KEY
+from renderer import FrameRenderer
+
+SMALL_MOVIE = {NUMBER_OF_MOLECULES_KEY : 30, NUMBER_OF_FRAMES_KEY : 6, NUMBER_OF_SUBFRAMES_PER_FRAME_KEY : 4}
+
+
+def renderer_arguments(simulation):
+    return [[simulation.trajectory_store],
+            simulation.number_of_frames,
+            simulation.number_of_subframes_per_frame,
+            simulation.pixel_length_in_um,
+            simulation.sigma_x_noise_in_um,
+            simulation.sigma_y_noise_in_um,
+            simulation.screen_size]
+
+
+def render_pixel_by_pixel(simulation):
+    """
+        The loops of create_frame and add_molecule_at_position_to_frame in Animation/animation.go
+    """
+    store = simulation.trajectory_store
+    pixel_length = simulation.pixel_length_in_um
+    sigma_x, sigma_y = simulation.sigma_x_noise_in_um, simulation.sigma_y_noise_in_um
+    size_x, size_y = simulation.screen_size
+    n_sigmas_x = 5 * (np.round(sigma_x / pixel_length) + 1)
+    n_sigmas_y = 5 * (np.round(sigma_y / pixel_length) + 1)
+    frames = np.zeros((simulation.number_of_frames, size_x, size_y))
+    for frame_index in range(simulation.number_of_frames):
+        for subframe in range(simulation.number_of_subframes_per_frame):
+            subframe_index = frame_index * simulation.number_of_subframes_per_frame + subframe
+            for molecule in range(len(store)):
+                position = store.get_position_in_frame(molecule, subframe_index)
+                if position is None:
+                    continue
+                x0, y0 = position[0], position[1]
+                min_x = int(max(np.floor(x0 / pixel_length + .5) - n_sigmas_x, 0))
+                max_x = int(min(np.floor(x0 / pixel_length + .5) + n_sigmas_x, size_x))
+                min_y = int(max(np.floor(y0 / pixel_length + .5) - n_sigmas_y, 0))
+                max_y = int(min(np.floor(y0 / pixel_length + .5) + n_sigmas_y, size_y))
+                for i in range(min_x, max_x):
+                    for j in range(min_y, max_y):
+                        frames[frame_index, i, j] += np.exp(-(i * pixel_length - x0) ** 2 / (2 * sigma_x ** 2)) * \
+                                                     np.exp(-(j * pixel_length - y0) ** 2 / (2 * sigma_y ** 2))
+    return frames
+
+
+def test_frames_match_the_pixel_by_pixel_go_loops(setup_simulation):
+    simulation = setup_simulation(SMALL_MOVIE)
+    with FrameRenderer(*renderer_arguments(simulation)) as renderer:
+        frames = renderer.render()
+    expected = render_pixel_by_pixel(simulation)
+    assert expected.max() > 0
+    assert np.allclose(frames, expected, rtol = 0, atol = 1e-12)
+
+
+def test_tiled_frames_match_the_whole_frame(setup_simulation):
+    simulation = setup_simulation(dict(SMALL_MOVIE, **{NUMBER_OF_MOLECULES_KEY : 300}))
+    with FrameRenderer(*renderer_arguments(simulation), tile_size = 1000) as renderer:
+        assert renderer.bin_emitters_by_tile(*renderer.get_emitters(0)[:2]).keys() == {(0, 0)}
+        frames = renderer.render()
+    # Tiles much smaller than the windows, so most emitters are in several tiles, on several threads
+    for tile_size, number_of_threads in [(5, 1), (16, 3), (64, 2)]:
+        with FrameRenderer(*renderer_arguments(simulation), tile_size = tile_size,
+                           number_of_threads = number_of_threads) as renderer:
+            assert np.allclose(renderer.render(), frames, rtol = 0, atol = 1e-12)
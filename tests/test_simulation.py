@@ -0,0 +1,17 @@
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from simulation import NUMBER_OF_MOLECULES_KEY
+
+
+def test_mean_square_displacement_curves_of_short_journeys_are_empty(setup_simulation):
+    simulation = setup_simulation({NUMBER_OF_MOLECULES_KEY : 20})
+    lengths = simulation.trajectory_store.lengths
+    assert lengths.min() < 10 and lengths.max() >= 20
+
+    plt.figure()
+    simulation.plot_mean_square_displacement_curves()
+    points = [len(line.get_xdata()) for line in plt.gca().lines]
+    plt.close()
+    assert points == list(np.maximum(lengths // 10 - 1, 0))
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+from random_streams import RandomStreams
+from simulation import MEAN_NUMBER_OF_EMITTERS_KEY, NUMBER_OF_FRAMES_KEY, TOTAL_TIME_IN_SECONDS_KEY
+from steady_state import steady_state_placement, steady_state_report, entry_rate
+
+MEAN_NUMBER_OF_EMITTERS = 500
+# 400 subframes of the small setup's step time
+STEADY_STATE_SETUP = {MEAN_NUMBER_OF_EMITTERS_KEY : MEAN_NUMBER_OF_EMITTERS,
+                      NUMBER_OF_FRAMES_KEY : 40,
+                      TOTAL_TIME_IN_SECONDS_KEY : 2}
+
+
+def test_entries_follow_the_entry_rate():
+    screen_size_in_um, screen_depth_in_um, step_size, number_of_steps = (5., 5.), 0.5, 0.1, 2001
+    start_frames, positions = steady_state_placement(RandomStreams(0), 1000, number_of_steps, step_size,
+                                                     screen_size_in_um, screen_depth_in_um)
+    assert np.all(np.diff(start_frames) >= 0)
+    assert np.all(positions > 0) and np.all(positions < [5., 5., 0.5])
+
+    concentration = 1000 / (5. * 5. * 0.5)
+    expected = concentration * entry_rate(step_size, screen_size_in_um, screen_depth_in_um) * (number_of_steps - 1)
+    assert np.sum(start_frames > 0) == pytest.approx(expected, abs = 4 * np.sqrt(expected))
+    assert np.sum(start_frames == 0) == pytest.approx(1000, abs = 4 * np.sqrt(1000))
+
+
+def test_in_frame_count_stays_at_the_mean_number_of_emitters(setup_simulation):
+    simulation = setup_simulation(STEADY_STATE_SETUP)
+    store, number_of_steps = simulation.trajectory_store, simulation.number_of_steps
+    index = store.get_subframe_index(number_of_steps)
+    counts = np.array([index.number_of_active(i, i + 1) for i in range(number_of_steps)])
+
+    report = steady_state_report(store, number_of_steps, MEAN_NUMBER_OF_EMITTERS)
+    assert report['mean_number_of_emitters'] == pytest.approx(counts.mean())
+    # Steps that cross two faces at once are neglected by entry_rate, a bias of a few percent on this slab
+    assert counts.mean() == pytest.approx(MEAN_NUMBER_OF_EMITTERS, rel = 0.05)
+    # No drift : the population at the end is the one at the start
+    quarter = number_of_steps // 4
+    assert counts[:quarter].mean() == pytest.approx(MEAN_NUMBER_OF_EMITTERS, rel = 0.075)
+    assert counts[-quarter:].mean() == pytest.approx(MEAN_NUMBER_OF_EMITTERS, rel = 0.075)
@@ -0,0 +1,40 @@
+import json
+import pytest
+from simulation import DIFFUSION_COEFFICIENT_KEY, NUMBER_OF_MOLECULES_KEY
+from sweep import run_sweep, read_sweep_results, POINT_KEY, REPLICATE_KEY, RESULT_KEY
+
+DIFFUSION_COEFFICIENTS = [0.5, 2.]
+
+
+@pytest.fixture
+def setup_filename(tmp_path, setup_parameters):
+    filename = str(tmp_path / 'setup.json')
+    with open(filename, 'w') as f:
+        json.dump(setup_parameters({NUMBER_OF_MOLECULES_KEY : 300}), f)
+    return filename
+
+
+def sorted_rows(rows):
+    return sorted(rows, key = lambda row : (row[POINT_KEY][DIFFUSION_COEFFICIENT_KEY], row[REPLICATE_KEY]))
+
+
+def test_sweep_estimates_every_point_and_resumes(tmp_path, setup_filename):
+    results_filename = str(tmp_path / 'results.jsonl')
+    axes = {DIFFUSION_COEFFICIENT_KEY : DIFFUSION_COEFFICIENTS}
+    rows = sorted_rows(run_sweep(setup_filename, axes, results_filename, replicates = 2, number_of_workers = 2))
+    assert [(row[POINT_KEY][DIFFUSION_COEFFICIENT_KEY], row[REPLICATE_KEY]) for row in rows] == \
+                [(0.5, 0), (0.5, 1), (2., 0), (2., 1)]
+    for row in rows:
+        estimate = row[RESULT_KEY]['diffusion_coefficient']
+        assert estimate == pytest.approx(row[POINT_KEY][DIFFUSION_COEFFICIENT_KEY], rel = 0.1)
+    assert rows[0][RESULT_KEY] != rows[1][RESULT_KEY]
+
+    # An interrupted sweep only runs the points that are missing from the file
+    with open(results_filename) as f:
+        lines = f.readlines()
+    with open(results_filename, 'w') as f:
+        f.writelines(lines[:3])
+    resumed = sorted_rows(run_sweep(setup_filename, axes, results_filename, replicates = 2, number_of_workers = 1))
+    assert resumed == rows
+    assert len(read_sweep_results(results_filename)) == 4
+    assert sorted_rows(run_sweep(setup_filename, axes, results_filename, replicates = 2)) == rows
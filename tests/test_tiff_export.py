@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+import tifffile
+from tiff_export import write_frames, write_frames_streaming, NO_COMPRESSION, ZLIB_COMPRESSION, DEFAULT_QUEUE_SIZE
+
+FRAME_INTERVAL_IN_SECONDS = 0.05
+PIXEL_LENGTH_IN_UM = 0.117
+
+
+def random_frames(number_of_frames = 10, shape = (24, 32), dtype = np.int16):
+    generator = np.random.default_rng(0)
+    return generator.integers(0, 1000, (number_of_frames,) + shape).astype(dtype)
+
+
+def read_back(filename):
+    with tifffile.TiffFile(filename) as tiff:
+        return tiff.asarray(), tiff.imagej_metadata, tiff.is_bigtiff, tiff.pages[0]
+
+
+@pytest.mark.parametrize('compression', [NO_COMPRESSION, ZLIB_COMPRESSION])
+@pytest.mark.parametrize('bigtiff', [False, True])
+def test_frames_round_trip(tmp_path, compression, bigtiff):
+    frames = random_frames()
+    filename = str(tmp_path / 'frames.tif')
+    statistics = write_frames(filename, frames,
+                              compression = compression,
+                              bigtiff = bigtiff,
+                              frame_interval_in_seconds = FRAME_INTERVAL_IN_SECONDS,
+                              pixel_length_in_um = PIXEL_LENGTH_IN_UM)
+
+    data, metadata, is_bigtiff, page = read_back(filename)
+    assert np.array_equal(data, frames)
+    assert is_bigtiff == bigtiff
+    assert metadata['images'] == metadata['frames'] == len(frames)
+    assert metadata['finterval'] == FRAME_INTERVAL_IN_SECONDS
+    assert metadata['unit'] == 'micron'
+    assert page.resolution == pytest.approx((1 / PIXEL_LENGTH_IN_UM, 1 / PIXEL_LENGTH_IN_UM))
+    assert statistics['number_of_frames'] == len(frames)
+    assert statistics['raw_bytes'] == frames.nbytes
+
+
+@pytest.mark.parametrize('compression', [NO_COMPRESSION, ZLIB_COMPRESSION])
+def test_streaming_with_a_reused_output_buffer(tmp_path, compression):
+    frames = random_frames(number_of_frames = 20)
+    batches = ((list(range(start, start + 4)), frames[start:start + 4]) for start in range(0, len(frames), 4))
+    output = np.empty((4,) + frames.shape[1:], dtype = np.uint16)
+    def convert_batch(frame_indices, batch):
+        output[:] = batch + 1
+        return output
+
+    filename = str(tmp_path / 'frames.tif')
+    write_frames_streaming(filename, batches,
+                           convert_batch = convert_batch,
+                           compression = compression,
+                           number_of_threads = 4,
+                           number_of_frames = len(frames))
+
+    data, metadata, _, _ = read_back(filename)
+    assert np.array_equal(data, frames + 1)
+    assert metadata['frames'] == len(frames)
+
+
+def test_wrong_number_of_frames(tmp_path):
+    frames = random_frames()
+    with pytest.raises(Exception, match = 'Expected 11 frames, got 10'):
+        write_frames(str(tmp_path / 'short.tif'), iter(frames), number_of_frames = 11)
+    with pytest.raises(Exception, match = 'Expected 9 frames, got more'):
+        write_frames(str(tmp_path / 'long.tif'), iter(frames), number_of_frames = 9)
+
+
+def test_streaming_keeps_a_bounded_number_of_batches_in_memory(tmp_path):
+    frames = random_frames(number_of_frames = 40)
+    counts = {'produced' : 0, 'written' : 0, 'ahead' : 0}
+    def batches():
+        for start in range(0, len(frames), 2):
+            counts['produced'] += 1
+            counts['ahead'] = max(counts['ahead'], counts['produced'] - counts['written'])
+            yield [start, start + 1], frames[start:start + 2]
+    def convert_batch(frame_indices, batch):
+        counts['written'] += 1
+        return batch
+
+    write_frames_streaming(str(tmp_path / 'frames.tif'), batches(),
+                           convert_batch = convert_batch,
+                           number_of_frames = len(frames))
+    assert counts['written'] == 20
+    # The queue, the batch waiting to be put in it and the batch being written
+    assert counts['ahead'] <= DEFAULT_QUEUE_SIZE + 2
+
+
+def test_animation_does_not_depend_on_the_batches(tmp_path, setup_simulation):
+    simulation = setup_simulation()
+    simulation.save_animation(str(tmp_path / 'one_batch.tif'), batch_size = simulation.number_of_frames)
+    simulation.save_animation(str(tmp_path / 'batches.tif'), batch_size = 3)
+    one_batch, metadata, _, _ = read_back(str(tmp_path / 'one_batch.tif'))
+    batches, _, _, _ = read_back(str(tmp_path / 'batches.tif'))
+    assert one_batch.shape == (simulation.number_of_frames, 64, 64)
+    assert metadata['frames'] == simulation.number_of_frames
+    assert np.array_equal(one_batch, batches)
@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+from random_streams import RandomStreams
+from trajectory_engine import move_molecules, move_molecules_coarse, is_in_frame
+
+NUMBER_OF_MOLECULES = 4000
+NUMBER_OF_STEPS = 2000
+STEP_SIZE = 0.05
+SCREEN_SIZE_IN_UM = (100., 100.)
+SCREEN_DEPTH_IN_UM = 1.
+SUBFRAMES_PER_POSITION = 10
+
+
+def centered_molecules():
+    """
+        Molecules in the middle of the slab, which they leave through the top or the bottom
+    """
+    positions = np.tile([SCREEN_SIZE_IN_UM[0] / 2, SCREEN_SIZE_IN_UM[1] / 2, SCREEN_DEPTH_IN_UM / 2],
+                        (NUMBER_OF_MOLECULES, 1))
+    return positions, np.zeros(NUMBER_OF_MOLECULES, dtype = np.int64)
+
+
+def move_coarse(seed, batch_size = 1024):
+    positions, start_frames = centered_molecules()
+    return move_molecules_coarse(positions, start_frames, STEP_SIZE, NUMBER_OF_STEPS,
+                                 SCREEN_SIZE_IN_UM, SCREEN_DEPTH_IN_UM,
+                                 SUBFRAMES_PER_POSITION,
+                                 batch_size = batch_size,
+                                 random_streams = RandomStreams(seed))
+
+
+def move_one_by_one(initial_position, step_size, number_of_steps, generator):
+    """
+        The loop of the per-molecule Molecule.move, on the generator of the molecule
+    """
+    positions = [np.array(initial_position)]
+    for _ in range(number_of_steps):
+        position = positions[-1] + step_size * generator.standard_normal(3)
+        if not is_in_frame(position, SCREEN_SIZE_IN_UM, SCREEN_DEPTH_IN_UM):
+            break
+        positions.append(position)
+    return np.array(positions)
+
+
+def test_batched_engine_matches_the_per_molecule_loop():
+    streams = RandomStreams(5)
+    positions, _ = centered_molecules()
+    positions = positions[:100]
+    tracks = move_molecules(positions, STEP_SIZE, NUMBER_OF_STEPS, SCREEN_SIZE_IN_UM, SCREEN_DEPTH_IN_UM,
+                            batch_size = 32, random_streams = streams)
+    for index, track in enumerate(tracks):
+        expected = move_one_by_one(positions[index], STEP_SIZE, NUMBER_OF_STEPS, streams.molecule(index))
+        assert track.shape == expected.shape
+        # The engine sums the steps of a chunk before adding them, so only the rounding differs
+        assert np.allclose(track, expected, rtol = 0, atol = 1e-12)
+
+
+def test_coarse_exit_times_match_the_fine_engine():
+    positions, _ = centered_molecules()
+    tracks = move_molecules(positions, STEP_SIZE, NUMBER_OF_STEPS, SCREEN_SIZE_IN_UM, SCREEN_DEPTH_IN_UM,
+                            random_streams = RandomStreams(1))
+    # The first out of frame position of the fine engine is the one after its track
+    fine_exits = np.array([len(track) for track in tracks])
+    _, coarse_exits = move_coarse(2)
+    assert fine_exits.max() < NUMBER_OF_STEPS and coarse_exits.max() < NUMBER_OF_STEPS
+
+    standard_error = np.sqrt((fine_exits.var() + coarse_exits.var()) / NUMBER_OF_MOLECULES)
+    assert abs(fine_exits.mean() - coarse_exits.mean()) < 4 * standard_error
+    for quantile in [0.1, 0.5, 0.9]:
+        assert np.quantile(coarse_exits, quantile) == pytest.approx(np.quantile(fine_exits, quantile), rel = 0.1)
+
+
+def test_coarse_tracks_keep_one_position_per_interval_in_the_frame():
+    tracks, end_subframes = move_coarse(3)
+    for track, end_subframe in zip(tracks, end_subframes):
+        # Positions on the multiples of SUBFRAMES_PER_POSITION before the exit
+        assert len(track) == -(-end_subframe // SUBFRAMES_PER_POSITION)
+    positions = np.concatenate(tracks)
+    assert positions[:, 2].min() > 0 and positions[:, 2].max() < SCREEN_DEPTH_IN_UM
+
+
+def test_coarse_tracks_do_not_depend_on_the_batches():
+    tracks, end_subframes = move_coarse(4)
+    batched_tracks, batched_end_subframes = move_coarse(4, batch_size = 100)
+    assert np.array_equal(end_subframes, batched_end_subframes)
+    assert all(np.array_equal(track, batched_track) for track, batched_track in zip(tracks, batched_tracks))
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+from simulation import Simulation, NUMBER_OF_MOLECULES_KEY, NUMBER_OF_FRAMES_KEY, NUMBER_OF_SUBFRAMES_PER_FRAME_KEY, \
+                       DIFFUSION_COEFFICIENT_KEY
+from fused_simulation import FusedSimulation
+from trajectory_file import TrajectoryFile, FORMAT_VERSION
+
+SMALL_SIMULATION = {NUMBER_OF_MOLECULES_KEY : 20, NUMBER_OF_FRAMES_KEY : 10, NUMBER_OF_SUBFRAMES_PER_FRAME_KEY : 4}
+
+
+def test_trajectories_round_trip(tmp_path, setup_simulation):
+    simulation = setup_simulation(SMALL_SIMULATION)
+    filename = str(tmp_path / 'simulation.trajectories')
+    simulation.save_trajectories(filename, dtype = np.float64)
+
+    trajectory_file = TrajectoryFile(filename)
+    assert trajectory_file.header['version'] == FORMAT_VERSION
+    store = trajectory_file.read_store(0)
+    assert np.array_equal(store.lengths, simulation.trajectory_store.lengths)
+    assert np.array_equal(store.end_subframes, simulation.trajectory_store.end_subframes)
+    assert store.subframes_per_position == simulation.trajectory_store.subframes_per_position
+
+
+def test_rejects_other_versions(tmp_path, setup_simulation):
+    simulation = setup_simulation(SMALL_SIMULATION)
+    filename = str(tmp_path / 'simulation.trajectories')
+    simulation.save_trajectories(filename)
+
+    with open(filename, 'rb') as f:
+        data = f.read()
+    version = '"version": {}'.format(FORMAT_VERSION).encode()
+    assert data.count(version) == 1
+    with open(filename, 'wb') as f:
+        f.write(data.replace(version, '"version": {}'.format(FORMAT_VERSION - 1).encode()))
+    with pytest.raises(Exception, match = 'Unsupported trajectory file version'):
+        TrajectoryFile(filename)
+
+
+def test_a_loaded_simulation_is_memory_mapped_and_renders_the_same_frames(tmp_path, setup_simulation):
+    simulation = setup_simulation(SMALL_SIMULATION)
+    filename = str(tmp_path / 'simulation.trajectories')
+    simulation.save_trajectories(filename, dtype = np.float64)
+
+    loaded = Simulation.from_file(filename)
+    assert isinstance(loaded.trajectory_store.positions, np.memmap)
+    assert np.array_equal(loaded.trajectory_store.positions, simulation.trajectory_store.positions)
+    assert np.array_equal(loaded.trajectory_store.start_frames, simulation.trajectory_store.start_frames)
+    assert np.array_equal(loaded.create_frames(), simulation.create_frames())
+
+
+def test_a_window_of_frames_only_reads_its_positions(tmp_path, setup_simulation):
+    simulation = setup_simulation(SMALL_SIMULATION)
+    filename = str(tmp_path / 'simulation.trajectories')
+    simulation.save_trajectories(filename, dtype = np.float64)
+
+    first, last = 3, 7
+    window = Simulation.from_file(filename, frames = (first, last))
+    subframes = simulation.trajectory_store.row_subframes()
+    in_window = (subframes >= first * 4) & (subframes < last * 4)
+    assert np.array_equal(window.trajectory_store.positions, simulation.trajectory_store.positions[in_window])
+    assert np.array_equal(window.create_frames()[first:last], simulation.create_frames()[first:last])
+
+
+def test_species_round_trip(tmp_path, setup_parameters):
+    simulation = FusedSimulation(setup_parameters(SMALL_SIMULATION),
+                                 [{DIFFUSION_COEFFICIENT_KEY : 0.1}, {DIFFUSION_COEFFICIENT_KEY : 1., NUMBER_OF_MOLECULES_KEY : 30}])
+    simulation.run(verbose = False)
+    filename = str(tmp_path / 'species.trajectories')
+    simulation.save_trajectories(filename, dtype = np.float64)
+
+    loaded = FusedSimulation.from_file(filename)
+    assert len(loaded) == 2
+    assert np.array_equal(loaded.trajectory_store.positions, simulation.trajectory_store.positions)
+    assert np.array_equal(loaded.trajectory_store.species, simulation.trajectory_store.species)
+    for species in range(2):
+        assert loaded.simulations[species].diffusion_coefficient == simulation.simulations[species].diffusion_coefficient
+        assert len(loaded.simulations[species].trajectory_store) == [20, 30][species]
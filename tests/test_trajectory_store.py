@@ -0,0 +1,82 @@
+import numpy as np
+from trajectory_store import TrajectoryStore
+
+SCREEN_SIZE_IN_UM = (10., 10.)
+SCREEN_DEPTH_IN_UM = 1.
+STEP_TIME_IN_SECONDS = 0.01
+START_FRAMES = [2, 0, 5, 1]
+LENGTHS = [4, 1, 6, 3]
+SPECIES = [0, 0, 1, 1]
+
+
+def random_tracks():
+    generator = np.random.default_rng(0)
+    return [generator.uniform(0, 1, [length, 3]) for length in LENGTHS]
+
+
+def make_store(tracks):
+    store = TrajectoryStore(START_FRAMES, [track[0] for track in tracks],
+                            SCREEN_SIZE_IN_UM, SCREEN_DEPTH_IN_UM, STEP_TIME_IN_SECONDS,
+                            species = SPECIES,
+                            diffusion_coefficients = [0.1, 1.],
+                            intensities = [1., 2.])
+    store.set_tracks(tracks)
+    return store
+
+
+def test_tracks_are_kept_back_to_back():
+    tracks = random_tracks()
+    store = make_store(tracks)
+    assert store.offsets.tolist() == [0, 4, 5, 11, 14]
+    assert store.lengths.tolist() == LENGTHS
+    assert store.end_subframes.tolist() == [6, 1, 11, 4]
+    for index, track in enumerate(tracks):
+        assert np.array_equal(store.get_positions(index), track)
+        assert np.shares_memory(store.get_positions(index), store.positions)
+        assert np.array_equal(store.get_position_in_frame(index, START_FRAMES[index] + len(track) - 1), track[-1])
+        assert store.get_position_in_frame(index, START_FRAMES[index] - 1) is None
+        assert store.get_position_in_frame(index, START_FRAMES[index] + len(track)) is None
+    assert store.molecule_ids().tolist() == sum([[index] * length for index, length in enumerate(LENGTHS)], [])
+    assert np.array_equal(store.row_subframes(),
+                          np.concatenate([start + np.arange(length) for start, length in zip(START_FRAMES, LENGTHS)]))
+
+
+def test_square_displacements_match_the_tracks():
+    tracks = random_tracks()
+    store = make_store(tracks)
+    for n in [1, 2, 3]:
+        displacements, molecule_ids = store.square_displacements(n)
+        expected = [np.sum((track[n:, :2] - track[:-n, :2]) ** 2, axis = 1) for track in tracks]
+        assert np.allclose(displacements, np.concatenate(expected))
+        assert molecule_ids.tolist() == sum([[index] * len(e) for index, e in enumerate(expected)], [])
+
+
+def test_species_views_share_the_buffers():
+    tracks = random_tracks()
+    store = make_store(tracks)
+    view = store.species_view(1)
+    assert len(view) == 2
+    assert view.lengths.tolist() == LENGTHS[2:]
+    assert np.shares_memory(view.positions, store.positions)
+    assert np.array_equal(view.get_positions(1), tracks[3])
+    assert view.intensities.tolist() == [2.]
+    assert view.step_sizes.tolist() == [np.sqrt(2 * 1. * STEP_TIME_IN_SECONDS)]
+
+
+def test_subframe_index_slices_the_rows_alive_in_any_range():
+    store = make_store(random_tracks())
+    number_of_subframes = 10
+    index = store.get_subframe_index(number_of_subframes)
+    assert store.get_subframe_index(number_of_subframes) is index
+    subframes = store.row_subframes()
+    for first in range(-1, number_of_subframes + 1):
+        for last in range(first, number_of_subframes + 2):
+            rows = index.rows_in_subframes(first, last)
+            expected = np.flatnonzero((subframes >= max(first, 0)) & (subframes < min(last, number_of_subframes)))
+            assert sorted(rows.tolist()) == expected.tolist()
+            assert np.all(np.diff(subframes[rows]) >= 0)
+            assert index.number_of_active(first, last) == len(expected)
+
+    # New tracks drop the index built for the old ones
+    store.set_tracks(random_tracks())
+    assert store.get_subframe_index(number_of_subframes) is not index
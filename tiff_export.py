@@ -0,0 +1,201 @@
+import itertools
+import os
+import threading
+import time
+import warnings
+import numpy as np
+import tifffile
+from queue import Queue
+
+DEFAULT_BATCH_SIZE = 16
+DEFAULT_QUEUE_SIZE = 2
+MAX_INT16 = np.int16((2**15-1))
+
+NO_COMPRESSION = None
+ZLIB_COMPRESSION = 'zlib'
+ZSTD_COMPRESSION = 'zstd'
+LZW_COMPRESSION = 'lzw'
+COMPRESSIONS = [NO_COMPRESSION, ZLIB_COMPRESSION, ZSTD_COMPRESSION, LZW_COMPRESSION]
+
+# Classic TIFF offsets are 32 bit, leave room for the IFDs and the description
+CLASSIC_TIFF_LIMIT = 2**32 - 2**24
+# Camera frames are mostly noise, higher levels cost several times the time for a few percent
+DEFAULT_ZLIB_LEVEL = 1
+DEFAULT_ZSTD_LEVEL = 3
+_DEFAULT_LEVELS = {ZLIB_COMPRESSION : DEFAULT_ZLIB_LEVEL, ZSTD_COMPRESSION : DEFAULT_ZSTD_LEVEL}
+
+_END_OF_STREAM = None
+
+
+def _compression_arguments(compression, level):
+    """
+        The compressionargs of tifffile for a compression and level (None is the default level),
+        zstd and LZW need the imagecodecs package
+    """
+    if compression not in COMPRESSIONS:
+        raise Exception("Unknown compression {}, expected one of {}".format(compression, COMPRESSIONS))
+    if compression not in _DEFAULT_LEVELS:
+        return None
+    return {'level' : _DEFAULT_LEVELS[compression] if level is None else level}
+
+
+def write_frames(filename, frames,
+                 number_of_frames = None,
+                 compression = NO_COMPRESSION,
+                 compression_level = None,
+                 number_of_threads = None,
+                 bigtiff = None,
+                 frame_interval_in_seconds = None,
+                 pixel_length_in_um = None):
+    """
+        Writes 2-D frames to an ImageJ TIFF with tifffile.TiffWriter, as one series of number_of_frames pages.
+        frames is an array or any iterable of frames, which is consumed one frame at a time,
+        so a generator never holds the movie in memory (number_of_frames is needed when it has no len).
+        tifffile cannot append compressed pages to an ImageJ series, so the stack is written with
+        a single TiffWriter.write call, fed by frames. Its strips are compressed (compression,
+        a lossless codec) on number_of_threads threads (maxworkers, None lets tifffile choose).
+        BigTIFF (64 bit offsets) is used when bigtiff is True, or when it is None and the uncompressed
+        frames would not fit in a classic TIFF. ImageJ itself opens neither BigTIFF nor compressed
+        stacks, Fiji (Bio-Formats) and tifffile read both.
+        The frame interval goes to the ImageJ description and the pixel size to the resolution tags.
+        Returns the frames, the bytes before and after compression, and the throughput
+        (of uncompressed frames) since the call.
+    """
+    start_time = time.time()
+    compression_arguments = _compression_arguments(compression, compression_level)
+    if number_of_frames is None:
+        try:
+            number_of_frames = len(frames)
+        except TypeError:
+            raise Exception("number_of_frames is needed to write frames from an iterator")
+    frames = iter(frames)
+    first_frame = np.asarray(next(frames))
+    if first_frame.ndim != 2:
+        raise Exception("Expected 2-D frames, got shape {}".format(first_frame.shape))
+    if bigtiff is None:
+        bigtiff = number_of_frames * first_frame.nbytes > CLASSIC_TIFF_LIMIT
+
+    counts = {'number_of_frames' : 0, 'raw_bytes' : 0}
+    def checked_frames():
+        for frame in itertools.chain([first_frame], frames):
+            frame = np.asarray(frame)
+            if frame.shape != first_frame.shape or frame.dtype != first_frame.dtype:
+                raise Exception("All the frames need to be {} {}, got {} {}".format(first_frame.shape, first_frame.dtype,
+                                                                                   frame.shape, frame.dtype))
+            counts['number_of_frames'] += 1
+            counts['raw_bytes'] += frame.nbytes
+            # tifffile compresses the strips of several frames at once, frames in reused buffers
+            # (see write_frames_streaming) would be overwritten before they are compressed
+            yield frame if compression == NO_COMPRESSION else frame.copy()
+            # tifffile may not ask for more once the series is full
+            if counts['number_of_frames'] == number_of_frames:
+                return
+        raise Exception("Expected {} frames, got {}".format(number_of_frames, counts['number_of_frames']))
+
+    metadata = {'axes' : 'TYX', 'loop' : False}
+    resolution = None
+    if frame_interval_in_seconds is not None:
+        metadata['finterval'] = frame_interval_in_seconds
+    if pixel_length_in_um is not None:
+        metadata['unit'] = 'micron'
+        resolution = (1 / pixel_length_in_um, 1 / pixel_length_in_um)
+    with warnings.catch_warnings():
+        # ImageJ BigTIFF, see above
+        warnings.filterwarnings('ignore', message = '.*nonconformant BigTIFF ImageJ')
+        with tifffile.TiffWriter(filename, bigtiff = bigtiff, imagej = True) as tiff:
+            tiff.write(checked_frames(),
+                       shape = (number_of_frames,) + first_frame.shape,
+                       dtype = first_frame.dtype,
+                       compression = compression,
+                       compressionargs = compression_arguments,
+                       maxworkers = number_of_threads,
+                       resolution = resolution,
+                       metadata = metadata)
+
+    if next(frames, None) is not None:
+        raise Exception("Expected {} frames, got more".format(number_of_frames))
+
+    seconds = time.time() - start_time
+    written_bytes = os.path.getsize(filename)
+    return {'number_of_frames' : counts['number_of_frames'],
+            'raw_bytes' : counts['raw_bytes'],
+            'written_bytes' : written_bytes,
+            'compression_ratio' : counts['raw_bytes'] / max(written_bytes, 1),
+            'seconds' : seconds,
+            'frames_per_second' : counts['number_of_frames'] / max(seconds, 1e-9),
+            'megabytes_per_second' : counts['raw_bytes'] / 2**20 / max(seconds, 1e-9)}
+
+
+class _ProducerError:
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def _produce(batches, queue):
+    try:
+        for batch in batches:
+            queue.put(batch)
+    except Exception as e:
+        queue.put(_ProducerError(e))
+        return
+    queue.put(_END_OF_STREAM)
+
+
+def write_frames_streaming(filename, batches, convert_frame = None,
+                           queue_size = DEFAULT_QUEUE_SIZE,
+                           progress = lambda x:x,
+                           convert_batch = None,
+                           compression = NO_COMPRESSION,
+                           number_of_threads = None,
+                           bigtiff = None,
+                           number_of_frames = None,
+                           frame_interval_in_seconds = None,
+                           pixel_length_in_um = None):
+    """
+        Writes frames to an ImageJ TIFF while they are being rendered.
+        `batches` yields (frame_indices, frames) pairs (see FrameRenderer.iter_batches),
+        and is consumed in a separate thread. At most queue_size batches wait
+        in memory, so the peak memory does not depend on the number of frames.
+        Every batch goes through convert_batch(frame_indices, frames) (e.g. CameraModel.apply)
+        and every frame through convert_frame(frame_index, frame) before it is written.
+        Both run in the writing thread, so they may reuse their output buffers.
+        number_of_frames is the total number of frames of the batches, the frames are
+        written and compressed by write_frames.
+        Returns the statistics of write_frames.
+    """
+    if number_of_frames is None:
+        raise Exception("number_of_frames is needed to write frames from batches")
+    queue = Queue(maxsize = queue_size)
+    producer = threading.Thread(target = _produce, args = (batches, queue))
+    producer.daemon = True
+    producer.start()
+
+    def frames():
+        for batch in progress(iter(queue.get, _END_OF_STREAM)):
+            if isinstance(batch, _ProducerError):
+                raise batch.exception
+            frame_indices, batch_frames = batch
+            if convert_batch is not None:
+                batch_frames = convert_batch(frame_indices, batch_frames)
+            if convert_frame is not None:
+                batch_frames = [convert_frame(frame_index, frame) for frame_index, frame in zip(frame_indices, batch_frames)]
+            for frame in batch_frames:
+                yield frame
+
+    statistics = write_frames(filename, frames(),
+                              number_of_frames = number_of_frames,
+                              compression = compression,
+                              number_of_threads = number_of_threads,
+                              bigtiff = bigtiff,
+                              frame_interval_in_seconds = frame_interval_in_seconds,
+                              pixel_length_in_um = pixel_length_in_um)
+    producer.join()
+    return statistics
+
+
+def to_int16(frame, converter, constant = 0):
+    """
+        Scales a frame to int16, saturating instead of wrapping around
+    """
+    return np.array(np.clip(constant + np.asarray(frame) * converter, -MAX_INT16, MAX_INT16),
+                    dtype = np.int16)
@@ -0,0 +1,285 @@
+import numpy as np
+
+DEFAULT_BATCH_SIZE = 1024
+INITIAL_CHUNK_SIZE = 16
+MAXIMUM_CHUNK_SIZE = 4096
+# Largest probability of missing an exit in an interval of move_molecules_coarse
+DEFAULT_REFINEMENT_THRESHOLD = 1e-9
+
+
+def is_in_frame(positions, screen_size_in_um, screen_depth_in_um):
+    """
+        Vectorized version of Molecule._is_in_frame, works on any array
+        whose last axis is (x, y, z)
+    """
+    x, y, z = positions[..., 0], positions[..., 1], positions[..., 2]
+    screen_size_x, screen_size_y = screen_size_in_um
+
+    return (x > 0) & (x < screen_size_x) & (y > 0) & (y < screen_size_y) & (z > 0) & (z < screen_depth_in_um)
+
+
+def _move_batch(initial_positions, step_size, number_of_steps,
+                screen_size_in_um, screen_depth_in_um,
+                stop_when_out_of_frame,
+                generators = None):
+    """
+        Moves a batch of molecules together.
+        Steps are drawn in chunks for all the molecules that are still alive,
+        cumulatively summed, and each molecule is cut at its first out-of-frame
+        position (which is never kept, same as Molecule.move).
+        The chunk size grows geometrically, since most molecules leave
+        the slab within a few steps and the rest tend to stay for a long time.
+        When generators (one per molecule) are given, every molecule draws its steps
+        from its own generator, otherwise all the steps come from np.random.
+        step_size is a number, or an array with the step size of every molecule.
+    """
+    number_of_molecules = len(initial_positions)
+    segments = [[position[np.newaxis, :]] for position in initial_positions]
+    step_sizes = np.broadcast_to(np.asarray(step_size, dtype = np.float64), (number_of_molecules,))
+
+    alive = np.arange(number_of_molecules)
+    current_positions = np.array(initial_positions, dtype = np.float64)
+    steps_done = 0
+    chunk_size = INITIAL_CHUNK_SIZE
+
+    while len(alive) and steps_done < number_of_steps:
+        chunk_size = min(chunk_size, number_of_steps - steps_done)
+
+        alive_step_sizes = step_sizes[alive, np.newaxis, np.newaxis]
+        if generators is None:
+            increments = np.random.normal(0, alive_step_sizes, [len(alive), chunk_size, 3])
+        else:
+            increments = alive_step_sizes * np.array([generators[index].standard_normal([chunk_size, 3])
+                                                      for index in alive])
+        path = current_positions[:, np.newaxis, :] + np.cumsum(increments, axis = 1)
+
+        if stop_when_out_of_frame:
+            outside = ~is_in_frame(path, screen_size_in_um, screen_depth_in_um)
+            left_frame = outside.any(axis = 1)
+            lengths = np.where(left_frame, outside.argmax(axis = 1), chunk_size)
+        else:
+            left_frame = np.zeros(len(alive), dtype = bool)
+            lengths = np.full(len(alive), chunk_size)
+
+        for index, molecule_path, length in zip(alive, path, lengths):
+            if length:
+                segments[index].append(molecule_path[:length])
+
+        still_alive = ~left_frame
+        alive = alive[still_alive]
+        current_positions = path[still_alive, -1]
+        steps_done += chunk_size
+        chunk_size = min(2 * chunk_size, MAXIMUM_CHUNK_SIZE)
+
+    return [np.concatenate(s) for s in segments]
+
+
+def move_molecules(initial_positions, step_size, number_of_steps,
+                   screen_size_in_um, screen_depth_in_um,
+                   stop_when_out_of_frame = True,
+                   batch_size = DEFAULT_BATCH_SIZE,
+                   random_streams = None,
+                   first_molecule = 0,
+                   progress = lambda x:x):
+    """
+        Batched replacement for calling Molecule.move on every molecule.
+        initial_positions is an (N, 3) array, returns a list of N arrays of
+        shape (length, 3), each starting with the initial position.
+        The statistics are the same as Molecule.move : i.i.d. gaussian steps,
+        stopping before the first step that leaves the frame.
+        step_size is a number, or an array with the step size of every molecule
+        (several species in one pass).
+        With random_streams, molecule i (counted from first_molecule) draws from
+        random_streams.molecule(first_molecule + i), so its track does not depend
+        on the batches or on which process moves it.
+    """
+    initial_positions = np.asarray(initial_positions, dtype = np.float64).reshape(-1, 3)
+    step_sizes = np.broadcast_to(np.asarray(step_size, dtype = np.float64), (len(initial_positions),))
+    tracks = []
+    for start in progress(range(0, len(initial_positions), batch_size)):
+        batch = initial_positions[start:start + batch_size]
+        generators = None
+        if random_streams is not None:
+            generators = [random_streams.molecule(first_molecule + start + i)
+                          for i in range(len(batch))]
+        tracks.extend(_move_batch(batch,
+                                  step_sizes[start:start + batch_size], number_of_steps,
+                                  screen_size_in_um, screen_depth_in_um,
+                                  stop_when_out_of_frame,
+                                  generators))
+    return tracks
+
+
+def bridge_exit_bound(start, end, variance, screen_size_in_um, screen_depth_in_um):
+    """
+        Upper bound on the probability that a Brownian bridge from start to end (both in the frame),
+        with a variance of variance per axis over the whole interval, leaves the frame on the way :
+        the sum over the 6 faces of exp(-2 d_start d_end / variance), the probability to cross a plane.
+        The positions of the discrete random walk are points of the bridge, so it bounds them too.
+    """
+    upper = np.array([screen_size_in_um[0], screen_size_in_um[1], screen_depth_in_um])
+    variance = np.asarray(variance)[..., np.newaxis]
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        lower_faces = np.exp(-2 * start * end / variance)
+        upper_faces = np.exp(-2 * (upper - start) * (upper - end) / variance)
+    return np.sum(np.nan_to_num(lower_faces + upper_faces), axis = -1)
+
+
+def _first_exits(starts, ends, lengths, step_sizes, normals,
+                 screen_size_in_um, screen_depth_in_um):
+    """
+        For intervals of lengths[i] steps of size step_sizes[i] of a gaussian walk from starts[i]
+        (in the frame) to ends[i], finds the first step that is out of the frame.
+        All the steps of all the intervals are drawn in one pass, as Brownian bridges :
+        a walk W of n = lengths[i] steps (normals, lengths.sum() standard normal triplets, interval after interval)
+        pinned to its end, starts[i] + W_k - k / n * (W_n - (ends[i] - starts[i])),
+        has exactly the law of the walk given its two ends.
+        Returns the first exit step of every interval (1..lengths[i]), 0 for no exit.
+    """
+    offsets = np.zeros(len(lengths) + 1, dtype = np.int64)
+    np.cumsum(lengths, out = offsets[1:])
+    intervals = np.repeat(np.arange(len(lengths)), lengths)
+    steps = np.arange(offsets[-1]) - offsets[intervals] + 1
+
+    walks = np.cumsum(normals * step_sizes[intervals, np.newaxis], axis = 0)
+    # Walks of every interval from 0, the running sum of the previous ones is taken off
+    walk_starts = np.concatenate([np.zeros((1, 3)), walks[offsets[1:-1] - 1]])
+    walks -= walk_starts[intervals]
+    pins = (walks[offsets[1:] - 1] - (ends - starts))[intervals]
+    positions = starts[intervals] + walks - (steps / lengths[intervals])[:, np.newaxis] * pins
+
+    exit_steps = np.zeros(len(lengths), dtype = np.int64)
+    outside = np.flatnonzero(~is_in_frame(positions, screen_size_in_um, screen_depth_in_um))
+    # Rows are in time order within an interval, so the first row out of the frame is the first exit
+    exiting, first_rows = np.unique(intervals[outside], return_index = True)
+    exit_steps[exiting] = steps[outside[first_rows]]
+    return exit_steps
+
+
+def _move_batch_coarse(initial_positions, start_frames, step_size, number_of_steps,
+                       screen_size_in_um, screen_depth_in_um,
+                       subframes_per_position,
+                       stop_when_out_of_frame,
+                       refinement_threshold,
+                       generators = None):
+    """
+        Coarse version of _move_batch, see move_molecules_coarse.
+        Intervals end on the multiples of subframes_per_position, so the first one of
+        every molecule is shorter unless it starts on one.
+    """
+    number_of_molecules = len(initial_positions)
+    segments = [[position[np.newaxis, :]] for position in initial_positions]
+    end_subframes = np.full(number_of_molecules, number_of_steps, dtype = np.int64)
+    step_sizes = np.broadcast_to(np.asarray(step_size, dtype = np.float64), (number_of_molecules,))
+
+    alive = np.arange(number_of_molecules)
+    current_positions = np.array(initial_positions, dtype = np.float64)
+    current_subframes = np.array(start_frames, dtype = np.int64)
+    chunk_size = INITIAL_CHUNK_SIZE
+
+    while len(alive):
+        # Subframes at the end of the next chunk_size intervals, and the interval lengths
+        boundaries = (current_subframes[:, np.newaxis] // subframes_per_position + 1 + np.arange(chunk_size)) * \
+                        subframes_per_position
+        boundaries = np.minimum(boundaries, number_of_steps)
+        lengths = np.diff(np.concatenate([current_subframes[:, np.newaxis], boundaries], axis = 1), axis = 1)
+
+        if generators is None:
+            normals = np.random.standard_normal([len(alive), chunk_size, 3])
+        else:
+            normals = np.array([generators[index].standard_normal([chunk_size, 3]) for index in alive])
+        alive_step_sizes = step_sizes[alive, np.newaxis]
+        path = current_positions[:, np.newaxis, :] + \
+                    np.cumsum((alive_step_sizes * np.sqrt(lengths))[:, :, np.newaxis] * normals, axis = 1)
+        # Rows are the positions at the start of every interval, the last boundary is not a row
+        number_of_rows = np.sum(boundaries < number_of_steps, axis = 1)
+
+        if stop_when_out_of_frame:
+            starts = np.concatenate([current_positions[:, np.newaxis, :], path[:, :-1]], axis = 1)
+            refine = ~is_in_frame(path, screen_size_in_um, screen_depth_in_um)
+            refine |= bridge_exit_bound(starts, path, lengths * alive_step_sizes ** 2,
+                                        screen_size_in_um, screen_depth_in_um) > refinement_threshold
+            refine &= lengths > 0
+            # Pairs are ordered by molecule and interval, so every molecule draws for its intervals in time order
+            molecules, intervals = np.nonzero(refine)
+            if len(molecules):
+                refined_lengths = lengths[molecules, intervals]
+                if generators is None:
+                    bridge_normals = np.random.standard_normal([refined_lengths.sum(), 3])
+                else:
+                    drawing, counts = np.unique(molecules, return_counts = True)
+                    draws = np.add.reduceat(refined_lengths, np.r_[0, np.cumsum(counts)[:-1]])
+                    bridge_normals = np.concatenate([generators[alive[molecule]].standard_normal([count, 3])
+                                                     for molecule, count in zip(drawing, draws)])
+                exit_steps = _first_exits(starts[molecules, intervals], path[molecules, intervals],
+                                          refined_lengths, alive_step_sizes[molecules, 0], bridge_normals,
+                                          screen_size_in_um, screen_depth_in_um)
+                exits = np.flatnonzero(exit_steps)
+                exiting, first_exit = np.unique(molecules[exits], return_index = True)
+                exits = exits[first_exit]
+                end_subframes[alive[exiting]] = boundaries[exiting, intervals[exits]] - \
+                                                    refined_lengths[exits] + exit_steps[exits]
+                number_of_rows[exiting] = intervals[exits]
+
+        for index, molecule_path, rows in zip(alive, path, number_of_rows):
+            if rows:
+                segments[index].append(molecule_path[:rows])
+
+        still_alive = (end_subframes[alive] == number_of_steps) & (boundaries[:, -1] < number_of_steps)
+        alive = alive[still_alive]
+        current_positions = path[still_alive, -1]
+        current_subframes = boundaries[still_alive, -1]
+        chunk_size = min(2 * chunk_size, MAXIMUM_CHUNK_SIZE)
+
+    return [np.concatenate(s) for s in segments], end_subframes
+
+
+def move_molecules_coarse(initial_positions, start_frames, step_size, number_of_steps,
+                          screen_size_in_um, screen_depth_in_um,
+                          subframes_per_position,
+                          stop_when_out_of_frame = True,
+                          refinement_threshold = DEFAULT_REFINEMENT_THRESHOLD,
+                          batch_size = DEFAULT_BATCH_SIZE,
+                          random_streams = None,
+                          first_molecule = 0,
+                          progress = lambda x:x):
+    """
+        Moves the molecules in exact gaussian steps of up to subframes_per_position subframes
+        (a sum of gaussian steps is gaussian), until subframe number_of_steps.
+        Only near the edges of the frame the steps in between matter : when the probability
+        that the walk left the frame inside an interval can be over refinement_threshold
+        (bridge_exit_bound), the subframe positions of the interval are drawn as a Brownian
+        bridge between its ends, and the molecule stops at the first one out of the frame,
+        same as move_molecules. Far from the edges only 3 numbers are drawn per interval.
+        The exit times are exact but for a probability of at most refinement_threshold
+        per interval to miss an exit.
+        This pays off when the molecules spend most of their intervals far from the edges,
+        i.e. when sqrt(subframes_per_position) * step_size is small next to the slab depth :
+        in a slab a few such intervals thick, most intervals need their bridge anyway and
+        move_molecules is faster.
+        step_size is a number, or an array with the step size of every molecule.
+        Returns the tracks, one position per interval (at start_frames and then on the
+        multiples of subframes_per_position), and the subframe at which every molecule
+        left the frame (number_of_steps if it did not), as TrajectoryStore.set_tracks takes them.
+    """
+    initial_positions = np.asarray(initial_positions, dtype = np.float64).reshape(-1, 3)
+    start_frames = np.asarray(start_frames, dtype = np.int64)
+    step_sizes = np.broadcast_to(np.asarray(step_size, dtype = np.float64), (len(initial_positions),))
+    tracks, end_subframes = [], []
+    for start in progress(range(0, len(initial_positions), batch_size)):
+        batch = slice(start, start + batch_size)
+        generators = None
+        if random_streams is not None:
+            generators = [random_streams.molecule(first_molecule + start + i)
+                          for i in range(len(initial_positions[batch]))]
+        batch_tracks, batch_end_subframes = _move_batch_coarse(initial_positions[batch],
+                                                               start_frames[batch],
+                                                               step_sizes[batch], number_of_steps,
+                                                               screen_size_in_um, screen_depth_in_um,
+                                                               subframes_per_position,
+                                                               stop_when_out_of_frame,
+                                                               refinement_threshold,
+                                                               generators)
+        tracks.extend(batch_tracks)
+        end_subframes.append(batch_end_subframes)
+    return tracks, np.concatenate(end_subframes) if end_subframes else np.zeros(0, dtype = np.int64)
@@ -0,0 +1,190 @@
+import json
+import numpy as np
+from trajectory_store import TrajectoryStore
+
+TRAJECTORY_FILE_EXTENSION = '.trajectories'
+MAGIC = b'DIFFTRJ1'
+# 2 added subframes_per_position and end_subframes, older files are not read
+FORMAT_VERSION = 2
+# Every array starts on a multiple of ALIGNMENT bytes, so it can be memory mapped
+ALIGNMENT = 64
+HEADER_LENGTH_DTYPE = np.dtype('<u8')
+
+INDEX_DTYPE = np.dtype('<i8')
+
+
+def _aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _to_json(value):
+    # Parameters may hold numpy scalars or arrays
+    return value.tolist()
+
+
+def write_trajectory_file(filename, stores, parameters, setup = None, dtype = None):
+    """
+        Writes the journeys of one or several TrajectoryStores (one per species) to filename.
+            parameters - the parameter dictionary of every store, enough to recreate its Simulation
+            setup      - any other JSON-able information to keep with the trajectories
+            dtype      - of the positions (np.float32 halves the file), by default the stores' dtype
+        Layout : MAGIC, the length of the JSON header, the header, then the columns
+        positions (N, 3), offsets, start_frames, species and end_subframes, each aligned for memory mapping.
+        Molecules are written species after species, so every species is a contiguous range.
+    """
+    if len(stores) != len(parameters):
+        raise Exception("Expected parameters for each of the {} stores, got {}".format(len(stores), len(parameters)))
+    for store in stores[1:]:
+        if store.step_time_in_seconds != stores[0].step_time_in_seconds or \
+                store.screen_depth_in_um != stores[0].screen_depth_in_um or \
+                not np.array_equal(store.screen_size_in_um, stores[0].screen_size_in_um):
+            raise Exception("All the stores need to have the same screen and step_time_in_seconds")
+    if dtype is None:
+        dtype = stores[0].positions.dtype
+    dtype = np.dtype(dtype).newbyteorder('<')
+
+    number_of_molecules = sum(len(store) for store in stores)
+    number_of_positions = sum(len(store.positions) for store in stores)
+    shapes = [('positions', dtype, [number_of_positions, 3]),
+              ('offsets', INDEX_DTYPE, [number_of_molecules + 1]),
+              ('start_frames', INDEX_DTYPE, [number_of_molecules]),
+              ('species', INDEX_DTYPE, [number_of_molecules]),
+              ('end_subframes', INDEX_DTYPE, [number_of_molecules])]
+
+    header = {
+        'version' : FORMAT_VERSION,
+        'parameters' : parameters,
+        'setup' : setup,
+        'screen_size_in_um' : stores[0].screen_size_in_um,
+        'screen_depth_in_um' : stores[0].screen_depth_in_um,
+        'step_time_in_seconds' : stores[0].step_time_in_seconds,
+        # Each store keeps its own species tables, they are concatenated in store order
+        'diffusion_coefficients' : [list(store.diffusion_coefficients) for store in stores],
+        'intensities' : [list(store.intensities) for store in stores],
+        'species_molecules' : np.cumsum([0] + [len(store) for store in stores]),
+        'subframes_per_position' : [store.subframes_per_position for store in stores],
+        'arrays' : {},
+    }
+
+    # Array offsets are relative to the (aligned) end of the header
+    offset = 0
+    for name, array_dtype, shape in shapes:
+        header['arrays'][name] = {'dtype' : array_dtype.str, 'shape' : shape, 'offset' : offset}
+        offset = _aligned(offset + array_dtype.itemsize * int(np.prod(shape)))
+    header_bytes = json.dumps(header, default = _to_json).encode()
+    data_start = _aligned(len(MAGIC) + HEADER_LENGTH_DTYPE.itemsize + len(header_bytes))
+
+    with open(filename, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.array(len(header_bytes), dtype = HEADER_LENGTH_DTYPE).tobytes())
+        f.write(header_bytes)
+
+        def write_column(name, parts):
+            f.seek(data_start + header['arrays'][name]['offset'])
+            array_dtype = np.dtype(header['arrays'][name]['dtype'])
+            for part in parts:
+                np.ascontiguousarray(part, dtype = array_dtype).tofile(f)
+
+        write_column('positions', (store.positions for store in stores))
+        first_rows = np.cumsum([0] + [len(store.positions) for store in stores])
+        write_column('offsets', [store.offsets[:-1] + first for store, first in zip(stores, first_rows)] +
+                                [[number_of_positions]])
+        write_column('start_frames', (store.start_frames for store in stores))
+        first_species = np.cumsum([0] + [len(store.diffusion_coefficients) for store in stores])
+        write_column('species', (store.species + first for store, first in zip(stores, first_species)))
+        write_column('end_subframes', (store.end_subframes for store in stores))
+        f.truncate(data_start + offset)
+
+
+class TrajectoryFile:
+    """
+        Memory mapped reader of a file written by write_trajectory_file.
+        Opening only reads the header, positions are read from disk when they are used.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise Exception("{} is not a trajectory file".format(filename))
+            header_length = int(np.frombuffer(f.read(HEADER_LENGTH_DTYPE.itemsize), dtype = HEADER_LENGTH_DTYPE)[0])
+            header = json.loads(f.read(header_length).decode())
+        if header['version'] != FORMAT_VERSION:
+            raise Exception("Unsupported trajectory file version {}, expected {}".format(header['version'], FORMAT_VERSION))
+
+        self.header = header
+        self.parameters = header['parameters']
+        self.setup = header['setup']
+        self.species_molecules = np.array(header['species_molecules'], dtype = np.int64)
+        data_start = _aligned(len(MAGIC) + HEADER_LENGTH_DTYPE.itemsize + header_length)
+        for name, array in header['arrays'].items():
+            shape = tuple(array['shape'])
+            if np.prod(shape) == 0:
+                mapped = np.zeros(shape, dtype = array['dtype'])
+            else:
+                mapped = np.memmap(filename, dtype = array['dtype'], mode = 'r',
+                                   offset = data_start + array['offset'], shape = shape)
+            setattr(self, name, mapped)
+
+    @property
+    def number_of_species(self):
+        return len(self.parameters)
+
+    def __len__(self):
+        return len(self.start_frames)
+
+    def read_store(self, species = None, steps = None):
+        """
+            A TrajectoryStore of the molecules of one species (an index into parameters),
+            or of all of them.
+            With steps = (first, last), only the positions in the subframes [first, last) are read,
+            molecules keep their index but their journeys are cut to the window.
+            Without a window the positions of the store are a memory map of the file.
+            Coarse journeys (see TrajectoryStore) can not be cut to a window.
+        """
+        subframes_per_position = self.header['subframes_per_position']
+        if species is None:
+            first, last = 0, len(self)
+            species_column = np.asarray(self.species)
+            diffusion_coefficients = sum(self.header['diffusion_coefficients'], [])
+            intensities = sum(self.header['intensities'], [])
+            if len(set(subframes_per_position)) > 1:
+                raise Exception("The species have different subframes_per_position, read them one at a time")
+            subframes_per_position = subframes_per_position[0] if subframes_per_position else 1
+        else:
+            first, last = self.species_molecules[species], self.species_molecules[species + 1]
+            first_species = sum(len(table) for table in self.header['diffusion_coefficients'][:species])
+            species_column = np.asarray(self.species[first:last]) - first_species
+            diffusion_coefficients = self.header['diffusion_coefficients'][species]
+            intensities = self.header['intensities'][species]
+            subframes_per_position = subframes_per_position[species]
+
+        offsets = np.asarray(self.offsets[first:last + 1])
+        start_frames = np.array(self.start_frames[first:last])
+        end_subframes = np.array(self.end_subframes[first:last])
+        if steps is None:
+            positions = self.positions[offsets[0]:offsets[-1]]
+            offsets = offsets - offsets[0]
+        else:
+            if subframes_per_position != 1:
+                raise Exception("Can not read a window of coarse journeys")
+            first_step, last_step = steps
+            lengths = np.diff(offsets)
+            begin = np.clip(first_step - start_frames, 0, lengths)
+            end = np.clip(last_step - start_frames, begin, lengths)
+            counts = end - begin
+            offsets = np.zeros(len(counts) + 1, dtype = np.int64)
+            np.cumsum(counts, out = offsets[1:])
+            rows = np.repeat(self.offsets[first:last] + begin - offsets[:-1], counts) + np.arange(offsets[-1])
+            # Rows are increasing, so only the pages of the window are read
+            positions = np.asarray(self.positions[rows])
+            start_frames = start_frames + begin
+            end_subframes = None
+
+        return TrajectoryStore.from_arrays(positions, offsets, start_frames, species_column,
+                                           self.header['screen_size_in_um'],
+                                           self.header['screen_depth_in_um'],
+                                           self.header['step_time_in_seconds'],
+                                           diffusion_coefficients = diffusion_coefficients,
+                                           intensities = intensities,
+                                           end_subframes = end_subframes,
+                                           subframes_per_position = subframes_per_position)
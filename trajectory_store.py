@@ -0,0 +1,273 @@
+import numpy as np
+
+
+class TrajectoryStore:
+    """
+        Struct-of-arrays storage for the journeys of all the molecules of a simulation.
+        The positions of every molecule are kept back to back in one (N, 3) buffer,
+        molecule i owns positions[offsets[i]:offsets[i+1]] (CSR style).
+        Per-species parameters are kept in small tables indexed by the species column.
+        Usually there is a position for every subframe, from start_frames on. Coarse stores
+        (subframes_per_position > 1, see move_molecules_coarse) only keep the position at the
+        start frame and on the multiples of subframes_per_position, every position stands for
+        the subframes until the next one, and end_subframes is the subframe at which every
+        molecule left the frame.
+    """
+    def __init__(self, start_frames, initial_positions,
+                 screen_size_in_um,
+                 screen_depth_in_um,
+                 step_time_in_seconds,
+                 species = None,
+                 diffusion_coefficients = (0.,),
+                 intensities = (1.,),
+                 dtype = np.float64):
+
+        self.start_frames = np.asarray(start_frames, dtype = np.int64)
+        number_of_molecules = len(self.start_frames)
+        if species is None:
+            species = np.zeros(number_of_molecules, dtype = np.int64)
+        self.species = np.asarray(species, dtype = np.int64)
+
+        self.screen_size_in_um = np.asarray(screen_size_in_um, dtype = np.float64)
+        self.screen_depth_in_um = screen_depth_in_um
+        self.step_time_in_seconds = step_time_in_seconds
+        self.diffusion_coefficients = np.asarray(diffusion_coefficients, dtype = np.float64)
+        self.intensities = np.asarray(intensities, dtype = np.float64)
+        self.dtype = dtype
+
+        self.set_tracks(np.asarray(initial_positions).reshape(number_of_molecules, 1, 3))
+
+    @classmethod
+    def from_arrays(cls, positions, offsets, start_frames, species,
+                    screen_size_in_um,
+                    screen_depth_in_um,
+                    step_time_in_seconds,
+                    diffusion_coefficients = (0.,),
+                    intensities = (1.,),
+                    end_subframes = None,
+                    subframes_per_position = 1):
+        """
+            Wraps existing buffers (e.g. shared or memory mapped) without copying them
+        """
+        store = cls.__new__(cls)
+        store.positions = positions
+        store.offsets = offsets
+        store.start_frames = start_frames
+        store.species = species
+        store.screen_size_in_um = np.asarray(screen_size_in_um, dtype = np.float64)
+        store.screen_depth_in_um = screen_depth_in_um
+        store.step_time_in_seconds = step_time_in_seconds
+        store.diffusion_coefficients = np.asarray(diffusion_coefficients, dtype = np.float64)
+        store.intensities = np.asarray(intensities, dtype = np.float64)
+        store.dtype = positions.dtype
+        store.subframes_per_position = subframes_per_position
+        store._set_end_subframes(end_subframes)
+        store._subframe_indices = {}
+        return store
+
+    def _set_end_subframes(self, end_subframes):
+        if end_subframes is None:
+            if self.subframes_per_position != 1:
+                raise Exception("Coarse stores need end_subframes")
+            end_subframes = self.start_frames + self.lengths
+        self.end_subframes = np.asarray(end_subframes, dtype = np.int64)
+
+    def set_tracks(self, tracks, end_subframes = None, subframes_per_position = 1):
+        """
+            Replaces the journeys with a sequence of (length, 3) arrays,
+            one for every molecule (and with end_subframes for coarse tracks).
+        """
+        lengths = np.array([len(track) for track in tracks], dtype = np.int64)
+        if len(lengths) != len(self):
+            raise Exception("Expected {} tracks, got {}".format(len(self), len(lengths)))
+
+        self.offsets = np.zeros(len(lengths) + 1, dtype = np.int64)
+        np.cumsum(lengths, out = self.offsets[1:])
+        if len(lengths):
+            self.positions = np.concatenate(tracks).astype(self.dtype, copy = False)
+        else:
+            self.positions = np.zeros([0, 3], dtype = self.dtype)
+        self.subframes_per_position = subframes_per_position
+        self._set_end_subframes(end_subframes)
+        self._subframe_indices = {}
+
+    def set_buffers(self, positions, offsets, end_subframes = None, subframes_per_position = 1):
+        """
+            Replaces the journeys with an existing positions buffer and its offsets
+        """
+        if len(offsets) != len(self) + 1:
+            raise Exception("Expected {} offsets, got {}".format(len(self) + 1, len(offsets)))
+        self.positions = np.asarray(positions, dtype = self.dtype)
+        self.offsets = np.asarray(offsets, dtype = np.int64)
+        self.subframes_per_position = subframes_per_position
+        self._set_end_subframes(end_subframes)
+        self._subframe_indices = {}
+
+    def species_view(self, species):
+        """
+            A store of the molecules of one species, with only its tables,
+            that shares the buffers of this one. The molecules of the species have to be contiguous.
+        """
+        molecules = np.flatnonzero(self.species == species)
+        first = molecules[0] if len(molecules) else 0
+        last = first + len(molecules)
+        if len(molecules) and molecules[-1] != last - 1:
+            raise Exception("The molecules of species {} are not contiguous".format(species))
+        offsets = self.offsets[first:last + 1]
+        return TrajectoryStore.from_arrays(self.positions[offsets[0]:offsets[-1]],
+                                           offsets - offsets[0],
+                                           self.start_frames[first:last],
+                                           np.zeros(len(molecules), dtype = np.int64),
+                                           self.screen_size_in_um,
+                                           self.screen_depth_in_um,
+                                           self.step_time_in_seconds,
+                                           diffusion_coefficients = self.diffusion_coefficients[[species]],
+                                           intensities = self.intensities[[species]],
+                                           end_subframes = self.end_subframes[first:last],
+                                           subframes_per_position = self.subframes_per_position)
+
+    @property
+    def is_coarse(self):
+        return self.subframes_per_position != 1
+
+    def _check_not_coarse(self):
+        if self.is_coarse:
+            raise Exception("Needs a position for every step, the store only has one every {} subframes".format(
+                                self.subframes_per_position))
+
+    def __len__(self):
+        return len(self.start_frames)
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    @property
+    def step_sizes(self):
+        return np.sqrt(2 * self.diffusion_coefficients * self.step_time_in_seconds)
+
+    def nbytes(self):
+        return sum(a.nbytes for a in [self.positions, self.offsets,
+                                      self.start_frames, self.species, self.end_subframes])
+
+    def get_positions(self, index):
+        """
+            Returns an (length, 3) view of the journey of molecule `index`
+        """
+        return self.positions[self.offsets[index]:self.offsets[index + 1]]
+
+    def get_position_in_frame(self, index, frame_number):
+        start_frame = self.start_frames[index]
+        if frame_number < start_frame or frame_number >= self.end_subframes[index]:
+            return None
+        position_index = frame_number - start_frame
+        if self.is_coarse:
+            position_index = frame_number // self.subframes_per_position - start_frame // self.subframes_per_position
+        if position_index >= self.offsets[index + 1] - self.offsets[index]:
+            return None
+        return self.positions[self.offsets[index] + position_index]
+
+    def row_subframes(self, rows = None):
+        """
+            The subframe of every row of the positions buffer (or of rows)
+        """
+        if rows is None:
+            rows = np.arange(len(self.positions))
+        molecule_ids = self.molecule_ids_of_rows(rows)
+        position_index = rows - self.offsets[molecule_ids]
+        start_frames = self.start_frames[molecule_ids]
+        if not self.is_coarse:
+            return start_frames + position_index
+        aligned = (start_frames // self.subframes_per_position + position_index) * self.subframes_per_position
+        return np.where(position_index == 0, start_frames, aligned)
+
+    def row_weights(self, rows):
+        """
+            Number of subframes every row stands for (1 unless the store is coarse)
+        """
+        if not self.is_coarse:
+            return np.ones(len(rows))
+        molecule_ids = self.molecule_ids_of_rows(rows)
+        subframes = self.row_subframes(rows)
+        next_subframes = (subframes // self.subframes_per_position + 1) * self.subframes_per_position
+        return np.minimum(next_subframes, self.end_subframes[molecule_ids]) - subframes
+
+    def get_subframe_index(self, number_of_subframes):
+        """
+            The SubframeIndex of the store, built on first use and kept until the tracks change
+        """
+        if number_of_subframes not in self._subframe_indices:
+            self._subframe_indices[number_of_subframes] = SubframeIndex(self, number_of_subframes)
+        return self._subframe_indices[number_of_subframes]
+
+    def set_subframe_index(self, index):
+        self._subframe_indices[index.number_of_subframes] = index
+
+    def molecule_ids_of_rows(self, rows):
+        return np.searchsorted(self.offsets, rows, side = 'right') - 1
+
+    def molecule_ids(self):
+        """
+            The molecule index of every row of the positions buffer
+        """
+        return np.repeat(np.arange(len(self)), self.lengths)
+
+    def square_displacements(self, n = 1, minimum_length = None):
+        """
+            2D square displacements with a lag of n steps, for all the molecules at once.
+            Only pairs of positions that belong to the same molecule are used.
+            Returns the displacements and the molecule index of every displacement,
+            ordered by molecule (same order as concatenating Molecule._square_displacement_vector).
+        """
+        self._check_not_coarse()
+        if minimum_length is None:
+            minimum_length = n + 1
+        starts = self.offsets[:-1]
+        counts = np.maximum(self.lengths - n, 0)
+        counts[self.lengths < minimum_length] = 0
+
+        molecule_ids = np.repeat(np.arange(len(self)), counts)
+        first = np.repeat(starts - np.concatenate([[0], np.cumsum(counts)[:-1]]), counts) + \
+                    np.arange(counts.sum())
+
+        delta = self.positions[first + n, :2] - self.positions[first, :2]
+        return np.sum(delta.astype(np.float64) ** 2, axis = 1), molecule_ids
+
+
+class SubframeIndex:
+    """
+        Maps every subframe to the rows of the positions buffer that are alive in it.
+        The rows are sorted by subframe once, so the emitters of any range
+        of subframes are one contiguous slice : rows[offsets[first]:offsets[last]].
+        Positions after the last subframe are not indexed.
+    """
+    def __init__(self, store, number_of_subframes):
+        self.number_of_subframes = number_of_subframes
+        if store is None:
+            return
+
+        subframes = store.row_subframes()
+        rows = np.flatnonzero((subframes >= 0) & (subframes < number_of_subframes))
+
+        self.rows = rows[np.argsort(subframes[rows], kind = 'stable')]
+        self.offsets = np.zeros(number_of_subframes + 1, dtype = np.int64)
+        np.cumsum(np.bincount(subframes[rows], minlength = number_of_subframes),
+                  out = self.offsets[1:])
+
+    @classmethod
+    def from_arrays(cls, rows, offsets):
+        index = cls(None, len(offsets) - 1)
+        index.rows = rows
+        index.offsets = offsets
+        return index
+
+    def rows_in_subframes(self, first, last):
+        """
+            Rows alive in the subframes [first, last)
+        """
+        first = min(max(first, 0), self.number_of_subframes)
+        last = min(max(last, first), self.number_of_subframes)
+        return self.rows[self.offsets[first]:self.offsets[last]]
+
+    def number_of_active(self, first, last):
+        return len(self.rows_in_subframes(first, last))